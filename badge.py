@@ -0,0 +1,925 @@
+#!/usr/bin/env python3
+
+# Single entry point for the MCH2022 badge tools
+#
+#     badge.py {command} [arguments]
+#
+# The commands mirror the separate tools (badge.py filesystem_push is
+# equivalent to filesystem_push.py). Only the parser of the selected command
+# is built, and pyusb is only imported once a connection is made, so
+# starting a command costs as little as possible.
+
+import os
+import sys
+
+def connect(begin = True, progress = True):
+    from webusb import Badge, TerminalProgress
+    try:
+        badge = Badge(progress=TerminalProgress() if progress else None)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if begin and not badge.begin():
+        print("Failed to connect")
+        sys.exit(1)
+    return badge
+
+def check_path(name):
+    if not (name.startswith("/internal") or name.startswith("/sd")):
+        print("Path should always start with /internal or /sd")
+        sys.exit(1)
+    if name.endswith("/"):
+        name = name[:-1]
+    return name
+
+def format_size(size):
+    if size >= 1024:
+        return str(round(size / 1024, 2)) + " KB"
+    return str(size) + " B"
+
+# Application management
+
+def app_list_arguments(parser):
+    pass
+
+def app_list(args):
+    badge = connect()
+    applist = badge.app_list()
+    if applist is None:
+        print("** Failed to load application list **")
+        return 1
+    print("\x1b[4m{: <48}\x1b[0m \x1b[4m{: <64}\x1b[0m \x1b[4m{: <8}\x1b[0m \x1b[4m{: <10}\x1b[0m".format("Name", "Title", "Version", "Size"))
+    for app in applist:
+        size = str(app["size"]) + " B"
+        if app["size"] > 1024:
+            size = str(round(app["size"] / 1024, 2)) + " KB"
+        print("{: <48} {: <64} {: <8} {: <10}".format(app["name"].decode("ascii", errors="ignore"), app["title"].decode("ascii", errors="ignore"), str(app["version"]), size))
+    return 0
+
+def app_push_arguments(parser):
+    parser.add_argument("file", help="Application binary")
+    parser.add_argument("name", help="Application name")
+    parser.add_argument("title", help="Application title")
+    parser.add_argument("version", type=int, help="Application version")
+    parser.add_argument('--run', '-r', '-R', action='store_true', help="Run application after uploading")
+    parser.add_argument("--force", "-f", action="store_true", help="Install even if the same version is installed already")
+
+def plan_apps(badge, apps, remove = [], force = False):
+    """
+    Plans installing apps on the badge, prints the plan and returns it, None if the plan can't be made or doesn't fit
+    """
+    from webusb_appfs import plan_install
+    applist = badge.app_list()
+    state = badge.fs_state()
+    if applist is None or not state:
+        print("Failed to read the AppFS state")
+        return None
+    plan = plan_install(applist, state["app"]["free"], apps, remove, force)
+    for app in plan["skip"]:
+        print("App {} is up to date".format(app["name"].decode("ascii", "ignore")))
+    if not plan["fits"]:
+        print("Not enough space in the AppFS, {} more needed".format(format_size(plan["shortage"])))
+        return None
+    return plan
+
+def print_step(action, name, result):
+    name = name.decode("ascii", "ignore")
+    if action == "remove":
+        print("Removed {}".format(name) if result else "Failed to remove {}".format(name))
+    else:
+        print("App {} installed succesfully".format(name) if result else "Failed to install app {}".format(name))
+
+def app_push(args):
+    from webusb_appfs import app_from_file, execute_plan
+    name = args.name.encode("ascii", "ignore")
+    title = args.title.encode("ascii", "ignore")
+    app = app_from_file(args.file, name, title, args.version)
+
+    badge = connect()
+    plan = plan_apps(badge, [app], force=args.force)
+    if plan is None or not execute_plan(badge, plan, print_step):
+        return 1
+
+    if args.run:
+        if not badge.app_run(name):
+            print("Failed to start")
+            return 1
+        badge.reset(False)
+        print("Started")
+    return 0
+
+def app_install_arguments(parser):
+    parser.add_argument("manifest", help="JSON file with a list of apps, objects with file, name, title and version")
+    parser.add_argument("--remove", nargs="+", default=[], metavar="NAME", help="Apps to remove")
+    parser.add_argument("--remove-unlisted", action="store_true", help="Remove all apps that are not in the manifest")
+    parser.add_argument("--force", "-f", action="store_true", help="Install apps even if the same version is installed already")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="Only show what would be done")
+
+def app_install(args):
+    import json
+    from webusb_appfs import app_from_file, execute_plan
+    directory = os.path.dirname(os.path.abspath(args.manifest))
+    try:
+        with open(args.manifest, "r") as f:
+            manifest = json.load(f)
+        apps = []
+        for entry in manifest:
+            # Files are relative to the manifest
+            filename = os.path.join(directory, entry["file"])
+            apps.append(app_from_file(filename, entry["name"].encode("ascii", "ignore"), entry.get("title", entry["name"]).encode("ascii", "ignore"), int(entry.get("version", 0))))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("Invalid manifest: {}".format(e))
+        return 1
+
+    badge = connect()
+    remove = [name.encode("ascii", "ignore") for name in args.remove]
+    if args.remove_unlisted:
+        applist = badge.app_list()
+        if applist is None:
+            print("** Failed to load application list **")
+            return 1
+        remove += [app["name"] for app in applist]
+    plan = plan_apps(badge, apps, remove, args.force)
+    if plan is None:
+        return 1
+    if args.dry_run:
+        for name in plan["remove"]:
+            print("Would remove {}".format(name.decode("ascii", "ignore")))
+        for app in plan["install"]:
+            print("Would install {} version {} ({})".format(app["name"].decode("ascii", "ignore"), app["version"], format_size(app["size"])))
+        return 0
+    if not execute_plan(badge, plan, print_step):
+        return 1
+    print("{} removed, {} installed, {} up to date".format(len(plan["remove"]), len(plan["install"]), len(plan["skip"])))
+    return 0
+
+def app_cache_arguments(parser):
+    parser.add_argument("--cache", nargs="?", const="", default=os.environ.get("BADGE_APP_CACHE"), metavar="DIRECTORY", help="Only download apps whose name, version or size isn't cached yet, cached in DIRECTORY (~/.cache/mch2022-tools/apps by default)")
+    parser.add_argument("--cache-size", type=int, default=256, help="Maximum size of the cache in MB")
+
+def open_app_cache(args):
+    if args.cache is None:
+        return None
+    from webusb_appcache import AppCache
+    return AppCache(args.cache or None, args.cache_size * 1024 * 1024)
+
+def read_app(badge, app, cache):
+    """
+    Returns the binary of app (an entry of app_list), from the cache if possible, False if it can't be downloaded
+    """
+    if cache is not None:
+        data = cache.get(app)
+        if data is not None:
+            print("App {} unchanged, copied from the cache".format(app["name"].decode("ascii", "ignore")))
+            return data
+    data = badge.app_read(app["name"])
+    if data is not False and cache is not None:
+        cache.put(app, data)
+    return data
+
+def app_pull_arguments(parser):
+    parser.add_argument("name", help="Remote app")
+    parser.add_argument("target", help="Local file")
+    app_cache_arguments(parser)
+
+def app_pull(args):
+    name = args.name.encode("ascii", "ignore")
+    cache = open_app_cache(args)
+    badge = connect()
+    if cache is not None:
+        applist = badge.app_list()
+        if applist is None:
+            print("** Failed to load application list **")
+            return 1
+        apps = [app for app in applist if app["name"] == name]
+        if len(apps) < 1:
+            print("App not found")
+            return 1
+        result = read_app(badge, apps[0], cache)
+        cache.save()
+    else:
+        result = badge.app_read(name)
+    if not result:
+        print("Failed to download app")
+        return 1
+    with open(args.target, "wb") as f:
+        f.write(result)
+        f.truncate(len(result))
+    print("App downloaded succesfully")
+    return 0
+
+def app_export_arguments(parser):
+    parser.add_argument("directory", help="Local directory for the binaries and manifest.json")
+    app_cache_arguments(parser)
+
+def app_export(args):
+    import json
+    cache = open_app_cache(args)
+    badge = connect()
+    applist = badge.app_list()
+    if applist is None:
+        print("** Failed to load application list **")
+        return 1
+    os.makedirs(args.directory, exist_ok=True)
+    manifest = []
+    failed = False
+    for app in applist:
+        name = app["name"].decode("ascii", "ignore")
+        data = read_app(badge, app, cache)
+        if data is False:
+            print("Failed to download app {}".format(name))
+            failed = True
+            continue
+        filename = name.replace("/", "_") + ".bin"
+        with open(os.path.join(args.directory, filename), "wb") as f:
+            f.write(data)
+        manifest.append({"file": filename, "name": name, "title": app["title"].decode("ascii", "ignore"), "version": app["version"]})
+        print("Exported {}".format(name))
+    if cache is not None:
+        cache.save()
+    with open(os.path.join(args.directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    print("Manifest written to {}".format(os.path.join(args.directory, "manifest.json")))
+    return 1 if failed else 0
+
+def app_remove_arguments(parser):
+    parser.add_argument("name", help="Name of app to be removed")
+
+def app_remove(args):
+    badge = connect()
+    if not badge.app_remove(args.name.encode('ascii', "ignore")):
+        print("Failed to remove")
+        return 1
+    print("Removed")
+    return 0
+
+def app_run_arguments(parser):
+    parser.add_argument("name", help="Name of app to be started")
+    parser.add_argument("--command", "-c", help="String to be stored in memory", required=False)
+
+def app_run(args):
+    badge = connect()
+    command = args.command.encode('ascii', "ignore") if args.command else None
+    if not badge.app_run(args.name.encode('ascii', "ignore"), command):
+        print("Failed to start")
+        return 1
+    badge.reset(False)
+    print("Started")
+    return 0
+
+# FAT filesystem
+
+def filesystem_list_arguments(parser):
+    parser.add_argument("name", help="directory name")
+    parser.add_argument('--recursive', '-r', '-R', action='store_true')
+
+def filesystem_list(args):
+    from datetime import datetime
+    header = "\x1b[4m{: <5}\x1b[0m \x1b[4m{: <64}\x1b[0m \x1b[4m{: <12}\x1b[0m \x1b[4m{: <19}\x1b[0m".format("Type", "Name", "Size", "Modified")
+
+    if args.name == "/":
+        print(header)
+        print("{: <5} {: <64} {: <12} {: <19}".format("Dir", "/internal", "", ""))
+        print("{: <5} {: <64} {: <12} {: <19}".format("Dir", "/sd", "", ""))
+        return 0
+
+    name = check_path(args.name)
+    badge = connect()
+
+    def listdir(location, recursive = False):
+        filelist = badge.fs_list(location)
+        if filelist is None:
+            print(location.decode("ascii") + " ** Failed to open directory **")
+            return
+        for f in filelist:
+            sizestring = ""
+            modifiedstring = ""
+            if f["stat"]:
+                if f["type"] != 2:
+                    sizestring = format_size(f["stat"]["size"])
+                modifiedstring = datetime.utcfromtimestamp(f["stat"]["modified"]).strftime('%Y-%m-%d %H:%M:%S')
+            typestring = "Dir" if f["type"] == 2 else "File"
+            newlocation = location + b"/" + f["name"]
+            print("{: <5} {: <64} {: <12} {: <19}".format(typestring, newlocation.decode("ascii", errors="ignore"), sizestring, modifiedstring))
+            if f["type"] == 2 and recursive:
+                listdir(newlocation, recursive)
+
+    print(header)
+    listdir(name.encode("ascii"), args.recursive)
+    return 0
+
+def filesystem_push_arguments(parser):
+    parser.add_argument("name", help="Local file, directory or archive (- for a tar stream on stdin)")
+    parser.add_argument("target", help="Remote file or directory")
+    parser.add_argument("--extract", "-x", action="store_true", help="Unpack the tar or zip archive name into the target directory")
+
+def archive_members(name):
+    """
+    Generator of (path, is_directory, size, file) tuples for the members of a tar or zip archive, reading tar archives as a stream
+    """
+    import tarfile
+    import zipfile
+    if name != "-" and zipfile.is_zipfile(name):
+        with zipfile.ZipFile(name) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    yield (info.filename, True, 0, None)
+                else:
+                    with archive.open(info) as f:
+                        yield (info.filename, False, info.file_size, f)
+        return
+    fileobj = sys.stdin.buffer if name == "-" else None
+    with tarfile.open(None if fileobj else name, mode="r|*", fileobj=fileobj) as archive:
+        for info in archive:
+            if info.isdir():
+                yield (info.name, True, 0, None)
+            elif info.isfile():
+                yield (info.name, False, info.size, archive.extractfile(info))
+            else:
+                print("Skipping {}, only files and directories are supported".format(info.name))
+
+def push_archive(badge, name, target):
+    import posixpath
+    created = set()
+
+    def create_directory(path):
+        if path in created or path == target:
+            return
+        create_directory(posixpath.dirname(path))
+        badge.fs_create_directory(path.encode("ascii", "ignore"))
+        created.add(path)
+
+    badge.fs_create_directory(target.encode("ascii", "ignore"))
+    for (member, is_directory, size, f) in archive_members(name):
+        parts = [part for part in member.split("/") if part not in ["", "."]]
+        if len(parts) < 1:
+            continue
+        if ".." in parts:
+            print(f"Skipping {member}, it points outside of the archive")
+            continue
+        path = posixpath.join(target, *parts)
+        if is_directory:
+            create_directory(path)
+            continue
+        create_directory(posixpath.dirname(path))
+        # Members are streamed from the archive straight to the badge
+        if not badge.fs_write_stream(path.encode("ascii", "ignore"), iter(lambda: f.read(8192), b""), size):
+            print(f"Failed to push {member} to {path}")
+            sys.exit(1)
+        print(f"File {member} pushed succesfully to {path}")
+
+def filesystem_push(args):
+    name = args.name
+    target = check_path(args.target)
+    badge = connect()
+
+    if args.extract or name == "-":
+        push_archive(badge, name, target)
+        return 0
+
+    def upload_file(name, target):
+        # The file is read while it is being sent
+        with open(name, "rb") as f:
+            result = badge.fs_write_file(target.encode("ascii", "ignore"), f)
+        if not result:
+            print(f"Failed to push file {name} to {target}")
+            sys.exit(1)
+        print(f"File {name} pushed succesfully to {target}")
+
+    if os.path.isdir(name):
+        # Small files are written back-to-back by fs_write_files, large files one by one afterwards
+        directories = []
+        small = []
+        large = []
+        for root, dirs, files in os.walk(name, topdown=True):
+            remote_root = target + root[len(name):].replace(os.sep, "/")
+            for dirname in dirs:
+                directories.append((remote_root + "/" + dirname).encode("ascii", "ignore"))
+            for filename in files:
+                local = os.path.join(root, filename)
+                remote = remote_root + "/" + filename
+                if os.path.getsize(local) > 256 * 1024:
+                    large.append((local, remote))
+                else:
+                    small.append((local, remote))
+
+        contents = []
+        for (local, remote) in small:
+            with open(local, "rb") as f:
+                contents.append((remote.encode("ascii", "ignore"), f.read()))
+
+        def written(index, success):
+            (local, remote) = small[index]
+            if success:
+                print(f"File {local} pushed succesfully to {remote}")
+            else:
+                print(f"Failed to push file {local} to {remote}")
+
+        results = badge.fs_write_files(contents, directories, written)
+        if not all(results):
+            sys.exit(1)
+        for (local, remote) in large:
+            upload_file(local, remote)
+    else:
+        upload_file(name, target)
+    return 0
+
+def filesystem_pull_arguments(parser):
+    parser.add_argument("name", help="Remote file or directory")
+    parser.add_argument("target", help="Local file or directory")
+    parser.add_argument("--recursive", "-r", "-R", action="store_true", help="Download the directory name and everything in it")
+    parser.add_argument("--cache", nargs="?", const="", default=os.environ.get("BADGE_PULL_CACHE"), metavar="DIRECTORY", help="Only download files whose size or modification time changed since they were pulled before, cached in DIRECTORY (~/.cache/mch2022-tools/pull by default)")
+    parser.add_argument("--cache-size", type=int, default=256, help="Maximum size of the cache in MB")
+
+def remote_stat(badge, name):
+    """
+    Returns the stat of remote file name from the listing of its directory, None if it can't be found
+    """
+    (directory, _, filename) = name.rpartition(b"/")
+    listing = badge.fs_list(directory)
+    for item in listing or []:
+        if item["name"] == filename and item["type"] != 2:
+            return item["stat"]
+    return None
+
+def pull_tree(badge, name, target, cache = None):
+    tree = badge.fs_list_tree(name.encode("ascii", "ignore"))
+    if tree is None:
+        print("Failed to list directory")
+        sys.exit(1)
+    os.makedirs(target, exist_ok=True)
+    directories = []
+    files = []
+    for (path, item) in tree:
+        parts = path[len(name) + 1:].decode("ascii", "ignore").split("/")
+        if any(part in ["", ".", ".."] for part in parts):
+            continue
+        local = os.path.join(target, *parts)
+        if item["type"] == 2:
+            os.makedirs(local, exist_ok=True)
+            directories.append((local, item))
+        else:
+            files.append((path, item, local))
+
+    def set_modified(local, item):
+        if item["stat"]:
+            os.utime(local, (item["stat"]["modified"], item["stat"]["modified"]))
+
+    def store(path, item, local, data):
+        with open(local, "wb") as f:
+            f.write(data)
+        set_modified(local, item)
+
+    if cache is not None:
+        remaining = []
+        for (path, item, local) in files:
+            data = cache.get(badge.serial, path.decode("ascii", "ignore"), item["stat"])
+            if data is None:
+                remaining.append((path, item, local))
+                continue
+            store(path, item, local, data)
+            print("File {} unchanged, copied from the cache to {}".format(path.decode("ascii", "ignore"), local))
+        files = remaining
+
+    def received(index, data):
+        (path, item, local) = files[index]
+        if data is False:
+            print("Failed to download {}".format(path.decode("ascii", "ignore")))
+            return
+        store(path, item, local, data)
+        if cache is not None:
+            cache.put(badge.serial, path.decode("ascii", "ignore"), item["stat"], data)
+        print("File {} downloaded succesfully to {}".format(path.decode("ascii", "ignore"), local))
+
+    # Files whose size is unknown are read on their own after the others
+    results = badge.fs_read_files([(path, item["stat"]["size"] if item["stat"] else -1) for (path, item, local) in files], received)
+    if cache is not None:
+        cache.save()
+    # Writing the files changed the modification times of the directories
+    for (local, item) in reversed(directories):
+        set_modified(local, item)
+    return 0 if all(results) else 1
+
+def filesystem_pull(args):
+    name = check_path(args.name)
+    cache = None
+    if args.cache is not None:
+        from webusb_pullcache import PullCache
+        cache = PullCache(args.cache or None, args.cache_size * 1024 * 1024)
+    badge = connect()
+    if args.recursive:
+        return pull_tree(badge, name, args.target, cache)
+    stat = None
+    if cache is not None:
+        stat = remote_stat(badge, name.encode("ascii", "ignore"))
+        result = cache.get(badge.serial, name, stat)
+        if result is not None:
+            with open(args.target, "wb") as f:
+                f.write(result)
+            print("File unchanged, copied from the cache")
+            return 0
+    result = badge.fs_read_file(name.encode("ascii", "ignore"))
+    if not result:
+        print("Failed to download file")
+        return 1
+    with open(args.target, "wb") as f:
+        f.write(result)
+        f.truncate(len(result))
+    if cache is not None:
+        cache.put(badge.serial, name, stat, result)
+        cache.save()
+    print("File downloaded succesfully")
+    return 0
+
+def filesystem_remove_arguments(parser):
+    parser.add_argument("name", help="Name of file or directory to be removed")
+
+def filesystem_remove(args):
+    name = check_path(args.name)
+    badge = connect()
+    if not badge.fs_remove(name.encode('ascii', "ignore")):
+        print("Failed to remove")
+        return 1
+    print("Removed")
+    return 0
+
+def filesystem_create_directory_arguments(parser):
+    parser.add_argument("name", help="directory name")
+
+def filesystem_create_directory(args):
+    name = check_path(args.name)
+    badge = connect()
+    if not badge.fs_create_directory(name.encode('ascii', "ignore")):
+        print("Failed to create directory")
+        return 1
+    print("Directory created")
+    return 0
+
+def filesystem_exists_arguments(parser):
+    parser.add_argument("name", help="Name of file")
+
+def filesystem_exists(args):
+    name = check_path(args.name)
+    badge = connect()
+    if not badge.fs_file_exists(name.encode('ascii', "ignore")):
+        print("File does not exist")
+        return 1
+    print("File exists")
+    return 0
+
+# Configuration management
+
+def configuration_list_arguments(parser):
+    parser.add_argument("namespace", help="Namespace", nargs='?', default=None)
+
+def configuration_list(args):
+    badge = connect()
+    print("\x1b[4m{: <32}\x1b[0m \x1b[4m{: <32}\x1b[0m \x1b[4m{: <8}\x1b[0m \x1b[4m{: <10}\x1b[0m \x1b[4m{: <32}\x1b[0m".format("Namespace", "Key", "Type", "Size", "Value"))
+    badge.printGarbage = True
+    if args.namespace:
+        entries = badge.nvs_list(args.namespace)
+    else:
+        entries = badge.nvs_list()
+
+    if not entries:
+        print("Failed to read data")
+        return 0
+    for namespace in entries:
+        for entry in entries[namespace]:
+            value = "(skipped)"
+            if entry["size"] < 64 and badge.nvs_should_read(entry["type"]):
+                value = str(badge.nvs_read(namespace, entry["key"], entry["type"]))
+            print("{: <32} {: <32} {: <8} {:10d} {}".format(namespace, entry["key"], badge.nvs_type_to_name(entry["type"]), entry["size"], value))
+    return 0
+
+def configuration_read_arguments(parser):
+    parser.add_argument("namespace", help="Namespace")
+    parser.add_argument("key", help="Key")
+    parser.add_argument("type", help="Type, one of u8, i8, u16, i16, u32, i32, u64, i64, string or blob")
+
+def configuration_read(args):
+    badge = connect(False)
+    type_name = args.type.lower()
+    type_number = badge.nvs_name_to_type(type_name)
+    if not badge.begin():
+        print("Failed to connect")
+        return 1
+
+    value = badge.nvs_read(args.namespace, args.key, type_number)
+
+    if type_name == "blob":
+        sys.stdout.buffer.write(value)
+    else:
+        print(value)
+    return 0
+
+def configuration_write_arguments(parser):
+    parser.add_argument("namespace", help="Namespace")
+    parser.add_argument("key", help="Key")
+    parser.add_argument("type", help="Type, one of u8, i8, u16, i16, u32, i32, u64, i64, string or blob")
+    parser.add_argument("value", help="Value, optional. If no value is provided the application will read from stdin", nargs='?', default=None)
+
+def configuration_write(args):
+    value = args.value
+    if not value:
+        value = sys.stdin.buffer.read()
+
+    badge = connect(False)
+    type_name = args.type.lower()
+    type_number = badge.nvs_name_to_type(type_name)
+
+    if type_name in ["u8", "i8", "u16", "i16", "u32", "i32", "u64", "i64"]:
+        value = int(value)
+
+    if not badge.begin():
+        print("Failed to connect")
+        return 1
+
+    if not badge.nvs_write(args.namespace, args.key, type_number, value):
+        print("Failed to store value")
+        return 1
+    print("Value stored")
+    return 0
+
+def configuration_remove_arguments(parser):
+    parser.add_argument("namespace", help="Namespace")
+    parser.add_argument("key", help="Key")
+
+def configuration_remove(args):
+    badge = connect()
+    if not badge.nvs_remove(args.namespace, args.key):
+        print("Failed to remove entry")
+        return 1
+    print("Entry removed")
+    return 0
+
+# Other
+
+def information_arguments(parser):
+    pass
+
+def information(args):
+    badge = connect()
+
+    try:
+        info = badge.info().split(" ")
+        print("Device name:             {}".format(info[0]))
+        print("Firmware version:        {}".format(info[1]))
+    except:
+        pass
+
+    result = badge.fs_state()
+
+    internal_size = result["internal"]["size"]
+    internal_free = result["internal"]["free"]
+    sdcard_size = result["sd"]["size"]
+    sdcard_free = result["sd"]["free"]
+    appfs_size = result["app"]["size"]
+    appfs_free = result["app"]["free"]
+
+    badge.printProgressBar(appfs_size - appfs_free,       appfs_size,    'Internal APP filesystem: {: <32}'.format('{} of {} KB used'.format(int((appfs_size-appfs_free) / 1024), int(appfs_size / 1024))), '', 0, printEnd="\r\n")
+    badge.printProgressBar(internal_size - internal_free, internal_size, 'Internal FAT filesystem: {: <32}'.format('{} of {} KB used'.format(int((internal_size-internal_free) / 1024), int(internal_size / 1024))), '', 0, printEnd="\r\n")
+    if sdcard_size > 0:
+        badge.printProgressBar(sdcard_size - sdcard_free,     sdcard_size,   'SD card  FAT filesystem: {: <32}'.format('{} of {} KB used'.format(int((sdcard_size-sdcard_free) / 1024), int(sdcard_size / 1024))), '', 0, printEnd="\r\n")
+    return 0
+
+def exit_arguments(parser):
+    pass
+
+def exit(args):
+    badge = connect(False)
+    badge.reset()
+    return 0
+
+def batch_arguments(parser):
+    parser.add_argument("file", nargs="?", default="-", help="File with one operation per line, stdin by default")
+    parser.add_argument("--stop-on-error", action="store_true", help="Skip the remaining operations after a failure")
+
+def batch(args):
+    import contextlib
+    from badge_batch import Batch, parse
+    if args.file == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.file, "r") as f:
+            lines = f.readlines()
+    operations = parse(lines)
+    output = sys.stdout
+    # Only the status of the operations is written to stdout, messages go to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        badge = connect(progress=False)
+        success = Batch(badge, output, args.stop_on_error).run(operations)
+    return 0 if success else 1
+
+def backup_arguments(parser):
+    parser.add_argument("directory", help="Backup store, shared by all badges backed up to it")
+    parser.add_argument("--label", help="Name of the badge in the store, the USB serial number of the badge by default. Only the previous snapshot with the same label, of the same badge, is used to skip unchanged data")
+
+def backup(args):
+    from badge_backup import Backup
+    from webusb_store import ChunkStore
+    store = ChunkStore(args.directory)
+    badge = connect()
+    backup = Backup(badge, store, args.label)
+    if backup.backup() is None:
+        return 1
+    return 0 if backup.failed == 0 else 1
+
+def restore_arguments(parser):
+    parser.add_argument("directory", help="Backup store")
+    parser.add_argument("snapshot", nargs="?", help="Name of the snapshot, the latest snapshot by default")
+    parser.add_argument("--label", help="Name of the badge in the store, the USB serial number of the connected badge by default")
+    parser.add_argument("--list", action="store_true", help="List the snapshots in the store instead")
+    parser.add_argument("--no-files", action="store_true", help="Don't restore the FAT filesystems")
+    parser.add_argument("--no-apps", action="store_true", help="Don't restore the apps")
+    parser.add_argument("--no-nvs", action="store_true", help="Don't restore the NVS entries")
+
+def restore(args):
+    from badge_backup import Restore, default_label
+    from webusb_store import ChunkStore
+    from datetime import datetime
+    store = ChunkStore(args.directory)
+    if args.list:
+        print("\x1b[4m{: <24}\x1b[0m \x1b[4m{: <20}\x1b[0m \x1b[4m{: <19}\x1b[0m \x1b[4m{: <8}\x1b[0m \x1b[4m{: <6}\x1b[0m \x1b[4m{: <6}\x1b[0m \x1b[4m{: <8}\x1b[0m".format("Label", "Snapshot", "Created", "Files", "Apps", "NVS", "Complete"))
+        for label in store.labels():
+            for name in store.snapshots(label):
+                snapshot = store.load_snapshot(label, name)
+                if snapshot is None:
+                    continue
+                files = len([entry for entry in snapshot["files"] if entry["type"] == "file"])
+                created = datetime.fromtimestamp(snapshot["created"]).strftime('%Y-%m-%d %H:%M:%S')
+                print("{: <24} {: <20} {: <19} {: <8} {: <6} {: <6} {: <8}".format(label, name, created, files, len(snapshot["apps"]), len(snapshot["nvs"]), "yes" if snapshot["complete"] else "no"))
+        return 0
+    badge = connect()
+    snapshot = store.load_snapshot(args.label or default_label(badge), args.snapshot)
+    if snapshot is None:
+        print("Snapshot not found")
+        return 1
+    if not Restore(badge, store, snapshot).restore(not args.no_files, not args.no_apps, not args.no_nvs):
+        print("Restore incomplete")
+        return 1
+    print("Restore finished")
+    return 0
+
+def queue_arguments(parser):
+    parser.add_argument("--queue", default=os.environ.get("BADGE_QUEUE"), metavar="FILE", help="Queue file, ~/.local/share/mch2022-tools/queue.json by default")
+    actions = parser.add_subparsers(dest="action", metavar="action")
+    actions.required = True
+    push = actions.add_parser("push", help="Queue pushing a local file or directory")
+    push.add_argument("name", help="Local file or directory")
+    push.add_argument("target", help="Remote file or directory")
+    pull = actions.add_parser("pull", help="Queue pulling a remote file or directory")
+    pull.add_argument("name", help="Remote file or directory")
+    pull.add_argument("target", help="Local file or directory")
+    pull.add_argument("--recursive", "-r", "-R", action="store_true", help="Download the directory name and everything in it")
+    app = actions.add_parser("app", help="Queue installing an app")
+    app.add_argument("file", help="Application binary")
+    app.add_argument("name", help="Name of the app")
+    app.add_argument("title", help="Title of the app")
+    app.add_argument("version", type=int, help="Version of the app")
+    for action in [push, pull, app]:
+        action.add_argument("--serial", help="Only run the job on the badge with this USB serial number, by default the job is bound to the badge it starts on")
+    actions.add_parser("list", help="List the jobs in the queue")
+    run = actions.add_parser("run", help="Run the queued jobs, waiting for their badges to be connected")
+    run.add_argument("--follow", action="store_true", help="Keep running and wait for new jobs once the queue is empty")
+    actions.add_parser("retry", help="Queue the failed jobs again")
+    clear = actions.add_parser("clear", help="Remove finished jobs from the queue")
+    clear.add_argument("--all", action="store_true", help="Remove all jobs, including queued and interrupted jobs")
+
+def queue(args):
+    from badge_queue import TransferQueue, QueueRunner, push_job, pull_job, app_job
+    transfers = TransferQueue(args.queue)
+    if args.action == "push":
+        if not os.path.exists(args.name):
+            print("File {} not found".format(args.name))
+            return 1
+        job = push_job(args.name, check_path(args.target), args.serial)
+    elif args.action == "pull":
+        job = pull_job(check_path(args.name), args.target, args.recursive, args.serial)
+    elif args.action == "app":
+        if not os.path.isfile(args.file):
+            print("File {} not found".format(args.file))
+            return 1
+        job = app_job(args.file, args.name, args.title, args.version, args.serial)
+    elif args.action == "list":
+        print("\x1b[4m{: <5}\x1b[0m \x1b[4m{: <11}\x1b[0m \x1b[4m{: <20}\x1b[0m \x1b[4m{: <5}\x1b[0m \x1b[4m{: <11}\x1b[0m \x1b[4m{: <40}\x1b[0m".format("Id", "State", "Badge", "Type", "Files done", "Source"))
+        for job in transfers.jobs:
+            files = "-" if job["files"] is None else "{}/{}".format(len([item for item in job["files"] if item["done"]]), len(job["files"]))
+            print("{: <5} {: <11} {: <20} {: <5} {: <11} {}".format(job["id"], job["state"], job["serial"] or "any", job["type"], files, job["source"]))
+        return 0
+    elif args.action == "run":
+        from webusb import TerminalProgress
+        return 0 if QueueRunner(transfers, progress=TerminalProgress()).run(args.follow) else 1
+    elif args.action == "retry":
+        print("Queued {} failed jobs again".format(transfers.retry()))
+        return 0
+    else:
+        states = ["done", "failed"] + (["queued", "running", "interrupted"] if args.all else [])
+        print("Removed {} jobs".format(transfers.remove(states)))
+        return 0
+    print("Queued job {}".format(transfers.add(job)))
+    return 0
+
+def shell_arguments(parser):
+    pass
+
+def shell(args):
+    from badge_shell import BadgeShell
+    badge = connect()
+    # Long running, the session is picked up again when the badge is unplugged or reset
+    badge.watch()
+    BadgeShell(badge).cmdloop()
+    return 0
+
+def gateway_arguments(parser):
+    parser.add_argument("--port", type=int, default=8022, help="Port to listen on, only on localhost")
+
+def gateway(args):
+    from badge_gateway import Gateway
+    badge = connect(progress=False)
+    badge.watch()
+    server = Gateway(badge, args.port)
+    print("Serving the badge on http://127.0.0.1:{}/".format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+def fpga_arguments(parser):
+    parser.add_argument("bitstream", help="Bitstream binary")
+    parser.add_argument("bindings", nargs="*", help="Data files/bindings")
+
+def fpga(args):
+    import runpy
+    sys.argv = ["fpga.py", args.bitstream] + args.bindings
+    runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fpga.py"), run_name="__main__")
+    return 0
+
+COMMANDS = {
+    "app_list":                    'MCH2022 badge application list tool',
+    "app_push":                    'MCH2022 badge app upload tool',
+    "app_install":                 'MCH2022 badge tool installing a set of apps',
+    "app_pull":                    'MCH2022 badge app download tool',
+    "app_export":                  'MCH2022 badge tool exporting all apps with a manifest for app_install',
+    "app_remove":                  'MCH2022 badge app removal tool',
+    "app_run":                     'MCH2022 badge app run tool',
+    "filesystem_list":             'MCH2022 badge FAT filesystem directory list tool',
+    "filesystem_push":             'MCH2022 badge FAT filesystem file upload tool',
+    "filesystem_pull":             'MCH2022 badge FAT filesystem file download tool',
+    "filesystem_remove":           'MCH2022 badge FAT filesystem file removal tool',
+    "filesystem_create_directory": 'MCH2022 badge FAT filesystem directory creation tool',
+    "filesystem_exists":           'MCH2022 badge FAT filesystem file exists check tool',
+    "configuration_list":          'MCH2022 badge NVS list tool',
+    "configuration_read":          'MCH2022 badge NVS read tool',
+    "configuration_write":         'MCH2022 badge NVS write tool',
+    "configuration_remove":        'MCH2022 badge NVS remove tool',
+    "information":                 'MCH2022 badge filesystem info tool',
+    "exit":                        'MCH2022 badge reboot tool, exits webusb mode',
+    "shell":                       'MCH2022 badge interactive shell',
+    "gateway":                     'MCH2022 badge HTTP and WebDAV gateway',
+    "batch":                       'MCH2022 badge batch tool, runs a list of operations over one connection',
+    "backup":                      'MCH2022 badge incremental backup tool',
+    "restore":                     'MCH2022 badge backup restore tool',
+    "queue":                       'MCH2022 badge transfer queue, resumes transfers when a badge is plugged in again',
+    "fpga":                        'MCH2022 badge FPGA bit stream loading tool',
+}
+
+def usage():
+    print("Usage: badge.py {command} [arguments]")
+    print()
+    print("Commands:")
+    for name, description in COMMANDS.items():
+        print("  {: <28} {}".format(name, description))
+
+def run(command, argv, prog = None):
+    """
+    Parses argv for command and runs it, returns the exit code
+    """
+    import argparse
+    import webusb_trace
+    parser = argparse.ArgumentParser(prog=prog, description=COMMANDS[command])
+    globals()[command + "_arguments"](parser)
+    webusb_trace.add_arguments(parser)
+    args = parser.parse_args(argv)
+    webusb_trace.enable(args.trace, args.profile)
+    return globals()[command](args)
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) < 1 or argv[0] in ["-h", "--help", "help"]:
+        usage()
+        return 0
+    command = argv[0].replace("-", "_")
+    if command.endswith(".py"):
+        command = command[:-3]
+    if command not in COMMANDS:
+        print("Unknown command {}".format(argv[0]))
+        usage()
+        return 1
+    return run(command, argv[1:], "badge.py " + command)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+# Incremental backups of the FAT filesystems, the AppFS and the NVS of a badge
+#
+# Backups are stored in a ChunkStore (see webusb_store.py). Every backup
+# creates a snapshot listing the files and directories of /internal and /sd,
+# the apps and the NVS entries together with the digests of their content.
+# Files whose size and modification time in the FSLS listing and apps whose
+# title, version and size in the app list match the previous snapshot with
+# the same label are not downloaded again, their chunks are reused. The label
+# is the USB serial number of the badge by default, and nothing is reused
+# from a snapshot of a badge with another serial number: badges flashed from
+# the same image or without a set clock easily have files with the same path,
+# size and modification time but different content. Of the
+# data that is downloaded only chunks that aren't in the store yet are
+# written, so a store shared by a fleet of badges holds common files once.
+#
+# The NVS entries are small and are always read, the raw values are stored so
+# they are written back exactly as they were read.
+
+import struct
+import sys
+import time
+
+SNAPSHOT_VERSION = 1
+STREAM_LIMIT = 256 * 1024 # Files larger than this are restored one by one, streamed from the store
+
+def default_label(badge):
+    return badge.serial or "badge"
+
+class Backup:
+    def __init__(self, badge, store, label = None):
+        self.badge = badge
+        self.store = store
+        self.label = label or default_label(badge)
+        self.downloaded = 0
+        self.reused = 0
+        self.failed = 0
+
+    def reusable(self, previous, entry, keys):
+        """
+        Returns the chunks of the previous version of entry if it is unchanged and all of its chunks are still stored
+        """
+        if previous is None:
+            return None
+        for key in keys:
+            if previous.get(key) != entry[key]:
+                return None
+        if self.store.missing(previous["chunks"]):
+            return None
+        return previous["chunks"]
+
+    def backup_files(self, root, base, output):
+        tree = self.badge.fs_list_tree(root.encode("ascii"))
+        if tree is None:
+            return False
+        previous = {entry["path"]: entry for entry in base}
+        pending = []
+        for (path, item) in tree:
+            stat = item["stat"] or {"size": 0, "modified": 0}
+            entry = {"path": path.decode("ascii", "ignore"), "type": "directory" if item["type"] == 2 else "file", "size": stat["size"], "modified": stat["modified"]}
+            if entry["type"] == "directory":
+                output.append(entry)
+                continue
+            chunks = None
+            if stat["modified"] > 0:
+                chunks = self.reusable(previous.get(entry["path"]), entry, ["size", "modified"])
+            if chunks is not None:
+                entry["chunks"] = chunks
+                output.append(entry)
+                self.reused += 1
+            else:
+                pending.append((path, entry))
+
+        def received(index, data):
+            (path, entry) = pending[index]
+            if data is False:
+                print("Failed to download {}".format(entry["path"]))
+                self.failed += 1
+                return
+            if len(data) != entry["size"]:
+                # Changed after it was listed, the stored stat doesn't describe this content
+                entry["size"] = len(data)
+                entry["modified"] = 0
+            entry["chunks"] = self.store.put(data)
+            output.append(entry)
+            self.downloaded += 1
+            print("Stored {}".format(entry["path"]))
+
+        self.badge.fs_read_files([(path, entry["size"] if entry["modified"] else -1) for (path, entry) in pending], received)
+        return True
+
+    def backup_apps(self, base, output):
+        applist = self.badge.app_list()
+        if applist is None:
+            print("Failed to load application list")
+            self.failed += 1
+            return
+        previous = {entry["name"]: entry for entry in base}
+        for app in applist:
+            entry = {"name": app["name"].decode("ascii", "ignore"), "title": app["title"].decode("ascii", "ignore"), "version": app["version"], "size": app["size"]}
+            chunks = self.reusable(previous.get(entry["name"]), entry, ["title", "version", "size"])
+            if chunks is not None:
+                entry["chunks"] = chunks
+                entry["length"] = previous[entry["name"]]["length"]
+                output.append(entry)
+                self.reused += 1
+                continue
+            stream = self.badge.app_read_stream(app["name"])
+            if stream is False:
+                print("Failed to download app {}".format(entry["name"]))
+                self.failed += 1
+                continue
+            try:
+                (entry["chunks"], entry["length"]) = self.store.put_stream(stream)
+            except IOError as e:
+                print("Failed to download app {}: {}".format(entry["name"], e))
+                self.failed += 1
+                continue
+            output.append(entry)
+            self.downloaded += 1
+            print("Stored app {}".format(entry["name"]))
+
+    def backup_nvs(self, output):
+        entries = self.badge.nvs_list()
+        if entries is None:
+            print("Failed to read NVS entries")
+            self.failed += 1
+            return
+        readable = []
+        for namespace in entries:
+            for entry in entries[namespace]:
+                if self.badge.nvs_type_to_name(entry["type"]) == str(entry["type"]):
+                    print("Skipped NVS entry {} {} of unknown type {}".format(namespace, entry["key"], entry["type"]))
+                    continue
+                readable.append({"namespace": namespace, "key": entry["key"], "type": entry["type"]})
+        # All entries are read back-to-back, the values are small
+        responses = self.badge.pipeline([(b"NVSR", self.badge.nvs_key(entry["namespace"], entry["key"]) + struct.pack("<B", entry["type"]), 100) for entry in readable])
+        for entry, response in zip(readable, responses):
+            payload = self.badge.response_payload(b"NVSR", response)
+            if payload is None:
+                print("Failed to read NVS entry {} {}".format(entry["namespace"], entry["key"]))
+                self.failed += 1
+                continue
+            entry["value"] = payload.hex()
+            output.append(entry)
+
+    def backup(self):
+        """
+        Stores a snapshot of the badge, returns its name or None if nothing could be stored
+        """
+        start = time.monotonic()
+        base = self.store.load_snapshot(self.label)
+        if base is not None and base.get("serial") != self.badge.serial:
+            print("The previous snapshot of {} is of another badge, downloading everything".format(self.label))
+            base = None
+        base = base or {"files": [], "apps": [], "nvs": []}
+        snapshot = {"version": SNAPSHOT_VERSION, "created": int(time.time()), "serial": self.badge.serial, "files": [], "apps": [], "nvs": []}
+        if not self.backup_files("/internal", base["files"], snapshot["files"]):
+            print("Failed to list /internal")
+            return None
+        if not self.backup_files("/sd", base["files"], snapshot["files"]):
+            print("No SD card found")
+        self.backup_apps(base["apps"], snapshot["apps"])
+        self.backup_nvs(snapshot["nvs"])
+        snapshot["complete"] = self.failed == 0
+        name = self.store.save_snapshot(self.label, snapshot)
+        print("Snapshot {} of {} stored in {:.1f} seconds: {} downloaded, {} unchanged, {} failed, {} new chunks ({} bytes)".format(
+            name, self.label, time.monotonic() - start, self.downloaded, self.reused, self.failed, self.store.new_chunks, self.store.new_bytes))
+        return name
+
+class Restore:
+    def __init__(self, badge, store, snapshot):
+        self.badge = badge
+        self.store = store
+        self.snapshot = snapshot
+        self.failed = 0
+        self.damaged = False # Set when the content of the last streamed entry couldn't be read from the store
+
+    def check(self, entries, description):
+        """
+        Returns the entries of which all chunks are stored
+        """
+        output = []
+        for entry in entries:
+            if self.store.missing(entry["chunks"]):
+                print("Content of {} is missing from the store".format(description(entry)))
+                self.failed += 1
+            else:
+                output.append(entry)
+        return output
+
+    def restore_files(self):
+        directories = [entry["path"].encode("ascii") for entry in self.snapshot["files"] if entry["type"] == "directory"]
+        files = self.check([entry for entry in self.snapshot["files"] if entry["type"] == "file"], lambda entry: entry["path"])
+        small = [entry for entry in files if entry["size"] <= STREAM_LIMIT]
+
+        def written(index, success):
+            if success:
+                print("Restored {}".format(small[index]["path"]))
+            else:
+                print("Failed to restore {}".format(small[index]["path"]))
+                self.failed += 1
+
+        self.badge.fs_write_files([(entry["path"].encode("ascii"), self.store.get(entry["chunks"])) for entry in small], directories, written)
+        for entry in files:
+            if entry["size"] <= STREAM_LIMIT:
+                continue
+            if not self.badge.fs_write_stream(entry["path"].encode("ascii"), self.stream(entry), entry["size"]) or self.damaged:
+                print("Failed to restore {}".format(entry["path"]))
+                self.failed += 1
+                continue
+            print("Restored {}".format(entry["path"]))
+
+    def stream(self, entry):
+        self.damaged = False
+        try:
+            for chunk in self.store.stream(entry["chunks"]):
+                yield chunk
+        except IOError as e:
+            # Ends the stream early, what has been written so far stays on the badge
+            print(e)
+            self.damaged = True
+
+    def restore_apps(self):
+        for entry in self.check(self.snapshot["apps"], lambda entry: "app " + entry["name"]):
+            if not self.badge.app_write_stream(entry["name"].encode("ascii"), entry["title"].encode("ascii"), entry["version"], entry["length"], self.stream(entry)) or self.damaged:
+                print("Failed to restore app {}".format(entry["name"]))
+                self.failed += 1
+                continue
+            print("Restored app {}".format(entry["name"]))
+
+    def restore_nvs(self):
+        entries = self.snapshot["nvs"]
+        responses = self.badge.pipeline([(b"NVSW", self.badge.nvs_key(entry["namespace"], entry["key"]) + struct.pack("<B", entry["type"]) + bytes.fromhex(entry["value"]), 100) for entry in entries])
+        for entry, response in zip(entries, responses):
+            payload = self.badge.response_payload(b"NVSW", response)
+            if payload is None or len(payload) < 1 or payload[0] == 0:
+                print("Failed to restore NVS entry {} {}".format(entry["namespace"], entry["key"]))
+                self.failed += 1
+        print("Restored {} NVS entries".format(len(entries)))
+
+    def restore(self, files = True, apps = True, nvs = True):
+        """
+        Writes the content of the snapshot to the badge, returns True if everything was restored
+        """
+        if files:
+            self.restore_files()
+        if apps:
+            self.restore_apps()
+        if nvs:
+            self.restore_nvs()
+        return self.failed == 0
+
+if __name__ == "__main__":
+    from badge import run
+    sys.exit(run("backup", sys.argv[1:]))
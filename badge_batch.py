@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+# Batch execution of badge operations over a single connection
+#
+# Reads one operation per line from a file (or stdin) and runs all of them
+# over one Badge, so a deployment of many steps connects to the badge only
+# once. Consecutive small operations (mkdir, rm, exists, app-remove and the
+# NVS operations) are pipelined: their requests are sent without waiting for
+# the responses to the previous ones. File transfers and app-run are run one
+# at a time, in order, in between.
+#
+# Lines are split like a shell would, # starts a comment:
+#
+#     mkdir /internal/apps/python/demo
+#     push main.py /internal/apps/python/demo/__init__.py
+#     pull /internal/apps/python/demo/__init__.py copy.py
+#     rm /internal/old.py
+#     exists /internal/apps/python/demo/__init__.py
+#     app-install main.bin demo "Demo app" 1
+#     app-remove old_app
+#     nvs-write system wifi.ssid string "My network"
+#     nvs-read system wifi.ssid string
+#     nvs-remove system wifi.ssid
+#     app-run demo
+#
+# app-run reboots the badge into the app, which ends the WebUSB session, so it
+# has to be the last operation: operations after it are rejected as invalid
+# when the batch is parsed and nothing after it is run.
+#
+# Blobs are given and returned as hexadecimal strings. For every operation a
+# JSON object is written to stdout, one per line, with the line number, the
+# operation, its arguments, the status ("ok", "failed", "invalid" or
+# "skipped"), the result (for exists and nvs-read) or an error message and
+# the duration in seconds (of the whole group for pipelined operations).
+
+import json
+import shlex
+import struct
+import sys
+import time
+
+INTEGER_TYPES = ["u8", "i8", "u16", "i16", "u32", "i32", "u64", "i64"]
+
+# Name: (number of arguments, pipelined)
+OPERATIONS = {
+    "push":        ((2, 2), False),
+    "pull":        ((2, 2), False),
+    "mkdir":       ((1, 1), True),
+    "rm":          ((1, 1), True),
+    "exists":      ((1, 1), True),
+    "app-install": ((4, 4), False),
+    "app-run":     ((1, 2), False),
+    "app-remove":  ((1, 1), True),
+    "nvs-read":    ((3, 3), True),
+    "nvs-write":   ((4, 4), True),
+    "nvs-remove":  ((2, 2), True),
+}
+
+class InvalidOperation(Exception):
+    pass
+
+def parse(lines):
+    """
+    Parses the lines of a batch file, returns a list of operations
+    """
+    operations = []
+    running = None # Line of the app-run operation, the badge runs the app after it
+    for number, line in enumerate(lines, 1):
+        operation = {"line": number, "operation": None, "arguments": []}
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError as e:
+            operation["error"] = str(e)
+            operations.append(operation)
+            continue
+        if len(words) < 1:
+            continue
+        operation["operation"] = words[0]
+        operation["arguments"] = words[1:]
+        if words[0] not in OPERATIONS:
+            operation["error"] = "Unknown operation"
+        else:
+            (minimum, maximum) = OPERATIONS[words[0]][0]
+            if not minimum <= len(words) - 1 <= maximum:
+                operation["error"] = "Expected {} arguments".format(minimum if minimum == maximum else "{} to {}".format(minimum, maximum))
+        if running is not None and "error" not in operation:
+            operation["error"] = "Not possible after app-run on line {}, the badge has left WebUSB mode".format(running)
+        if words[0] == "app-run" and "error" not in operation:
+            running = number
+        operations.append(operation)
+    return operations
+
+def remote_path(name):
+    if not (name.startswith("/internal") or name.startswith("/sd")):
+        raise InvalidOperation("Path should always start with /internal or /sd")
+    if name.endswith("/"):
+        name = name[:-1]
+    return name.encode("ascii", "ignore")
+
+def nvs_value(badge, type_name, value):
+    type_number = nvs_type(badge, type_name)
+    try:
+        if type_name in INTEGER_TYPES:
+            return type_number, int(value, 0)
+        if type_name == "blob":
+            return type_number, bytes.fromhex(value)
+    except ValueError:
+        raise InvalidOperation("Invalid value for type {}".format(type_name))
+    return type_number, value
+
+def nvs_key(badge, namespace, key):
+    try:
+        return badge.nvs_key(namespace, key)
+    except struct.error:
+        raise InvalidOperation("Namespace and key can be at most 255 bytes long")
+
+def nvs_type(badge, type_name):
+    try:
+        return badge.nvs_name_to_type(type_name.lower())
+    except ValueError:
+        raise InvalidOperation("Invalid type name")
+
+def json_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return value
+
+class Batch:
+    def __init__(self, badge, output = None, stop_on_error = False):
+        self.badge = badge
+        self.output = output if output is not None else sys.stdout
+        self.stop_on_error = stop_on_error
+        self.failed = False
+
+    def report(self, operation, status, start, result = None, error = None):
+        entry = {
+            "line": operation["line"],
+            "operation": operation["operation"],
+            "arguments": operation["arguments"],
+            "status": status,
+        }
+        if result is not None:
+            entry["result"] = json_value(result)
+        if error is not None:
+            entry["error"] = error
+        entry["duration"] = round(time.monotonic() - start, 6)
+        self.output.write(json.dumps(entry) + "\n")
+        self.output.flush()
+        if status != "ok":
+            self.failed = True
+
+    # Pipelined operations, request returns (command, payload, timeout), response returns (success, result)
+
+    def request(self, operation):
+        badge = self.badge
+        name = operation["operation"]
+        arguments = operation["arguments"]
+        if name == "mkdir":
+            return (b"FSMD", remote_path(arguments[0]), 100)
+        if name == "rm":
+            return (b"FSRM", remote_path(arguments[0]), 10000)
+        if name == "exists":
+            return (b"FSEX", remote_path(arguments[0]), 100)
+        if name == "app-remove":
+            return (b"APPD", arguments[0].encode("ascii", "ignore"), 10000)
+        if name == "nvs-read":
+            return (b"NVSR", nvs_key(badge, arguments[0], arguments[1]) + struct.pack("<B", nvs_type(badge, arguments[2])), 100)
+        if name == "nvs-write":
+            (type_number, value) = nvs_value(badge, arguments[2].lower(), arguments[3])
+            try:
+                value = badge.nvs_encode(type_number, value)
+            except struct.error as e:
+                raise InvalidOperation(str(e))
+            return (b"NVSW", nvs_key(badge, arguments[0], arguments[1]) + struct.pack("<B", type_number) + value, 100)
+        if name == "nvs-remove":
+            return (b"NVSD", nvs_key(badge, arguments[0], arguments[1]), 100)
+
+    def response(self, operation, command, response):
+        badge = self.badge
+        name = operation["operation"]
+        if name == "exists":
+            # A missing file is a valid answer, not a failure
+            payload = badge.response_payload(command, response)
+            if payload is None or len(payload) != 1:
+                return (False, None)
+            return (True, payload[0] != 0)
+        if name == "nvs-read":
+            payload = badge.response_payload(command, response)
+            if payload is None:
+                return (False, None)
+            try:
+                return (True, badge.nvs_decode(nvs_type(badge, operation["arguments"][2]), payload))
+            except struct.error:
+                return (False, None) # The badge returns no data for missing keys
+        if name in ["nvs-write", "nvs-remove"]:
+            payload = badge.response_payload(command, response)
+            return (payload is not None and len(payload) > 0 and payload[0] != 0, None)
+        return (badge.response_bool(command, response), None)
+
+    def run_pipelined(self, operations):
+        start = time.monotonic()
+        requests = []
+        for operation in operations:
+            try:
+                requests.append((operation, self.request(operation)))
+            except InvalidOperation as e:
+                self.report(operation, "invalid", start, error=str(e))
+        if len(requests) < 1:
+            return
+        responses = self.badge.pipeline([request for (operation, request) in requests])
+        for (operation, request), response in zip(requests, responses):
+            (success, result) = self.response(operation, request[0], response)
+            self.report(operation, "ok" if success else "failed", start, result)
+
+    # Sequential operations
+
+    def run_single(self, operation):
+        badge = self.badge
+        name = operation["operation"]
+        arguments = operation["arguments"]
+        start = time.monotonic()
+        try:
+            if name == "push":
+                target = remote_path(arguments[1])
+                try:
+                    f = open(arguments[0], "rb")
+                except OSError as e:
+                    raise InvalidOperation(str(e))
+                with f:
+                    success = badge.fs_write_file(target, f)
+            elif name == "pull":
+                data = badge.fs_read_file(remote_path(arguments[0]))
+                success = data is not False
+                if success:
+                    try:
+                        with open(arguments[1], "wb") as f:
+                            f.write(data)
+                    except OSError as e:
+                        # The remaining operations still run and get their status line
+                        self.report(operation, "failed", start, error=str(e))
+                        return
+            elif name == "app-install":
+                try:
+                    version = max(0, int(arguments[3]))
+                    f = open(arguments[0], "rb")
+                except (OSError, ValueError) as e:
+                    raise InvalidOperation(str(e))
+                with f:
+                    success = badge.app_write(arguments[1].encode("ascii", "ignore"), arguments[2].encode("ascii", "ignore"), version, f)
+            elif name == "app-run":
+                command = arguments[1].encode("ascii", "ignore") if len(arguments) > 1 else None
+                success = badge.app_run(arguments[0].encode("ascii", "ignore"), command)
+                if success:
+                    badge.reset(False)
+        except InvalidOperation as e:
+            self.report(operation, "invalid", start, error=str(e))
+            return
+        self.report(operation, "ok" if success else "failed", start)
+
+    def run(self, operations):
+        """
+        Runs the operations in order, returns True if all of them succeeded
+        """
+        index = 0
+        while index < len(operations):
+            operation = operations[index]
+            if "error" in operation:
+                self.report(operation, "invalid", time.monotonic(), error=operation["error"])
+                index += 1
+            elif OPERATIONS[operation["operation"]][1]:
+                end = index
+                while end < len(operations) and "error" not in operations[end] and OPERATIONS[operations[end]["operation"]][1]:
+                    end += 1
+                self.run_pipelined(operations[index:end])
+                index = end
+            else:
+                self.run_single(operation)
+                index += 1
+            if self.failed and self.stop_on_error:
+                for skipped in operations[index:]:
+                    self.report(skipped, "skipped", time.monotonic())
+                return False
+        return not self.failed
+
+if __name__ == "__main__":
+    from badge import run
+    sys.exit(run("batch", sys.argv[1:]))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+from webusb import *
+import argparse
+import json
+import platform
+import socket
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='MCH2022 badge USB link benchmark tool')
+parser.add_argument("--pings", type=int, default=200, help="Number of tiny PING packets used for measuring latency")
+parser.add_argument("--duration", type=float, default=2.0, help="Seconds spent measuring throughput for every payload size")
+parser.add_argument("--max-size", type=int, default=65536, help="Largest payload size to try, in bytes")
+parser.add_argument("--label", default="", help="Free-form description of the setup (host, cable, hub)")
+parser.add_argument("--output", "-o", default="badge_bench.json", help="File to store the results in as JSON")
+args = parser.parse_args()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def round_trip(payload, timeout = 1.0):
+    """
+    Sends a PING and reads its response, returns the seconds until the first bytes of the response arrived or None
+    Badge.ping waits until the link has been idle for a while before it returns, which would be measured too
+    """
+    badge.rx_data = bytes([])
+    badge.packets = []
+    badge.pending = []
+    expected = 20 + len(payload)
+    received = bytearray()
+    first = None
+    start = time.perf_counter()
+    badge.send_packet(b"PING", payload, False)
+    while len(received) < expected:
+        try:
+            data = bytes(badge.esp32_ep_in.read(badge.esp32_ep_in.wMaxPacketSize, 5))
+        except Exception as e:
+            if device_gone(e):
+                raise BadgeDisconnected("Badge disconnected") from e
+            data = b""
+        now = time.perf_counter()
+        if len(data) > 0 and first is None:
+            first = now - start
+        received += data
+        if now - start > timeout:
+            break
+    badge.rx_data = bytes(received)
+    if not badge.check_ping(payload, badge.receive_packet(0)):
+        return None
+    return first
+
+def measure_latency(count):
+    latencies = []
+    failures = 0
+    for i in range(count):
+        latency = round_trip(os.urandom(8))
+        if latency is not None:
+            latencies.append(latency * 1000)
+        else:
+            failures += 1
+            badge.sync()
+    return latencies, failures
+
+def measure_throughput(size, duration):
+    count = 0
+    failures = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        if round_trip(os.urandom(size)) is not None:
+            count += 1
+        else:
+            failures += 1
+            badge.sync()
+            if count == 0 and failures >= 3:
+                break
+    elapsed = time.perf_counter() - start
+    return count, failures, elapsed
+
+def accepted(size, attempts = 3):
+    for attempt in range(attempts):
+        if round_trip(os.urandom(size)) is not None:
+            return True
+        badge.sync()
+    return False
+
+badge = Badge(progress=TerminalProgress())
+
+if not badge.begin():
+    print("Failed to connect")
+    sys.exit(1)
+
+firmware = badge.info()
+
+results = {
+    "label": args.label,
+    "host": socket.gethostname(),
+    "platform": platform.platform(),
+    "python": platform.python_version(),
+    "firmware": firmware if firmware else None,
+    "timestamp": datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+}
+
+print("Measuring round-trip latency using {} PING packets...".format(args.pings))
+badge.sync()
+crc_errors_start = badge.metrics.crc_errors
+latencies, failures = measure_latency(args.pings)
+if len(latencies) < 1:
+    print("Badge did not answer any PING packet")
+    sys.exit(1)
+
+results["latency"] = {
+    "count": len(latencies),
+    "failures": failures,
+    "min": min(latencies),
+    "p50": percentile(latencies, 0.50),
+    "p90": percentile(latencies, 0.90),
+    "p99": percentile(latencies, 0.99),
+    "max": max(latencies),
+}
+
+print("Measuring throughput...")
+throughput = []
+max_accepted = 0
+size = 64
+while size <= args.max_size:
+    count, failures, elapsed = measure_throughput(size, args.duration)
+    if count == 0:
+        break
+    max_accepted = size
+    throughput.append({
+        "size": size,
+        "count": count,
+        "failures": failures,
+        "elapsed": elapsed,
+        "bytes_per_second": size * count / elapsed,
+    })
+    size *= 2
+
+if size <= args.max_size:
+    # The largest accepted payload lies between the last size that worked and the first that didn't
+    (low, high) = (max_accepted, size)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if accepted(middle):
+            low = middle
+        else:
+            high = middle
+    max_accepted = low
+
+results["throughput"] = throughput
+results["max_payload"] = max_accepted
+
+packets = len(latencies) + sum(entry["count"] + entry["failures"] for entry in throughput)
+crc_errors = badge.metrics.crc_errors - crc_errors_start
+results["crc"] = {
+    "errors": crc_errors,
+    "packets": packets,
+    "rate": crc_errors / packets if packets > 0 else 0,
+}
+
+print()
+print("\x1b[4m{: <10}\x1b[0m \x1b[4m{: <10}\x1b[0m".format("Latency", "ms"))
+for key in ["min", "p50", "p90", "p99", "max"]:
+    print("{: <10} {: <10.3f}".format(key, results["latency"][key]))
+print()
+print("\x1b[4m{: <10}\x1b[0m \x1b[4m{: <10}\x1b[0m \x1b[4m{: <10}\x1b[0m \x1b[4m{: <12}\x1b[0m".format("Payload", "Packets", "Failures", "Throughput"))
+for entry in throughput:
+    print("{: <10} {: <10} {: <10} {: <12}".format(str(entry["size"]) + " B", entry["count"], entry["failures"], str(round(entry["bytes_per_second"] / 1024, 2)) + " KB/s"))
+print()
+print("Largest accepted payload: {} B".format(max_accepted))
+print("CRC errors:               {} of {} packets ({:.4%})".format(crc_errors, packets, results["crc"]["rate"]))
+
+with open(args.output, "w") as f:
+    json.dump(results, f, indent=4)
+print("Results stored in {}".format(args.output))
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+# HTTP and WebDAV gateway to the filesystems of the badge
+#
+# Serves /internal, /sd and the AppFS (as /apps) on localhost over a single
+# connection to the badge:
+#
+#     GET       download a file or app, directories are listed as JSON
+#     HEAD      size and modification time of a file
+#     PUT       upload a file, or install an app (title and version from
+#               the X-App-Title and X-App-Version headers or the title and
+#               version query parameters)
+#     DELETE    remove a file, directory or app
+#     MKCOL     create a directory
+#     PROPFIND  WebDAV listing (depth 0 or 1)
+#
+# Requests are handled in parallel and share the badge through a Scheduler
+# (see webusb_scheduler.py): listings, lookups, removals and directory
+# creation are run between the chunks of running transfers, so they don't
+# wait for a large upload or download to finish. Transfers run one at a time,
+# shared fairly between clients (the X-Client header, or the connection).
+# The X-Priority header sets the priority of a transfer, lower numbers first
+# (20 by default). File bodies are streamed in both directions, so transfers
+# don't need to fit in memory. Directory listings are cached for a few
+# seconds and dropped when the directory is changed through the gateway.
+
+import email.utils
+import json
+import posixpath
+import queue
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+from webusb_listing import ListingCache
+from webusb_scheduler import BULK, Scheduler, queued_chunks, read_job
+
+APPS = "/apps"
+
+def remote_path(path):
+    """
+    Returns the normalized path of a request, or None when it is outside of /internal, /sd and /apps
+    """
+    path = posixpath.normpath(urllib.parse.unquote(path)).replace("//", "/")
+    if path == "/":
+        return path
+    for root in ["/internal", "/sd", APPS]:
+        if path == root or path.startswith(root + "/"):
+            return path
+    return None
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "BadgeGateway/1.0"
+
+    @property
+    def badge(self):
+        return self.server.badge
+
+    @property
+    def cache(self):
+        return self.server.cache
+
+    @property
+    def scheduler(self):
+        return self.server.scheduler
+
+    def client(self):
+        return self.headers.get("X-Client") or "{}:{}".format(*self.client_address[:2])
+
+    def priority(self):
+        try:
+            return int(self.headers.get("X-Priority", BULK))
+        except ValueError:
+            return BULK
+
+    def send_empty(self, code, headers = {}):
+        self.send_response(code)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_body(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = remote_path(url.path)
+        if path is None:
+            self.send_empty(404)
+        return path, urllib.parse.parse_qs(url.query)
+
+    def body(self, length):
+        remaining = length
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, 8192))
+            if len(data) < 1:
+                raise IOError("Request body ended early")
+            remaining -= len(data)
+            yield data
+
+    def content_length(self):
+        if "chunked" in self.headers.get("Transfer-Encoding", ""):
+            return None
+        try:
+            return int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return None
+
+    # Lookups
+
+    def app_list(self):
+        return self.scheduler.call(lambda badge: badge.app_list())
+
+    def stat(self, path):
+        """
+        Returns the listing entry of path, None if it doesn't exist
+        """
+        if path in ["/", "/internal", "/sd", APPS]:
+            return {"type": 2, "name": posixpath.basename(path).encode("ascii"), "stat": None}
+        if path.startswith(APPS + "/"):
+            name = path[len(APPS) + 1:].encode("ascii", "ignore")
+            for app in self.app_list() or []:
+                if app["name"] == name:
+                    return {"type": 1, "name": name, "stat": {"size": app["size"], "modified": 0}, "app": app}
+            return None
+        listing = self.cache.get(posixpath.dirname(path))
+        if listing is None:
+            return None
+        name = posixpath.basename(path).encode("ascii", "ignore")
+        for item in listing:
+            if item["name"] == name:
+                return item
+        return None
+
+    def listing(self, path):
+        if path == "/":
+            return [
+                {"type": 2, "name": b"internal", "stat": None},
+                {"type": 2, "name": b"sd", "stat": None},
+                {"type": 2, "name": APPS[1:].encode("ascii"), "stat": None},
+            ]
+        if path == APPS:
+            applist = self.app_list()
+            if applist is None:
+                return None
+            return [{"type": 1, "name": app["name"], "stat": {"size": app["size"], "modified": 0}, "app": app} for app in applist]
+        return self.cache.get(path)
+
+    # Methods
+
+    def do_OPTIONS(self):
+        self.send_empty(200, {"DAV": "1", "Allow": "OPTIONS, GET, HEAD, PUT, DELETE, MKCOL, PROPFIND"})
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        (path, query) = self.parse()
+        if path is None:
+            return
+        item = self.stat(path)
+        if item is None:
+            self.send_empty(404)
+            return
+        if item["type"] == 2:
+            listing = self.listing(path)
+            if listing is None:
+                self.send_empty(502)
+                return
+            entries = []
+            for entry in listing:
+                entries.append({
+                    "name": entry["name"].decode("ascii", "ignore"),
+                    "type": "directory" if entry["type"] == 2 else "file",
+                    "size": entry["stat"]["size"] if entry["stat"] else None,
+                    "modified": entry["stat"]["modified"] if entry["stat"] else None,
+                })
+            self.send_body(200, "application/json", json.dumps(entries).encode("utf-8"))
+            return
+        size = item["stat"]["size"] if item["stat"] else None
+        if path.startswith(APPS + "/"):
+            size = None # The size in the app list is the size of the allocated space, not of the binary
+        if self.command == "HEAD":
+            headers = {"Content-Type": "application/octet-stream"}
+            if item["stat"] and item["stat"]["modified"]:
+                headers["Last-Modified"] = email.utils.formatdate(item["stat"]["modified"], usegmt=True)
+            self.send_response(200)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            if size is not None:
+                self.send_header("Content-Length", str(size))
+            self.end_headers()
+            return
+        if path.startswith(APPS + "/"):
+            open_stream = lambda badge: badge.app_read_stream(path[len(APPS) + 1:].encode("ascii", "ignore"))
+        else:
+            open_stream = lambda badge: badge.fs_read_stream(path.encode("ascii", "ignore"))
+        chunks = queue.Queue(8)
+        cancelled = threading.Event()
+        future = self.scheduler.submit_job(read_job(open_stream, chunks, cancelled), self.priority(), self.client())
+        try:
+            opened = self.receive(chunks, future)
+        except IOError:
+            opened = False
+        if not opened:
+            self.send_empty(502)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        if size is None:
+            # Without a length the end of the body is marked by closing the connection
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        else:
+            self.send_header("Content-Length", str(size))
+        self.end_headers()
+        sent = 0
+        try:
+            while True:
+                chunk = self.receive(chunks, future)
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                self.wfile.write(chunk)
+                sent += len(chunk)
+        except IOError as e:
+            # The headers are sent already, the client notices the short body
+            self.log_error("Transfer of %s failed: %s", path, e)
+            cancelled.set()
+            self.close_connection = True
+            return
+        if size is not None and sent != size:
+            self.log_error("Size of %s changed during the transfer", path)
+            self.close_connection = True
+
+    def do_PUT(self):
+        (path, query) = self.parse()
+        if path is None:
+            return
+        length = self.content_length()
+        if length is None:
+            self.send_empty(411)
+            return
+        if path in ["/", "/internal", "/sd", APPS]:
+            self.send_empty(405)
+            return
+        if path.startswith(APPS + "/"):
+            name = path[len(APPS) + 1:].encode("ascii", "ignore")
+            title = self.headers.get("X-App-Title") or query.get("title", [name.decode("ascii")])[0]
+            try:
+                version = max(0, int(self.headers.get("X-App-Version") or query.get("version", ["0"])[0]))
+            except ValueError:
+                self.send_empty(400)
+                return
+            result = self.upload(lambda badge, chunks: badge.app_write_stream_steps(name, title.encode("ascii", "ignore"), version, length, chunks), length)
+        else:
+            self.cache.invalidate(path)
+            result = self.upload(lambda badge, chunks: badge.fs_write_stream_steps(path.encode("ascii", "ignore"), chunks, length), length)
+            self.cache.invalidate(path)
+        if not result:
+            # Unknown how much of the body has been read, the connection can't be reused
+            self.close_connection = True
+            self.send_empty(502, {"Connection": "close"})
+            return
+        self.send_empty(201)
+
+    def receive(self, chunks, future):
+        """
+        Returns the next item put in the queue by a read_job, raises IOError if the job ended without putting it
+        """
+        while True:
+            try:
+                return chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+            if future.done():
+                try:
+                    return chunks.get_nowait()
+                except queue.Empty:
+                    raise IOError(future.exception() or "Transfer ended early")
+
+    def upload(self, start, length):
+        """
+        Sends the request body to the badge as a scheduled transfer, start is called with the badge and the chunks and returns the steps
+        """
+        chunks = queue.Queue(8)
+        future = self.scheduler.submit_job(lambda badge: start(badge, queued_chunks(chunks)), self.priority(), self.client())
+        try:
+            for data in self.body(length):
+                # Waits while the transfer is waiting for its turn or the queue is full
+                while not self.put(chunks, data, future):
+                    pass
+                if future.done():
+                    break # Failed, the rest of the body isn't read
+            self.put(chunks, None, future)
+        except IOError as e:
+            self.put(chunks, e, future)
+        try:
+            return future.result()
+        except IOError as e:
+            self.log_error("Upload failed: %s", e)
+            return False
+
+    def put(self, chunks, item, future):
+        """
+        Puts item in the queue of an upload, returns False if the queue is still full after a while
+        """
+        if future.done():
+            return True
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            return False
+
+    def do_DELETE(self):
+        (path, query) = self.parse()
+        if path is None:
+            return
+        if path in ["/", "/internal", "/sd", APPS]:
+            self.send_empty(405)
+            return
+        if path.startswith(APPS + "/"):
+            result = self.scheduler.call(lambda badge: badge.app_remove(path[len(APPS) + 1:].encode("ascii", "ignore")))
+        else:
+            result = self.scheduler.call(lambda badge: badge.fs_remove(path.encode("ascii", "ignore")))
+        self.cache.invalidate(path)
+        self.send_empty(204 if result else 404)
+
+    def do_MKCOL(self):
+        (path, query) = self.parse()
+        if path is None:
+            return
+        if path == "/" or path == APPS or path.startswith(APPS + "/"):
+            self.send_empty(405)
+            return
+        result = self.scheduler.call(lambda badge: badge.fs_create_directory(path.encode("ascii", "ignore")))
+        self.cache.invalidate(path)
+        self.send_empty(201 if result else 409)
+
+    def do_PROPFIND(self):
+        (path, query) = self.parse()
+        if path is None:
+            return
+        length = self.content_length()
+        if length:
+            self.rfile.read(length) # Only allprop is supported, the request body is ignored
+        item = self.stat(path)
+        if item is None:
+            self.send_empty(404)
+            return
+        responses = [self.propfind_response(path, item)]
+        if item["type"] == 2 and self.headers.get("Depth", "1") != "0":
+            listing = self.listing(path)
+            if listing is None:
+                self.send_empty(502)
+                return
+            for entry in listing:
+                responses.append(self.propfind_response(posixpath.join(path, entry["name"].decode("ascii", "ignore")), entry))
+        body = '<?xml version="1.0" encoding="utf-8"?>\n<D:multistatus xmlns:D="DAV:">' + "".join(responses) + "</D:multistatus>"
+        self.send_body(207, 'application/xml; charset="utf-8"', body.encode("utf-8"))
+
+    def propfind_response(self, path, item):
+        properties = "<D:displayname>{}</D:displayname>".format(escape(posixpath.basename(path) or "/"))
+        if item["type"] == 2:
+            href = path.rstrip("/") + "/"
+            properties += "<D:resourcetype><D:collection/></D:resourcetype>"
+        else:
+            href = path
+            properties += "<D:resourcetype/>"
+            if item["stat"]:
+                properties += "<D:getcontentlength>{}</D:getcontentlength>".format(item["stat"]["size"])
+        if item["stat"] and item["stat"]["modified"]:
+            properties += "<D:getlastmodified>{}</D:getlastmodified>".format(email.utils.formatdate(item["stat"]["modified"], usegmt=True))
+        return "<D:response><D:href>{}</D:href><D:propstat><D:prop>{}</D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>".format(escape(urllib.parse.quote(href)), properties)
+
+class Gateway(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, badge, port = 8022, max_age = 2.0):
+        # Only bound to localhost, the gateway has no authentication
+        super().__init__(("127.0.0.1", port), GatewayHandler)
+        self.badge = badge
+        self.scheduler = Scheduler(badge)
+        self.cache = ListingCache(badge, max_age, background=False, scheduler=self.scheduler)
+
+if __name__ == "__main__":
+    from badge import run
+    sys.exit(run("gateway", sys.argv[1:]))
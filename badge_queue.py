@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+
+# Persistent queue of transfers that survives badges being unplugged
+#
+# Pushes, pulls and app installs are added to a queue file and run by
+# `badge.py queue run`. Every job records which of its files are done and
+# the queue file is updated while the job runs, so after the badge is
+# unplugged, the runner is stopped or the host reboots only the unfinished
+# files are transferred again.
+#
+# A job is bound to the badge it was started on, or to the badge given with
+# --serial when it was added, identified by its USB serial number. When the
+# badge disappears in the middle of a transfer the job is marked interrupted
+# and the runner waits until a badge with queued or interrupted jobs is
+# connected; the job continues when the same badge comes back. Jobs that
+# aren't bound to a badge run on the first badge that is connected. Badges
+# whose serial number can't be read (usually a permission problem) can't be
+# told apart, their jobs stay unbound.
+#
+# The file that was being transferred when the badge disappeared is
+# transferred again from the start: the badge has a single open file, and
+# the file is lost together with the connection.
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows, the queue file isn't locked against concurrent changes
+
+ACTIVE_STATES = ["queued", "running", "interrupted"]
+STREAM_LIMIT = 256 * 1024 # Larger files are pushed one by one, read while they are sent
+
+def default_file():
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "mch2022-tools", "queue.json")
+
+def push_job(name, target, serial = None):
+    """
+    Describes pushing a local file or directory to the badge
+    """
+    job = {"type": "push", "source": os.path.abspath(name), "target": target, "serial": serial, "directories": [], "files": []}
+    if os.path.isdir(name):
+        job["directories"].append(target)
+        for root, dirs, files in os.walk(name, topdown=True):
+            remote_root = target + root[len(name):].replace(os.sep, "/")
+            for dirname in dirs:
+                job["directories"].append(remote_root + "/" + dirname)
+            for filename in files:
+                local = os.path.join(root, filename)
+                job["files"].append({"local": os.path.abspath(local), "remote": remote_root + "/" + filename, "size": os.path.getsize(local), "done": False})
+    else:
+        job["files"].append({"local": os.path.abspath(name), "remote": target, "size": os.path.getsize(name), "done": False})
+    return job
+
+def pull_job(name, target, recursive = False, serial = None):
+    """
+    Describes pulling a file or directory from the badge, the files of a directory are listed when the job starts
+    """
+    job = {"type": "pull", "source": name, "target": os.path.abspath(target), "serial": serial, "recursive": recursive, "directories": [], "files": None}
+    if not recursive:
+        job["files"] = [{"local": job["target"], "remote": name, "size": -1, "modified": 0, "done": False}]
+    return job
+
+def app_job(filename, name, title, version, serial = None):
+    """
+    Describes installing an app from a local binary
+    """
+    filename = os.path.abspath(filename)
+    return {"type": "app", "source": filename, "target": name, "serial": serial,
+            "files": [{"local": filename, "name": name, "title": title, "version": version, "done": False}]}
+
+class TransferQueue:
+    def __init__(self, filename = None):
+        self.filename = filename or default_file()
+        self.jobs = []
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as f:
+                self.jobs = json.load(f)["jobs"]
+        except (OSError, ValueError, KeyError):
+            self.jobs = []
+
+    def write(self):
+        temporary = self.filename + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"jobs": self.jobs}, f)
+        os.replace(temporary, self.filename)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Holds the lock of the queue file and reads it again, every change is made this way so jobs added by
+        another process while the runner is working aren't lost
+        """
+        with open(self.filename + ".lock", "w") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            self.load()
+            yield
+
+    def add(self, job):
+        """
+        Appends a job to the queue, returns its id
+        """
+        with self.locked():
+            job["id"] = max([current["id"] for current in self.jobs], default=0) + 1
+            job["state"] = "queued"
+            job["added"] = int(time.time())
+            self.jobs.append(job)
+            self.write()
+        return job["id"]
+
+    def update(self, job):
+        """
+        Stores the state of a job, returns False if the job was removed from the queue in the meantime
+        """
+        with self.locked():
+            for index, current in enumerate(self.jobs):
+                if current["id"] == job["id"]:
+                    self.jobs[index] = job
+                    self.write()
+                    return True
+        return False
+
+    def remove(self, states):
+        """
+        Removes the jobs in one of states, returns the number of removed jobs
+        """
+        with self.locked():
+            count = len(self.jobs)
+            self.jobs = [job for job in self.jobs if job["state"] not in states]
+            self.write()
+        return count - len(self.jobs)
+
+    def retry(self):
+        """
+        Queues the failed jobs again, only their unfinished files are transferred
+        """
+        with self.locked():
+            jobs = [job for job in self.jobs if job["state"] == "failed"]
+            for job in jobs:
+                job["state"] = "queued"
+            self.write()
+        return len(jobs)
+
+    def runnable(self, serial):
+        """
+        Returns the jobs that can run on the badge with serial, in the order they were added
+        """
+        return [job for job in self.jobs if job["state"] in ACTIVE_STATES and job["serial"] in [None, serial]]
+
+class QueueRunner:
+    def __init__(self, queue, poll = 0.5, save_interval = 1.0, progress = None):
+        """
+        Runs the jobs of a TransferQueue on the badges that are connected
+        @params:
+            queue         - Required  : TransferQueue
+            poll          - Optional  : seconds between looking for new jobs in the queue file while waiting (Float)
+            save_interval - Optional  : seconds between storing the progress of a job, it is always stored when a job ends or is interrupted (Float)
+            progress      - Optional  : progress callback for the badges, see Badge.report_progress
+        """
+        self.queue = queue
+        self.poll = poll
+        self.save_interval = save_interval
+        self.progress = progress
+        self.saved = 0
+        self.failed = 0 # Number of files of the running job that failed
+        self.removed = False # Set when the running job was removed from the queue
+
+    def save(self, job, force = False):
+        now = time.monotonic()
+        if not force and now - self.saved < self.save_interval:
+            return
+        self.saved = now
+        if not self.queue.update(job):
+            self.removed = True
+
+    def connect(self):
+        """
+        Connects to a badge that has jobs to run, returns None if there is none
+        """
+        from webusb import Badge
+        from webusb_hotplug import monitor
+        for (serial, device) in monitor().badges():
+            if len(self.queue.runnable(serial)) < 1:
+                continue
+            try:
+                badge = Badge(device, progress=self.progress)
+                # The runner continues interrupted jobs itself, with only the unfinished files
+                badge.reconnect_timeout = 0
+                badge.watch()
+                if badge.begin():
+                    return badge
+            except Exception as e:
+                # Unplugged or still booting, the badge is tried again at the next poll
+                print("Failed to connect to badge {}: {}".format(serial, e))
+        return None
+
+    def finished(self, job, item, success, description):
+        if not success:
+            print("Failed to {}".format(description))
+            self.failed += 1
+            return
+        item["done"] = True
+        print(description[0].upper() + description[1:] + " done")
+        self.save(job)
+
+    def run_push(self, badge, job):
+        remaining = [item for item in job["files"] if not item["done"]]
+        small = []
+        contents = []
+        for item in remaining:
+            if item["size"] > STREAM_LIMIT:
+                continue
+            try:
+                with open(item["local"], "rb") as f:
+                    contents.append((item["remote"].encode("ascii", "ignore"), f.read()))
+                small.append(item)
+            except OSError as e:
+                print(e)
+                self.failed += 1
+
+        def written(index, success):
+            self.finished(job, small[index], success, "push of {} to {}".format(small[index]["local"], small[index]["remote"]))
+
+        # Creating directories that exist already fails harmlessly, so they are created again when the job continues
+        badge.fs_write_files(contents, [directory.encode("ascii", "ignore") for directory in job["directories"]], written)
+        for item in remaining:
+            if item["size"] <= STREAM_LIMIT:
+                continue
+            try:
+                f = open(item["local"], "rb")
+            except OSError as e:
+                print(e)
+                self.failed += 1
+                continue
+            # The file is read while it is being sent, BadgeDisconnected (an IOError) has to reach run_job
+            with f:
+                result = badge.fs_write_file(item["remote"].encode("ascii", "ignore"), f)
+            self.finished(job, item, result, "push of {} to {}".format(item["local"], item["remote"]))
+
+    def list_pull(self, badge, job):
+        source = job["source"].encode("ascii", "ignore")
+        tree = badge.fs_list_tree(source)
+        if tree is None:
+            print("Failed to list {}".format(job["source"]))
+            return False
+        job["directories"] = [job["target"]]
+        job["files"] = []
+        for (path, item) in tree:
+            parts = path[len(source) + 1:].decode("ascii", "ignore").split("/")
+            if any(part in ["", ".", ".."] for part in parts):
+                continue
+            local = os.path.join(job["target"], *parts)
+            if item["type"] == 2:
+                job["directories"].append(local)
+                continue
+            stat = item["stat"] or {"size": -1, "modified": 0}
+            job["files"].append({"local": local, "remote": path.decode("ascii", "ignore"), "size": stat["size"], "modified": stat["modified"], "done": False})
+        self.save(job, True)
+        return True
+
+    def run_pull(self, badge, job):
+        if job["files"] is None and not self.list_pull(badge, job):
+            self.failed += 1
+            return
+        for directory in job["directories"]:
+            os.makedirs(directory, exist_ok=True)
+        remaining = [item for item in job["files"] if not item["done"]]
+
+        def received(index, data):
+            item = remaining[index]
+            description = "pull of {} to {}".format(item["remote"], item["local"])
+            if data is False:
+                self.finished(job, item, False, description)
+                return
+            try:
+                with open(item["local"], "wb") as f:
+                    f.write(data)
+                if item["modified"]:
+                    os.utime(item["local"], (item["modified"], item["modified"]))
+            except OSError as e:
+                print(e)
+                self.finished(job, item, False, description)
+                return
+            self.finished(job, item, True, description)
+
+        badge.fs_read_files([(item["remote"].encode("ascii", "ignore"), item["size"]) for item in remaining], received)
+
+    def run_app(self, badge, job, resumed):
+        from webusb_appfs import app_from_file, plan_install, execute_plan
+        item = job["files"][0]
+        if item["done"]:
+            return
+        try:
+            app = app_from_file(item["local"], item["name"].encode("ascii", "ignore"), item["title"].encode("ascii", "ignore"), item["version"])
+        except OSError as e:
+            print(e)
+            self.failed += 1
+            return
+        applist = badge.app_list()
+        state = badge.fs_state()
+        if applist is None or not state:
+            print("Failed to read the AppFS state")
+            self.failed += 1
+            return
+        # An interrupted install may have left an app with the new title and version but incomplete content
+        plan = plan_install(applist, state["app"]["free"], [app], force=resumed)
+        if not plan["fits"]:
+            print("Not enough space in the AppFS for app {}".format(item["name"]))
+            self.failed += 1
+            return
+        self.finished(job, item, execute_plan(badge, plan), "install of app {}".format(item["name"]))
+
+    def run_job(self, badge, job):
+        from webusb import BadgeDisconnected
+        resumed = job["state"] != "queued"
+        print("{} job {}: {} {}".format("Resuming" if resumed else "Starting", job["id"], job["type"], job["source"]))
+        if job["serial"] is None:
+            job["serial"] = badge.serial
+        job["state"] = "running"
+        self.failed = 0
+        self.removed = False
+        self.save(job, True)
+        try:
+            if job["type"] == "app":
+                self.run_app(badge, job, resumed)
+            else:
+                getattr(self, "run_" + job["type"])(badge, job)
+        except BadgeDisconnected:
+            job["state"] = "interrupted"
+            self.save(job, True)
+            raise
+        job["state"] = "done" if self.failed == 0 else "failed"
+        self.save(job, True)
+        if self.removed:
+            print("Job {} was removed from the queue".format(job["id"]))
+        print("Job {} {}".format(job["id"], job["state"]))
+
+    def run(self, follow = False):
+        """
+        Runs the queued jobs, waiting for their badges to be connected
+        Returns True if no job failed, with follow it keeps waiting for new jobs and never returns
+        """
+        from webusb import BadgeDisconnected
+        from webusb_hotplug import monitor
+        waiting = False
+        while True:
+            self.queue.load()
+            if not any(job["state"] in ACTIVE_STATES for job in self.queue.jobs):
+                if not follow:
+                    return not any(job["state"] == "failed" for job in self.queue.jobs)
+                time.sleep(self.poll)
+                continue
+            generation = monitor().generation
+            badge = self.connect()
+            if badge is None:
+                if not waiting:
+                    print("Waiting for a badge with queued jobs")
+                    waiting = True
+                # Woken up as soon as a badge is plugged in, the poll picks up jobs added to the queue file
+                monitor().wait_change(generation, self.poll)
+                continue
+            waiting = False
+            print("Badge {} connected".format(badge.serial or "without serial number"))
+            try:
+                while True:
+                    self.queue.load()
+                    jobs = self.queue.runnable(badge.serial)
+                    if len(jobs) < 1:
+                        break
+                    self.run_job(badge, jobs[0])
+            except BadgeDisconnected:
+                print("Badge {} disconnected, its jobs continue when it is connected again".format(badge.serial or "without serial number"))
+
+if __name__ == "__main__":
+    from badge import run
+    sys.exit(run("queue", sys.argv[1:]))
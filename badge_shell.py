@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# Interactive shell for the MCH2022 badge
+#
+# Keeps one connection to the badge open and offers ls, cd, put, get, rm,
+# mkdir, df, apps and nvs commands. Remote paths are tab completed from a
+# cache of directory listings. Cached listings older than a few seconds are
+# still used for completion but are refreshed in the background, the
+# subdirectories of a listed directory are fetched in the background too and
+# every command that changes the filesystem invalidates the listings it
+# affects.
+
+import cmd
+import glob
+import os
+import posixpath
+import shlex
+import sys
+from datetime import datetime
+from webusb import BadgeDisconnected
+from webusb_listing import ListingCache
+
+def format_size(size):
+    if size >= 1024:
+        return str(round(size / 1024, 2)) + " KB"
+    return str(size) + " B"
+
+class BadgeShell(cmd.Cmd):
+    intro = "MCH2022 badge shell, type help or ? to list commands"
+
+    def __init__(self, badge):
+        super().__init__()
+        self.badge = badge
+        self.cache = ListingCache(badge)
+        self.cwd = "/"
+        self.update_prompt()
+        try:
+            import readline
+            # Complete whole paths instead of the part after the last slash
+            readline.set_completer_delims(" \t\n")
+        except ImportError:
+            pass
+
+    def update_prompt(self):
+        self.prompt = "badge:{}> ".format(self.cwd)
+
+    def resolve(self, path):
+        if not path:
+            return self.cwd
+        return posixpath.normpath(posixpath.join(self.cwd, path)).replace("//", "/")
+
+    def check_remote(self, path):
+        if not (path == "/internal" or path.startswith("/internal/") or path == "/sd" or path.startswith("/sd/")):
+            print("Path should always start with /internal or /sd")
+            return False
+        return True
+
+    def split(self, line, minimum, maximum):
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            print(e)
+            return None
+        if not minimum <= len(words) <= maximum:
+            print("Expected {} arguments".format(minimum if minimum == maximum else "{} to {}".format(minimum, maximum)))
+            return None
+        return words
+
+    def is_directory(self, path):
+        if path == "/":
+            return True
+        listing = self.cache.get(posixpath.dirname(path))
+        if listing is None:
+            return False
+        name = posixpath.basename(path).encode("ascii", "ignore")
+        return any(item["name"] == name and item["type"] == 2 for item in listing)
+
+    # Completion
+
+    def complete_remote(self, text, directories_only = False):
+        if "/" in text:
+            directory = text[:text.rindex("/") + 1]
+        else:
+            directory = ""
+        prefix = text[len(directory):]
+        # Never waits for the badge, a directory that isn't cached yet is listed in the background for the next tab
+        listing = self.cache.get(self.resolve(directory), wait=False)
+        if listing is None:
+            return []
+        matches = []
+        for item in listing:
+            name = item["name"].decode("ascii", "ignore")
+            if not name.startswith(prefix):
+                continue
+            if item["type"] == 2:
+                matches.append(directory + name + "/")
+            elif not directories_only:
+                matches.append(directory + name)
+        return matches
+
+    def complete_local(self, text):
+        return [path + "/" if os.path.isdir(path) else path for path in glob.glob(os.path.expanduser(text) + "*")]
+
+    def argument_index(self, line, begidx):
+        return len(line[:begidx].split()) - 1
+
+    def complete_ls(self, text, line, begidx, endidx):
+        return self.complete_remote(text)
+
+    def complete_cd(self, text, line, begidx, endidx):
+        return self.complete_remote(text, True)
+
+    def complete_rm(self, text, line, begidx, endidx):
+        return self.complete_remote(text)
+
+    def complete_mkdir(self, text, line, begidx, endidx):
+        return self.complete_remote(text, True)
+
+    def complete_get(self, text, line, begidx, endidx):
+        if self.argument_index(line, begidx) == 0:
+            return self.complete_remote(text)
+        return self.complete_local(text)
+
+    def complete_put(self, text, line, begidx, endidx):
+        if self.argument_index(line, begidx) == 0:
+            return self.complete_local(text)
+        return self.complete_remote(text)
+
+    # Commands
+
+    def onecmd(self, line):
+        # The badge may be unplugged during any command, after which the reconnect timeout expired (see Badge.reconnect)
+        # or the request isn't resumable. The shell keeps running, the next command works once the badge is back
+        try:
+            return super().onecmd(line)
+        except BadgeDisconnected as e:
+            print(e)
+            return False
+
+    def emptyline(self):
+        pass
+
+    def do_ls(self, line):
+        "ls [path]: list a directory"
+        words = self.split(line, 0, 1)
+        if words is None:
+            return
+        path = self.resolve(words[0] if words else "")
+        if path != "/" and not self.check_remote(path):
+            return
+        listing = self.cache.fetch(path)
+        if listing is None:
+            print(path + " ** Failed to open directory **")
+            return
+        self.cache.prefetch_children(path, listing)
+        print("\x1b[4m{: <5}\x1b[0m \x1b[4m{: <48}\x1b[0m \x1b[4m{: <12}\x1b[0m \x1b[4m{: <19}\x1b[0m".format("Type", "Name", "Size", "Modified"))
+        for item in listing:
+            sizestring = ""
+            modifiedstring = ""
+            if item["stat"]:
+                if item["type"] != 2:
+                    sizestring = format_size(item["stat"]["size"])
+                modifiedstring = datetime.utcfromtimestamp(item["stat"]["modified"]).strftime('%Y-%m-%d %H:%M:%S')
+            typestring = "Dir" if item["type"] == 2 else "File"
+            print("{: <5} {: <48} {: <12} {: <19}".format(typestring, item["name"].decode("ascii", errors="ignore"), sizestring, modifiedstring))
+
+    def do_cd(self, line):
+        "cd [path]: change the current directory"
+        words = self.split(line, 0, 1)
+        if words is None:
+            return
+        path = self.resolve(words[0] if words else "/")
+        if path != "/":
+            if not self.check_remote(path):
+                return
+            listing = self.cache.get(path)
+            if listing is None:
+                print(path + " ** Failed to open directory **")
+                return
+            self.cache.prefetch_children(path, listing)
+        self.cwd = path
+        self.update_prompt()
+
+    def do_pwd(self, line):
+        "pwd: print the current directory"
+        print(self.cwd)
+
+    def do_put(self, line):
+        "put {local} [remote]: upload a file"
+        words = self.split(line, 1, 2)
+        if words is None:
+            return
+        local = os.path.expanduser(words[0])
+        target = self.resolve(words[1] if len(words) > 1 else "")
+        if self.is_directory(target):
+            target = posixpath.join(target, os.path.basename(local))
+        if not self.check_remote(target):
+            return
+        try:
+            f = open(local, "rb")
+        except OSError as e:
+            print(e)
+            return
+        with f, self.badge.lock:
+            result = self.badge.fs_write_file(target.encode("ascii", "ignore"), f)
+        self.cache.invalidate(target)
+        if not result:
+            print("Failed to push file")
+            return
+        print("File {} pushed succesfully to {}".format(local, target))
+
+    def do_get(self, line):
+        "get {remote} [local]: download a file"
+        words = self.split(line, 1, 2)
+        if words is None:
+            return
+        name = self.resolve(words[0])
+        if not self.check_remote(name):
+            return
+        target = os.path.expanduser(words[1]) if len(words) > 1 else posixpath.basename(name)
+        if os.path.isdir(target):
+            target = os.path.join(target, posixpath.basename(name))
+        with self.badge.lock:
+            result = self.badge.fs_read_file(name.encode("ascii", "ignore"))
+        if result is False:
+            print("Failed to download file")
+            return
+        try:
+            with open(target, "wb") as f:
+                f.write(result)
+        except OSError as e:
+            print(e)
+            return
+        print("File downloaded succesfully to {}".format(target))
+
+    def do_rm(self, line):
+        "rm {path}: remove a file or directory"
+        words = self.split(line, 1, 1)
+        if words is None:
+            return
+        name = self.resolve(words[0])
+        if not self.check_remote(name):
+            return
+        with self.badge.lock:
+            result = self.badge.fs_remove(name.encode("ascii", "ignore"))
+        self.cache.invalidate(name)
+        if not result:
+            print("Failed to remove")
+
+    def do_mkdir(self, line):
+        "mkdir {path}: create a directory"
+        words = self.split(line, 1, 1)
+        if words is None:
+            return
+        name = self.resolve(words[0])
+        if not self.check_remote(name):
+            return
+        with self.badge.lock:
+            result = self.badge.fs_create_directory(name.encode("ascii", "ignore"))
+        self.cache.invalidate(name)
+        if not result:
+            print("Failed to create directory")
+
+    def do_df(self, line):
+        "df: show the usage of the filesystems"
+        with self.badge.lock:
+            result = self.badge.fs_state()
+        if not result:
+            print("Failed to read filesystem state")
+            return
+        print("\x1b[4m{: <12}\x1b[0m \x1b[4m{: <12}\x1b[0m \x1b[4m{: <12}\x1b[0m \x1b[4m{: <12}\x1b[0m".format("Filesystem", "Size", "Used", "Free"))
+        for name, key in [("AppFS", "app"), ("/internal", "internal"), ("/sd", "sd")]:
+            if result[key]["size"] > 0:
+                print("{: <12} {: <12} {: <12} {: <12}".format(name, format_size(result[key]["size"]), format_size(result[key]["size"] - result[key]["free"]), format_size(result[key]["free"])))
+
+    def do_apps(self, line):
+        "apps: list the apps in the AppFS"
+        with self.badge.lock:
+            applist = self.badge.app_list()
+        if applist is None:
+            print("** Failed to load application list **")
+            return
+        print("\x1b[4m{: <32}\x1b[0m \x1b[4m{: <48}\x1b[0m \x1b[4m{: <8}\x1b[0m \x1b[4m{: <10}\x1b[0m".format("Name", "Title", "Version", "Size"))
+        for app in applist:
+            print("{: <32} {: <48} {: <8} {: <10}".format(app["name"].decode("ascii", errors="ignore"), app["title"].decode("ascii", errors="ignore"), str(app["version"]), format_size(app["size"])))
+
+    def do_nvs(self, line):
+        "nvs [namespace]: list the NVS entries, with the values of small entries"
+        words = self.split(line, 0, 1)
+        if words is None:
+            return
+        with self.badge.lock:
+            entries = self.badge.nvs_list(words[0] if words else None)
+            if not entries:
+                print("Failed to read data")
+                return
+            print("\x1b[4m{: <24}\x1b[0m \x1b[4m{: <24}\x1b[0m \x1b[4m{: <8}\x1b[0m \x1b[4m{: <10}\x1b[0m \x1b[4m{: <32}\x1b[0m".format("Namespace", "Key", "Type", "Size", "Value"))
+            for namespace in entries:
+                for entry in entries[namespace]:
+                    value = "(skipped)"
+                    if entry["size"] < 64 and self.badge.nvs_should_read(entry["type"]):
+                        value = str(self.badge.nvs_read(namespace, entry["key"], entry["type"]))
+                    print("{: <24} {: <24} {: <8} {:10d} {}".format(namespace, entry["key"], self.badge.nvs_type_to_name(entry["type"]), entry["size"], value))
+
+    def do_exit(self, line):
+        "exit: leave the shell"
+        return True
+
+    def do_EOF(self, line):
+        print()
+        return True
+
+if __name__ == "__main__":
+    from badge import run
+    sys.exit(run("shell", sys.argv[1:]))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+from webusb import *
+from webusb_sim import SimulatedDevice, FaultyDevice
+import argparse
+import contextlib
+import json
+import random
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='MCH2022 badge transfer reliability soak test')
+parser.add_argument("--duration", type=float, default=60, help="Seconds to run the workload for, per phase")
+parser.add_argument("--drop", type=float, default=0.001, help="Probability of dropping a USB read")
+parser.add_argument("--garbage", type=float, default=0.001, help="Probability of injecting garbage into a USB read")
+parser.add_argument("--corrupt", type=float, default=0.001, help="Probability of corrupting a USB read")
+parser.add_argument("--delay", type=float, default=0.001, help="Probability of delaying a USB read")
+parser.add_argument("--delay-time", type=float, default=0.2, help="Duration of a delayed USB read in seconds")
+parser.add_argument("--min-size", type=int, default=1024, help="Smallest file size used by the workload")
+parser.add_argument("--max-size", type=int, default=65536, help="Largest file size used by the workload")
+parser.add_argument("--seed", type=int, default=None, help="Seed for the workload and the injected faults")
+parser.add_argument("--hardware", action="store_true", help="Inject faults into the connection with a real badge instead of the simulated badge")
+parser.add_argument("--target", default="/internal/soak", help="Directory on the badge used by the workload, must not exist yet")
+parser.add_argument("--output", "-o", help="File to store the results in as JSON")
+args = parser.parse_args()
+
+if not (args.target.startswith("/internal") or args.target.startswith("/sd")):
+    print("Path should always start with /internal or /sd")
+    sys.exit(1)
+
+workload_random = random.Random(args.seed)
+
+def run_phase(badge, faulty, duration):
+    stats = {
+        "operations": 0,
+        "failures": 0,
+        "integrity_failures": 0,
+        "bytes": 0,
+        "recoveries": [],
+    }
+    expected = {}
+    written = set() # Files the workload wrote to, the only files removed afterwards
+    failed_since = None
+    faults_start = len(faulty.faults)
+    crc_errors_start = badge.metrics.crc_errors
+    garbage_bytes_start = badge.metrics.garbage_bytes
+    retries_start = badge.metrics.retries
+    target = args.target.encode("ascii", "ignore")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        badge.fs_create_directory(target)
+        start = time.monotonic()
+        while time.monotonic() - start < duration:
+            name = target + "/file{}.bin".format(workload_random.randrange(8)).encode("ascii")
+            operation = workload_random.choice(["push", "push", "pull", "pull", "list"])
+            if operation == "pull" and name not in expected:
+                operation = "push"
+            integrity = True
+            if operation == "push":
+                data = os.urandom(workload_random.randint(args.min_size, args.max_size))
+                expected.pop(name, None)
+                written.add(name)
+                result = badge.fs_write_file(name, data)
+                if result:
+                    expected[name] = data
+                    stats["bytes"] += len(data)
+                    if isinstance(faulty.device, SimulatedDevice):
+                        integrity = faulty.device.filesystem.read(name.decode("ascii")) == data
+            elif operation == "pull":
+                result = badge.fs_read_file(name)
+                if result:
+                    stats["bytes"] += len(result)
+                    integrity = bytes(result) == expected[name]
+            else:
+                result = badge.fs_list(target) is not None
+            stats["operations"] += 1
+            if not integrity:
+                stats["integrity_failures"] += 1
+                expected.pop(name, None)
+            if result:
+                if failed_since is not None:
+                    stats["recoveries"].append(time.monotonic() - failed_since)
+                    failed_since = None
+            else:
+                stats["failures"] += 1
+                if failed_since is None:
+                    failed_since = time.monotonic()
+                badge.sync()
+        stats["elapsed"] = time.monotonic() - start
+        # Only what the workload created is removed, the directory is empty by then
+        for name in sorted(written):
+            badge.fs_remove(name)
+        badge.fs_remove(target)
+    stats["throughput"] = stats["bytes"] / stats["elapsed"]
+    stats["crc_errors"] = badge.metrics.crc_errors - crc_errors_start
+    stats["garbage_bytes"] = badge.metrics.garbage_bytes - garbage_bytes_start
+    stats["retries"] = badge.metrics.retries - retries_start
+    faults = {}
+    for (timestamp, kind) in faulty.faults[faults_start:]:
+        faults[kind] = faults.get(kind, 0) + 1
+    stats["faults"] = faults
+    return stats
+
+if args.hardware:
+    device = Badge().device
+else:
+    device = SimulatedDevice(bandwidth = 90000)
+
+faulty = FaultyDevice(device, args.drop, args.garbage, args.corrupt, args.delay, args.delay_time, args.seed)
+badge = Badge(faulty)
+
+faulty.enabled = False
+if not badge.begin():
+    print("Failed to connect")
+    sys.exit(1)
+print()
+
+if badge.fs_file_exists(args.target.encode("ascii", "ignore")):
+    # The directory is removed after every phase, it must not hold anything of the user
+    print("{} exists already, choose a --target that doesn't exist yet".format(args.target))
+    sys.exit(1)
+
+print("Running workload without faults for {} seconds...".format(args.duration))
+clean = run_phase(badge, faulty, args.duration)
+print("Running workload with faults for {} seconds...".format(args.duration))
+faulty.enabled = True
+noisy = run_phase(badge, faulty, args.duration)
+faulty.enabled = False
+
+print()
+print("\x1b[4m{: <24}\x1b[0m \x1b[4m{: <14}\x1b[0m \x1b[4m{: <14}\x1b[0m".format("", "Without faults", "With faults"))
+for (title, key) in [("Operations", "operations"), ("Failed operations", "failures"), ("Integrity failures", "integrity_failures"), ("Retries", "retries"), ("CRC errors", "crc_errors"), ("Garbage bytes", "garbage_bytes")]:
+    print("{: <24} {: <14} {: <14}".format(title, clean[key], noisy[key]))
+print("{: <24} {: <14} {: <14}".format("Throughput", str(round(clean["throughput"] / 1024, 2)) + " KB/s", str(round(noisy["throughput"] / 1024, 2)) + " KB/s"))
+print()
+for kind, count in sorted(noisy["faults"].items()):
+    print("Injected {: <16} {}".format(kind + ":", count))
+if clean["throughput"] > 0:
+    print("Throughput degradation:  {:.1%}".format(1 - noisy["throughput"] / clean["throughput"]))
+if len(noisy["recoveries"]) > 0:
+    print("Recovery time:           {:.3f} s average, {:.3f} s maximum".format(sum(noisy["recoveries"]) / len(noisy["recoveries"]), max(noisy["recoveries"])))
+
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump({"clean": clean, "faults": noisy}, f, indent=4)
+    print("Results stored in {}".format(args.output))
+
+if clean["integrity_failures"] > 0 or noisy["integrity_failures"] > 0:
+    sys.exit(1)
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
-from webusb import *
-badge = Badge()
-badge.reset()
+
+import sys
+from badge import run
+
+sys.exit(run("exit", sys.argv[1:]))
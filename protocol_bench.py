@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Performance regression benchmarks for the host side of the WebUSB protocol
+#
+# Every benchmark drives webusb.Badge against an in-process stand-in for the
+# badge, so the numbers reflect the cost of the host side protocol stack only.
+# The end-to-end transfers run against a simulated badge without latency whose
+# endpoint doesn't wait for the USB timeout when no data is ready.
+# Results are compared against a stored baseline, any benchmark that got
+# slower than the allowed threshold makes the run fail.
+
+from webusb import *
+from webusb_sim import SimulatedDevice, MemoryFilesystem
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+class IdleEndpoint:
+    bEndpointAddress = 0x83
+    wMaxPacketSize = 64
+
+    def read(self, size, timeout = None):
+        raise TimeoutError("No data")
+
+class NullEndpoint:
+    bEndpointAddress = 0x03
+
+    def write(self, data, timeout = None):
+        return len(data)
+
+class ReplyEndpoints:
+    """
+    Endpoint pair answering every request with the same response
+    """
+    def __init__(self, command, payload):
+        self.bEndpointAddress = 0x03
+        self.wMaxPacketSize = 1 << 20
+        self.response = struct.pack("<IIIII", Badge.MAGIC, 0, int.from_bytes(command, "little"), len(payload), binascii.crc32(payload)) + payload
+        self.pending = b""
+
+    def write(self, data, timeout = None):
+        if len(data) == 20:
+            self.pending = self.response
+        return len(data)
+
+    def read(self, size, timeout = None):
+        if not self.pending:
+            raise TimeoutError("No data")
+        data = self.pending
+        self.pending = b""
+        return data
+
+class ImmediateEndpoint:
+    """
+    Endpoint of a simulated badge that returns at once when no data is ready instead of waiting for the USB timeout
+    Badge.receive_data only returns after a few reads without data, with the timeouts these would dominate the transfer benchmarks
+    """
+    def __init__(self, device, endpoint):
+        self.device = device
+        self.endpoint = endpoint
+        self.bEndpointAddress = endpoint.bEndpointAddress
+        self.wMaxPacketSize = endpoint.wMaxPacketSize
+
+    def read(self, size, timeout = None):
+        ready = self.device._next_read(size)
+        if ready is None or ready > time.monotonic():
+            raise TimeoutError("No data")
+        return self.endpoint.read(size, timeout)
+
+def create_transfer_badge():
+    """
+    Returns a simulated badge without latency and a Badge with a session started on it, for the end-to-end benchmarks
+    """
+    device = SimulatedDevice(MemoryFilesystem(internal_size = 64 * 1024 * 1024), packet_size = 64)
+    badge = Badge(device)
+    badge.begin()
+    badge.esp32_ep_in = ImmediateEndpoint(device, badge.esp32_ep_in)
+    return (device, badge)
+
+def create_badge(device = None):
+    badge = Badge(device if device is not None else SimulatedDevice())
+    badge.esp32_ep_out = NullEndpoint()
+    badge.esp32_ep_in = IdleEndpoint()
+    return badge
+
+def run(function, budget):
+    """
+    Runs function repeatedly for about budget seconds, returns seconds per call
+    """
+    function()
+    count = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= budget:
+            return elapsed / count
+
+def frame(command, payload):
+    return struct.pack("<IIIII", Badge.MAGIC, 0, int.from_bytes(command, "little"), len(payload), binascii.crc32(payload)) + payload
+
+def bench_receive_packets(budget):
+    badge = create_badge()
+    data = b"".join(frame(b"CHNK", os.urandom(size)) for size in [0, 4, 64, 512, 4096] * 20)
+    def function():
+        badge.rx_data = data
+        badge.packets = []
+        badge.receive_packets(1)
+    seconds = run(function, budget)
+    return {"us_per_op": seconds * 1e6, "mb_per_s": len(data) / seconds / 1e6}
+
+def bench_send_packet(budget):
+    badge = create_badge()
+    payload = os.urandom(8192)
+    seconds = run(lambda: badge.send_packet(b"CHNK", payload, False), budget)
+    return {"us_per_op": seconds * 1e6, "mb_per_s": len(payload) / seconds / 1e6}
+
+def bench_send_packet_empty(budget):
+    badge = create_badge()
+    seconds = run(lambda: badge.send_packet(b"SYNC", b"", False), budget)
+    return {"us_per_op": seconds * 1e6}
+
+def bench_decode(command, payload, call, budget):
+    badge = create_badge()
+    endpoints = ReplyEndpoints(command, payload)
+    badge.esp32_ep_out = endpoints
+    badge.esp32_ep_in = endpoints
+    seconds = run(lambda: call(badge), budget)
+    return {"us_per_op": seconds * 1e6}
+
+def bench_fs_list(budget):
+    payload = bytearray()
+    for i in range(256):
+        name = "file_{:04d}.py".format(i).encode("ascii")
+        payload += struct.pack("<BI", 1, len(name)) + name + struct.pack("<iIQ", 0, 1234, 1650000000)
+    return bench_decode(b"FSLS", bytes(payload), lambda badge: badge.fs_list(b"/internal"), budget)
+
+def bench_app_list(budget):
+    payload = bytearray()
+    for i in range(64):
+        name = "app_{:04d}".format(i).encode("ascii")
+        title = "Application number {}".format(i).encode("ascii")
+        payload += struct.pack("<H", len(name)) + name + struct.pack("<H", len(title)) + title + struct.pack("<HI", 1, 123456)
+    return bench_decode(b"APPL", bytes(payload), lambda badge: badge.app_list(), budget)
+
+def bench_nvs_list(budget):
+    payload = bytearray()
+    for i in range(256):
+        namespace = "namespace_{}".format(i % 8).encode("ascii")
+        key = "key_{:04d}".format(i).encode("ascii")
+        payload += struct.pack("<H", len(namespace)) + namespace + struct.pack("<H", len(key)) + key + struct.pack("<BL", 0x04, 4)
+    return bench_decode(b"NVSL", bytes(payload), lambda badge: badge.nvs_list(), budget)
+
+def bench_transfer(budget, write):
+    (device, badge) = create_transfer_badge()
+    data = os.urandom(256 * 1024)
+    device.filesystem.write("/internal/bench.bin", data)
+    if write:
+        function = lambda: badge.fs_write_file(b"/internal/bench.bin", data)
+    else:
+        function = lambda: badge.fs_read_file(b"/internal/bench.bin")
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        seconds = run(function, budget)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return {"us_per_op": seconds * 1e6, "mb_per_s": len(data) / seconds / 1e6}
+
+def bench_files(budget, write):
+    (device, badge) = create_transfer_badge()
+    files = [("/internal/file_{:03d}.py".format(i).encode("ascii"), os.urandom(512 + i * 16)) for i in range(64)]
+    size = sum(len(data) for (name, data) in files)
+    if write:
+        function = lambda: badge.fs_write_files(files)
+    else:
+        for (name, data) in files:
+            device.filesystem.write(name.decode("ascii"), data)
+        function = lambda: badge.fs_read_files([(name, len(data)) for (name, data) in files], lambda index, data: None)
+    seconds = run(function, budget)
+    return {"us_per_op": seconds * 1e6, "mb_per_s": size / seconds / 1e6}
+
+def bench_files_mixed(budget):
+    # Tiny files end in a short chunk, the number of reads planned for the large files must not be derived from it
+    (device, badge) = create_transfer_badge()
+    files = [("/internal/tiny_{:02d}.txt".format(i).encode("ascii"), os.urandom(6 + i)) for i in range(8)]
+    files += [("/internal/large_{}.bin".format(i).encode("ascii"), os.urandom(100 * 1024 + i * 1000)) for i in range(2)]
+    for (name, data) in files:
+        device.filesystem.write(name.decode("ascii"), data)
+    size = sum(len(data) for (name, data) in files)
+    received = {}
+    function = lambda: badge.fs_read_files([(name, len(data)) for (name, data) in files], lambda index, data: received.__setitem__(index, data))
+    seconds = run(function, budget)
+    result = {"us_per_op": seconds * 1e6, "mb_per_s": size / seconds / 1e6}
+    # Every file takes the reads for its data and one more that returns nothing
+    expected = sum(-(-len(data) // device.chunk_size) + 1 for (name, data) in files)
+    reads = badge.metrics.commands["CHNK"]["count"] / badge.metrics.commands["FSFR"]["count"] * len(files)
+    if any(received.get(index) != data for index, (name, data) in enumerate(files)):
+        result["error"] = "wrong data"
+    elif reads > expected:
+        result["error"] = "{:.0f} CHNK requests per run, expected {}".format(reads, expected)
+    return result
+
+def bench_import_time(budget):
+    # Starting any of the tools imports badge and webusb, pyusb should only be imported once a badge is used
+    directory = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    error = None
+    start = time.perf_counter()
+    while best is None or time.perf_counter() - start < budget:
+        output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import badge, webusb"], cwd=directory, capture_output=True, text=True).stderr
+        total = 0
+        for line in output.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            (own, cumulative, name) = line[len("import time:"):].split("|")
+            if name.strip() in ["badge", "webusb"]:
+                total += int(cumulative)
+            if name.strip() == "usb":
+                error = "pyusb imported"
+        best = total if best is None else min(best, total)
+    result = {"us_per_op": best, "limit_us": args.import_budget * 1000}
+    if error:
+        result["error"] = error
+    return result
+
+benchmarks = {
+    "receive_packets":     bench_receive_packets,
+    "send_packet":         bench_send_packet,
+    "send_packet_empty":   bench_send_packet_empty,
+    "fs_list":             bench_fs_list,
+    "app_list":            bench_app_list,
+    "nvs_list":            bench_nvs_list,
+    "fs_write_file":       lambda budget: bench_transfer(budget, True),
+    "fs_read_file":        lambda budget: bench_transfer(budget, False),
+    "fs_write_files":      lambda budget: bench_files(budget, True),
+    "fs_read_files":       lambda budget: bench_files(budget, False),
+    "fs_read_files_mixed": bench_files_mixed,
+    "import_time":         bench_import_time,
+}
+
+parser = argparse.ArgumentParser(description='MCH2022 badge host side protocol benchmark suite')
+parser.add_argument("benchmarks", nargs="*", help="Names of the benchmarks to run, all benchmarks are run by default")
+parser.add_argument("--baseline", default="protocol_bench_baseline.json", help="Baseline file to compare against")
+parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown compared to the baseline (fraction)")
+parser.add_argument("--budget", type=float, default=2.0, help="Seconds spent on every benchmark")
+parser.add_argument("--import-budget", type=float, default=50, help="Maximum time in milliseconds for importing badge and webusb")
+parser.add_argument("--list", action="store_true", help="List the available benchmarks")
+args = parser.parse_args()
+
+if args.list:
+    for name in benchmarks:
+        print(name)
+    sys.exit(0)
+
+for name in args.benchmarks:
+    if name not in benchmarks:
+        print("Unknown benchmark {}".format(name))
+        sys.exit(1)
+
+baseline = {}
+if os.path.exists(args.baseline):
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)["results"]
+
+results = {}
+failed = False
+print("\x1b[4m{: <20}\x1b[0m \x1b[4m{: <14}\x1b[0m \x1b[4m{: <10}\x1b[0m \x1b[4m{: <14}\x1b[0m \x1b[4m{: <6}\x1b[0m".format("Benchmark", "us/op", "MB/s", "Baseline us/op", "Result"))
+for name, function in benchmarks.items():
+    if args.benchmarks and name not in args.benchmarks:
+        continue
+    result = function(args.budget)
+    results[name] = result
+    status = ""
+    reference = ""
+    if name in baseline:
+        reference = "{:.2f}".format(baseline[name]["us_per_op"])
+        if result["us_per_op"] > baseline[name]["us_per_op"] * (1 + args.threshold):
+            status = "FAIL"
+            failed = True
+        else:
+            status = "ok"
+    if "limit_us" in result and result["us_per_op"] > result["limit_us"]:
+        status = "FAIL"
+        failed = True
+    if "error" in result:
+        status = "FAIL ({})".format(result["error"])
+        failed = True
+    throughput = "{:.2f}".format(result["mb_per_s"]) if "mb_per_s" in result else ""
+    print("{: <20} {: <14.2f} {: <10} {: <14} {: <6}".format(name, result["us_per_op"], throughput, reference, status))
+
+if args.save:
+    if args.benchmarks:
+        baseline.update(results)
+        results = baseline
+    with open(args.baseline, "w") as f:
+        json.dump({"platform": platform.platform(), "python": platform.python_version(), "results": results}, f, indent=4)
+    print("Baseline stored in {}".format(args.baseline))
+elif failed:
+    print("Performance regression detected (threshold {:.0%})".format(args.threshold))
+    sys.exit(1)
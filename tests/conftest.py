@@ -0,0 +1,25 @@
+# Tests run the host side against the simulated badge of webusb_sim.py
+#
+# The tools are modules in the root of the repository, which is added to the
+# module search path so the tests can be run from any directory.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def connect():
+    """
+    Returns a function opening a Badge on a simulated device and starting a session
+    """
+    from webusb import Badge
+
+    def connect(device):
+        badge = Badge(device)
+        badge.reconnect_timeout = 0 # Disconnects are reported to the test instead of waiting for the badge
+        assert badge.begin()
+        return badge
+    return connect
@@ -0,0 +1,53 @@
+import io
+import json
+
+from badge_batch import Batch, parse
+from webusb_sim import SimulatedDevice, MemoryFilesystem
+
+def run(connect, lines):
+    device = SimulatedDevice(MemoryFilesystem())
+    device.filesystem.write("/internal/hello.txt", b"Hello")
+    badge = connect(device)
+    output = io.StringIO()
+    success = Batch(badge, output).run(parse(lines))
+    return success, [json.loads(line) for line in output.getvalue().splitlines()], device
+
+def test_batch_runs_all_operations(connect, tmp_path):
+    local = tmp_path / "hello.txt"
+    (success, results, device) = run(connect, [
+        "mkdir /internal/demo",
+        "pull /internal/hello.txt {}".format(local),
+        "exists /internal/hello.txt",
+        "nvs-write system name string Badge",
+        "nvs-read system name string",
+    ])
+    assert success
+    assert [result["status"] for result in results] == ["ok"] * 5
+    assert results[2]["result"] is True
+    assert results[4]["result"] == "Badge"
+    assert local.read_bytes() == b"Hello"
+    assert device.filesystem.exists("/internal/demo")
+
+def test_failed_local_write_is_reported(connect, tmp_path):
+    (success, results, device) = run(connect, [
+        "pull /internal/hello.txt {}".format(tmp_path / "missing" / "hello.txt"),
+        "exists /internal/hello.txt",
+    ])
+    assert not success
+    assert results[0]["status"] == "failed"
+    assert "error" in results[0]
+    assert results[1]["status"] == "ok"
+
+def test_overlong_nvs_key_is_invalid(connect):
+    (success, results, device) = run(connect, [
+        "nvs-read {} name string".format("n" * 300),
+        "nvs-write system {} string value".format("k" * 300),
+        "exists /internal/hello.txt",
+    ])
+    assert not success
+    assert [result["status"] for result in results] == ["invalid", "invalid", "ok"]
+
+def test_operations_after_app_run_are_invalid():
+    operations = parse(["app-run demo", "mkdir /internal/demo", "# comment", "rm /internal/demo"])
+    assert "error" not in operations[0]
+    assert [operation["line"] for operation in operations if "error" in operation] == [2, 4]
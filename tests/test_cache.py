@@ -0,0 +1,99 @@
+import hashlib
+import os
+
+from badge import pull_tree
+from webusb_appcache import AppCache
+from webusb_pullcache import PullCache
+from webusb_sim import SimulatedDevice, MemoryFilesystem
+
+class CountingDevice(SimulatedDevice):
+    """
+    Simulated badge counting the files opened for reading
+    """
+    def __init__(self, **kwargs):
+        super().__init__(MemoryFilesystem(), **kwargs)
+        self.opened = []
+
+    def _handle_fsfr(self, payload):
+        self.opened.append(payload.decode("ascii"))
+        return super()._handle_fsfr(payload)
+
+def logs_device(**kwargs):
+    device = CountingDevice(**kwargs)
+    device.filesystem.create_directory("/internal/logs")
+    device.filesystem.write("/internal/logs/a.txt", b"a" * 1000)
+    device.filesystem.write("/internal/logs/b.txt", b"b" * 2000)
+    return device
+
+def test_pull_reads_only_changed_files(connect, tmp_path):
+    device = logs_device()
+    badge = connect(device)
+    cache = PullCache(str(tmp_path / "cache"))
+    assert pull_tree(badge, "/internal/logs", str(tmp_path / "first"), cache) == 0
+    assert sorted(device.opened) == ["/internal/logs/a.txt", "/internal/logs/b.txt"]
+
+    device.opened = []
+    device.filesystem.write("/internal/logs/b.txt", b"c" * 3000)
+    cache = PullCache(str(tmp_path / "cache"))
+    assert pull_tree(badge, "/internal/logs", str(tmp_path / "second"), cache) == 0
+    assert device.opened == ["/internal/logs/b.txt"]
+    assert (tmp_path / "second" / "a.txt").read_bytes() == b"a" * 1000
+    assert (tmp_path / "second" / "b.txt").read_bytes() == b"c" * 3000
+
+def test_pull_cache_is_kept_per_badge(connect, tmp_path):
+    first = logs_device(serial="BADGE0001")
+    second = logs_device(serial="BADGE0002")
+    # Same path, size and modification time, different content
+    second.filesystem.files["/internal/logs/a.txt"] = (b"z" * 1000, first.filesystem.files["/internal/logs/a.txt"][1])
+    cache = PullCache(str(tmp_path / "cache"))
+    assert pull_tree(connect(first), "/internal/logs", str(tmp_path / "first"), cache) == 0
+    assert pull_tree(connect(second), "/internal/logs", str(tmp_path / "second"), cache) == 0
+    assert sorted(second.opened) == ["/internal/logs/a.txt", "/internal/logs/b.txt"]
+    assert (tmp_path / "second" / "a.txt").read_bytes() == b"z" * 1000
+
+def test_pull_cache_checks_size_and_modification_time(tmp_path):
+    cache = PullCache(str(tmp_path))
+    cache.put("BADGE0001", "/internal/a.txt", {"size": 3, "modified": 100}, b"abc")
+    assert cache.get("BADGE0001", "/internal/a.txt", {"size": 3, "modified": 100}) == b"abc"
+    assert cache.get("BADGE0001", "/internal/a.txt", {"size": 3, "modified": 101}) is None
+    assert cache.get("BADGE0001", "/internal/a.txt", {"size": 4, "modified": 100}) is None
+    # Without a modification time changes can't be detected, nothing is cached
+    cache.put("BADGE0001", "/internal/b.txt", {"size": 3, "modified": 0}, b"abc")
+    assert cache.get("BADGE0001", "/internal/b.txt", {"size": 3, "modified": 0}) is None
+
+def test_pull_cache_evicts_least_recently_used(tmp_path):
+    cache = PullCache(str(tmp_path), 2500)
+    stat = {"size": 1000, "modified": 100}
+    cache.put("BADGE0001", "/internal/a.txt", stat, b"a" * 1000)
+    cache.put("BADGE0001", "/internal/b.txt", stat, b"b" * 1000)
+    cache.entries[cache.key("BADGE0001", "/internal/a.txt")]["used"] += 10 # Used after b.txt
+    cache.put("BADGE0001", "/internal/c.txt", stat, b"c" * 1000)
+    assert cache.get("BADGE0001", "/internal/b.txt", stat) is None
+    assert cache.get("BADGE0001", "/internal/a.txt", stat) == b"a" * 1000
+    assert cache.total_size() <= 2500
+    cache.save()
+    assert len([name for name in os.listdir(str(tmp_path)) if name != "index.json"]) == 2
+
+def app(name, data):
+    return {"name": name, "title": name, "version": 1, "size": len(data)}
+
+def test_app_cache_stores_binary_once(tmp_path):
+    data = os.urandom(1000)
+    cache = AppCache(str(tmp_path))
+    cache.put(app(b"first", data), data)
+    cache.put(app(b"second", data), data)
+    cache.save()
+    cache = AppCache(str(tmp_path))
+    assert cache.get(app(b"first", data)) == data
+    assert cache.get(app(b"second", data)) == data
+    assert list(cache.entries) == [hashlib.sha256(data).hexdigest()]
+
+def test_app_cache_drops_damaged_binary(tmp_path):
+    data = os.urandom(1000)
+    cache = AppCache(str(tmp_path))
+    cache.put(app(b"demo", data), data)
+    with open(cache.content_file(hashlib.sha256(data).hexdigest()), "r+b") as f:
+        f.write(b"damaged")
+    assert cache.get(app(b"demo", data)) is None
+    assert len(cache.entries) == 0
+    assert len(cache.apps) == 0
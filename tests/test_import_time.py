@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+BUDGET_US = 50000 # Same default as protocol_bench.py --import-budget
+
+def import_time():
+    # Best of a few runs, the first one pays for reading the files from disk
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    best = None
+    modules = set()
+    for attempt in range(5):
+        output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import badge, webusb"], cwd=directory, capture_output=True, text=True, check=True).stderr
+        total = 0
+        for line in output.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            (own, cumulative, name) = line[len("import time:"):].split("|")
+            modules.add(name.strip())
+            if name.strip() in ["badge", "webusb"]:
+                total += int(cumulative)
+        best = total if best is None else min(best, total)
+    return best, modules
+
+def test_import_time_within_budget():
+    (best, modules) = import_time()
+    assert "usb" not in modules, "pyusb should only be imported once a badge is used"
+    assert best <= BUDGET_US, "importing badge and webusb took {} µs".format(best)
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from badge_queue import QueueRunner, TransferQueue, STREAM_LIMIT, push_job
+from webusb import BadgeDisconnected
+from webusb_sim import SimulatedDevice, MemoryFilesystem
+
+class WritesDevice(SimulatedDevice):
+    """
+    Simulated badge recording the files opened for writing
+    """
+    def __init__(self, **kwargs):
+        super().__init__(MemoryFilesystem(), **kwargs)
+        self.opened = []
+
+    def _handle_fsfw(self, payload):
+        self.opened.append(payload.decode("ascii"))
+        return super()._handle_fsfw(payload)
+
+class UnpluggingRunner(QueueRunner):
+    """
+    Runner unplugging the badge after the first file of a job is done
+    """
+    def __init__(self, queue, device):
+        super().__init__(queue, save_interval=0)
+        self.device = device
+
+    def finished(self, job, item, success, description):
+        super().finished(job, item, success, description)
+        if success and self.device.connected:
+            self.device.unplug()
+
+def test_interrupted_push_continues_with_unfinished_files(connect, tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    contents = {}
+    for name in ["a.bin", "b.bin", "c.bin"]:
+        # Larger than STREAM_LIMIT, so the files are pushed one at a time
+        contents[name] = os.urandom(STREAM_LIMIT + 1000)
+        (source / name).write_bytes(contents[name])
+    queue = TransferQueue(str(tmp_path / "queue.json"))
+    queue.add(push_job(str(source), "/internal/target", "SIMULATED0001"))
+
+    device = WritesDevice()
+    runner = UnpluggingRunner(queue, device)
+    with pytest.raises(BadgeDisconnected):
+        runner.run_job(connect(device), queue.runnable(device.serial_number)[0])
+    # The state is stored in the queue file, a new runner continues from it
+    queue = TransferQueue(str(tmp_path / "queue.json"))
+    job = queue.runnable(device.serial_number)[0]
+    assert job["state"] == "interrupted"
+    assert len([item for item in job["files"] if item["done"]]) == 1
+    first = device.opened[0]
+
+    device.plug()
+    device.opened = []
+    QueueRunner(queue).run_job(connect(device), job)
+    queue.load()
+    assert queue.jobs[0]["state"] == "done"
+    assert sorted(device.opened) == sorted(name for name in ["/internal/target/a.bin", "/internal/target/b.bin", "/internal/target/c.bin"] if name != first)
+    for name, data in contents.items():
+        assert device.filesystem.read("/internal/target/" + name) == data
@@ -0,0 +1,102 @@
+import os
+import struct
+
+from webusb_sim import SimulatedDevice, MemoryFilesystem, ERR_INVALID
+
+class ScriptedDevice(SimulatedDevice):
+    """
+    Simulated badge failing CHNK writes as listed in faults, one entry per CHNK write:
+    "reject" answers with an error, "short" writes half of the chunk, "lost" writes the chunk without acknowledging it
+    """
+    def __init__(self, faults = [], **kwargs):
+        super().__init__(MemoryFilesystem(), **kwargs)
+        self.faults = list(faults)
+        self.writes = [] # Size of every CHNK write
+        self.reads = 0 # Number of CHNK reads
+        self.opened = 0 # Number of files opened for writing
+        self.silent = False
+
+    def _handle_fsfw(self, payload):
+        self.opened += 1
+        return super()._handle_fsfw(payload)
+
+    def _handle_appw(self, payload):
+        self.opened += 1
+        return super()._handle_appw(payload)
+
+    def _handle_chnk(self, payload):
+        if self.open_file is None or self.open_file["mode"] == "read":
+            self.reads += 1
+            return super()._handle_chnk(payload)
+        self.writes.append(len(payload))
+        fault = self.faults.pop(0) if len(self.faults) > 0 else None
+        if fault == "reject":
+            return (ERR_INVALID, b"")
+        if fault == "short":
+            self.open_file["data"] += payload[:len(payload) // 2]
+            return struct.pack("<I", len(payload) // 2)
+        self.silent = fault == "lost"
+        return super()._handle_chnk(payload)
+
+    def _send(self, identifier, command, payload = b""):
+        if self.silent:
+            self.silent = False
+            return
+        super()._send(identifier, command, payload)
+
+DATA = os.urandom(20000) # Sent as chunks of 8192, 8192 and 3616 bytes
+
+def write(connect, faults):
+    device = ScriptedDevice(faults)
+    badge = connect(device)
+    assert badge.fs_write_file(b"/internal/data.bin", DATA)
+    assert device.filesystem.read("/internal/data.bin") == DATA
+    return device
+
+def test_write_without_faults(connect):
+    device = write(connect, [])
+    assert device.writes == [8192, 8192, 3616]
+    assert device.opened == 1
+
+def test_rejected_chunk_is_sent_again(connect):
+    device = write(connect, [None, "reject"])
+    assert device.writes == [8192, 8192, 8192, 3616]
+    assert device.opened == 1
+
+def test_short_write_sends_remainder(connect):
+    device = write(connect, [None, "short"])
+    assert device.writes == [8192, 8192, 4096, 3616]
+    assert device.opened == 1
+
+def test_lost_acknowledgement_restarts_file(connect):
+    # The amount written is unknown and the firmware can't seek or append, the file is sent again from the start
+    device = write(connect, [None, "lost"])
+    assert device.writes == [8192, 8192, 8192, 8192, 3616]
+    assert device.opened == 2
+
+def test_lost_acknowledgement_restarts_app(connect):
+    device = ScriptedDevice([None, None, "lost"])
+    badge = connect(device)
+    assert badge.app_write(b"demo", b"Demo", 1, DATA)
+    assert device.apps[b"demo"]["data"] == DATA
+    assert device.opened == 2
+
+def test_write_gives_up_after_retries(connect):
+    device = ScriptedDevice(["reject"] * 10)
+    badge = connect(device)
+    assert not badge.fs_write_file(b"/internal/data.bin", DATA)
+    assert device.writes == [8192] * (badge.max_retries + 1)
+
+def test_read_files_sends_only_needed_reads(connect):
+    device = ScriptedDevice()
+    contents = {"/internal/empty": b"", "/internal/tiny": b"x" * 10, "/internal/chunk": os.urandom(4096), "/internal/large": os.urandom(10000)}
+    for name, data in contents.items():
+        device.filesystem.write(name, data)
+    badge = connect(device)
+    files = [(name.encode("ascii"), len(data)) for name, data in contents.items()]
+    received = {}
+    results = badge.fs_read_files(files, lambda index, data: received.__setitem__(index, data))
+    assert all(results)
+    assert [received[index] for index in range(len(files))] == list(contents.values())
+    # Every file needs the reads returning its data and one more returning no data
+    assert device.reads == sum(-(-len(data) // device.chunk_size) + 1 for data in contents.values())
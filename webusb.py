@@ -1,13 +1,185 @@
 #!/usr/bin/env python3
 
 import os
-import usb.core
-import usb.util
 import binascii
+import errno
+import functools
+import io
+import queue
 import time
 import sys
 import struct
+import atexit
+import threading
 from datetime import datetime
+from webusb_metrics import Metrics, export
+import webusb_trace as trace
+from webusb_trace import traced
+
+def printProgressBar(iteration, total, prefix = '', suffix = '', decimals = 1, length = 50, fill = '█', printEnd = "\r"):
+    """
+    Call in a loop to create terminal progress bar
+    @params:
+        iteration   - Required  : current iteration (Int)
+        total       - Required  : total iterations (Int)
+        prefix      - Optional  : prefix string (Str)
+        suffix      - Optional  : suffix string (Str)
+        decimals    - Optional  : positive number of decimals in percent complete (Int)
+        length      - Optional  : character length of bar (Int)
+        fill        - Optional  : bar fill character (Str)
+        printEnd    - Optional  : end character (e.g. "\r", "\r\n") (Str)
+    """
+    percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
+    filledLength = int(length * iteration // total)
+    bar = fill * filledLength + '-' * (length - filledLength)
+    print(f'\r{prefix} |{bar}| {percent}% {suffix}', end = printEnd)
+    # Print New Line on Complete
+    if iteration == total and printEnd != "\r\n":
+        print()
+
+class TerminalProgress:
+    """
+    Progress callback rendering progress events as a terminal progress bar, at most once per interval seconds
+    """
+    titles = {
+        "connect": "Connecting...",
+        "write": "Writing...",
+        "read": "Reading...",
+    }
+
+    def __init__(self, interval = 0.1):
+        self.interval = interval
+        self.last = 0
+
+    def __call__(self, event):
+        now = time.monotonic()
+        if not event["done"] and now - self.last < self.interval:
+            return
+        self.last = now
+        title = self.titles.get(event["operation"], event["operation"])
+        if event["operation"] == "connect":
+            printProgressBar(event["position"], event["total"], title, '', 0)
+            return
+        suffix = '{} bytes'.format(event["position"])
+        if event["total"]:
+            suffix = '{} of {} bytes'.format(event["position"], event["total"])
+        suffix += ', {} KB/s'.format(round(event["rate"] / 1024, 1))
+        if event["eta"] is not None and not event["done"]:
+            suffix += ', {} s left'.format(int(event["eta"]))
+        if event["total"]:
+            printProgressBar(event["position"], event["total"], title, suffix + '   ', 0)
+        elif event["done"]:
+            printProgressBar(100, 100, title, suffix + '   ', 0)
+        else:
+            printProgressBar(0, 100, title, suffix + '   ', 0)
+
+class BadgeDisconnected(IOError):
+    """
+    Raised when the badge was unplugged or reset during an exchange
+    """
+
+def device_gone(error):
+    # libusb reports LIBUSB_ERROR_NO_DEVICE, pyusb translates it to ENODEV
+    return getattr(error, "errno", None) == errno.ENODEV or getattr(error, "backend_error_code", None) == -4
+
+def usb_backend():
+    if os.name == 'nt':
+        from usb.backend import libusb1
+        return libusb1.get_backend(find_library=lambda x: os.path.dirname(__file__) + "\\libusb-1.0.dll")
+    return None
+
+def device_serial(device):
+    """
+    Returns the USB serial number of a device, None if it can't be read (for example without access to the device)
+    """
+    try:
+        return device.serial_number
+    except Exception:
+        return None
+
+def device_key(device):
+    # The bus and address identify a device until it is unplugged, a badge that comes back gets a new address
+    return (getattr(device, "bus", None), getattr(device, "address", None))
+
+def find_devices():
+    """
+    Returns the pyusb devices of all connected badges
+    """
+    import usb.core
+    with trace.span("USB enumeration"):
+        return list(usb.core.find(find_all=True, idVendor=0x16d0, idProduct=0x0f9a, backend=usb_backend()))
+
+def find_badges():
+    """
+    Returns a list of (serial number, device) tuples for all connected badges
+    """
+    return [(device_serial(device), device) for device in find_devices()]
+
+def resumable(function):
+    """
+    Decorator running a Badge method again after reconnecting when the badge disappeared during the call (see Badge.reconnect)
+    Only the outermost resumable call is repeated, the method has to be safe to repeat from the start
+    """
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if self.resuming:
+            return function(self, *args, **kwargs)
+        self.resuming = True
+        try:
+            for attempt in range(self.max_retries):
+                try:
+                    return function(self, *args, **kwargs)
+                except BadgeDisconnected:
+                    if attempt == self.max_retries - 1 or not self.reconnect():
+                        raise
+        finally:
+            self.resuming = False
+    return wrapper
+
+class ChunkPrefetcher:
+    """
+    Reads chunks from a file and computes their headers on a worker thread while the previous chunks are on the wire
+    At most depth prepared chunks are buffered, the worker waits until the sender takes the next one
+    """
+    def __init__(self, source, size = 8192, depth = 4):
+        self.source = source
+        self.size = size
+        self.queue = queue.Queue(depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker(self):
+        try:
+            while True:
+                data = self.source.read(self.size)
+                header = Badge.frame_header(b"CHNK", data) if data else None
+                if not self.put((data, header)) or not data:
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def get(self):
+        """
+        Returns the next (data, header) tuple, data is empty at the end of the file. Raises IOError when the file can't be read
+        """
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise IOError(item)
+        return item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
 
 class Badge:
     # Defined in webusb_task.c of the RP2040 firmware
@@ -26,17 +198,69 @@ class Badge:
     
     MAGIC = 0xFEEDF00D
 
-    def __init__(self):
-        if os.name == 'nt':
-            from usb.backend import libusb1
-            be = libusb1.get_backend(find_library=lambda x: os.path.dirname(__file__) + "\\libusb-1.0.dll")
-            self.device = usb.core.find(idVendor=0x16d0, idProduct=0x0f9a, backend=be)
-        else:
-            self.device = usb.core.find(idVendor=0x16d0, idProduct=0x0f9a)
+    # Bytes returned for a CHNK read by the ESP32 firmware, assumed until a full chunk was received
+    READ_CHUNK_SIZE = 4096
+
+    def __init__(self, device = None, capture = None, progress = None, serial = None, wait = None):
+        # Imported here to keep starting the tools fast, pyusb takes a while to import
+        import usb.core
+
+        if device is None and os.environ.get("BADGE_REPLAY"):
+            from webusb_capture import ReplayDevice
+            device = ReplayDevice(os.environ["BADGE_REPLAY"], float(os.environ.get("BADGE_REPLAY_SPEED", "1")))
 
-        if self.device is None:
+        if device is None and serial is not None:
+            device = next((device for (number, device) in find_badges() if number == serial), None)
+        elif device is None:
+            with trace.span("USB enumeration"):
+                device = usb.core.find(idVendor=0x16d0, idProduct=0x0f9a, backend=usb_backend())
+
+        wait = float(os.environ.get("BADGE_WAIT", "0")) if wait is None else wait
+        if device is None and wait > 0:
+            from webusb_hotplug import monitor
+            print("Waiting for a badge to be connected")
+            found = monitor().wait_for(lambda number: serial is None or number == serial, wait)
+            device = found[1] if found else None
+
+        if device is None:
             raise ValueError("Badge not found")
 
+        self.reconnect_timeout = float(os.environ.get("BADGE_RECONNECT", "10")) # Seconds to wait for the badge to come back after it disappeared, 0 to fail at once
+        self.gone = threading.Event() # Set by the hot-plug monitor when the badge is unplugged, see watch
+        self.watching = False
+        self.resuming = False # Set while a resumable operation runs, see resumable
+        self.open_device(device, capture or os.environ.get("BADGE_CAPTURE"))
+
+        self.printGarbage = False
+        self.max_retries = 3
+        self.progress = progress # Called with progress events, see report_progress
+
+        self.metrics = Metrics()
+        self.pending = []
+        self.pipeline_depth = 8
+        self.pipeline_bytes = 32768
+        self.prefetch_depth = 4 # Number of chunks prepared ahead by ChunkPrefetcher while writing
+        self.read_chunk_size = None # Largest chunk returned by the badge that wasn't the last of its file, used to estimate the number of reads for a file
+        self.lock = threading.RLock() # Held by code sharing the badge between threads, around every exchange
+        if os.environ.get("BADGE_METRICS") or os.environ.get("BADGE_METRICS_PROM"):
+            atexit.register(export, self.metrics)
+
+    def open_device(self, device, capture = None):
+        """
+        Opens the WebUSB interface of the ESP32 on device, a new session has to be started with begin
+        @params:
+            device      - Required  : pyusb device (or a simulated or replayed device)
+            capture     - Optional  : file to record the USB traffic in, see webusb_capture.py (Str)
+        """
+        import usb.util
+
+        self.serial = device_serial(device)
+        self.device_key = device_key(device)
+        self.device = device
+        if capture:
+            from webusb_capture import CaptureDevice
+            self.device = CaptureDevice(self.device, capture)
+
         configuration = self.device.get_active_configuration()
 
         self.webusb_esp32 = configuration[(4,0)]
@@ -49,62 +273,129 @@ class Badge:
         
         self.rx_data = bytes([])
         self.packets = []
+        self.pending = []
+        self.gone.clear()
 
-        self.printGarbage = False
+    def watch(self):
+        """
+        Has the hot-plug monitor report when the badge is unplugged, so operations waiting for the badge fail at once instead of timing out
+        """
+        if self.watching:
+            return
+        from webusb_hotplug import monitor
+        monitor().add_listener(self.device_event)
+        self.watching = True
+
+    def device_event(self, event, key, serial, device):
+        if event == "left" and key == self.device_key:
+            self.gone.set()
+
+    def reconnect(self):
+        """
+        Waits up to reconnect_timeout seconds for the badge with the same serial number to come back after it disappeared (unplugged or reset),
+        opens it again and starts a new session. Returns True on success. The USB traffic is no longer captured after reconnecting
+        """
+        if self.reconnect_timeout <= 0 or self.serial is None:
+            return False
+        from webusb_hotplug import monitor
+        print("Badge disconnected, waiting {:g} seconds for it to come back".format(self.reconnect_timeout))
+        deadline = time.monotonic() + self.reconnect_timeout
+        stale = [self.device_key] # A badge that comes back is enumerated again, under a new address
+        while True:
+            found = monitor().wait_for(lambda serial: serial == self.serial, deadline - time.monotonic(), stale)
+            if found is None:
+                print("Badge didn't come back")
+                return False
+            stale.append(device_key(found[1]))
+            try:
+                self.open_device(found[1])
+                if self.begin():
+                    self.watch()
+                    print("Badge reconnected")
+                    return True
+            except Exception as e:
+                print("Failed to reconnect:", e)
 
     def printProgressBar(self, iteration, total, prefix = '', suffix = '', decimals = 1, length = 50, fill = '█', printEnd = "\r"):
+        printProgressBar(iteration, total, prefix, suffix, decimals, length, fill, printEnd)
+
+    def report_progress(self, operation, position, total, start, done = False):
         """
-        Call in a loop to create terminal progress bar
+        Sends a progress event to the progress callback
         @params:
-            iteration   - Required  : current iteration (Int)
-            total       - Required  : total iterations (Int)
-            prefix      - Optional  : prefix string (Str)
-            suffix      - Optional  : suffix string (Str)
-            decimals    - Optional  : positive number of decimals in percent complete (Int)
-            length      - Optional  : character length of bar (Int)
-            fill        - Optional  : bar fill character (Str)
-            printEnd    - Optional  : end character (e.g. "\r", "\r\n") (Str)
-        """
-        percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
-        filledLength = int(length * iteration // total)
-        bar = fill * filledLength + '-' * (length - filledLength)
-        print(f'\r{prefix} |{bar}| {percent}% {suffix}', end = printEnd)
-        # Print New Line on Complete
-        if iteration == total and printEnd != "\r\n":
-            print()
+            operation   - Required  : "connect", "write" or "read" (Str)
+            position    - Required  : bytes (or steps) done so far (Int)
+            total       - Required  : total number of bytes (or steps), None if unknown (Int)
+            start       - Required  : time.monotonic() at the start of the operation (Float)
+            done        - Optional  : True for the last event of the operation (Bool)
+        """
+        if self.progress is None:
+            return
+        elapsed = time.monotonic() - start
+        rate = position / elapsed if elapsed > 0 else 0
+        eta = None
+        if total and rate > 0:
+            eta = (total - position) / rate
+        self.progress({
+            "operation": operation,
+            "position": position,
+            "total": total,
+            "rate": rate,
+            "eta": eta,
+            "done": done,
+        })
 
+    @traced("begin")
     def begin(self):
         if not self.sync():
             self.start_webusb()
+            start = time.monotonic()
             for i in range(20):
                 if i == 10:
                     self.reset()
                     self.start_webusb()
                     time.sleep(0.5)
-                self.printProgressBar(i, 20, 'Connecting...', '', 0)
+                self.report_progress("connect", i, 20, start)
                 if self.sync():
-                    self.printProgressBar(20, 20, 'Connecting...', '', 0)
+                    self.report_progress("connect", 20, 20, start, True)
                     return True
                 time.sleep(0.1)
             return False
         return True
 
-    def send_packet(self, command = b"XXXX", payload = bytes([]), flush = True):
+    @classmethod
+    def frame_header(cls, command, payload):
+        return struct.pack("<IIIII", cls.MAGIC, 0x00000000, int.from_bytes(command, "little"), len(payload), binascii.crc32(payload))
+
+    def send_packet(self, command = b"XXXX", payload = bytes([]), flush = True, header = None):
         if flush:
             self.receive_packets(1)
             self.packets = []
-        self.esp32_ep_out.write(struct.pack("<IIIII", self.MAGIC, 0x00000000, int.from_bytes(command, "little"), len(payload), binascii.crc32(payload)))
-        if len(payload) > 0:
-            self.esp32_ep_out.write(payload)
+            self.pending = []
+        self.pending.append((command, time.perf_counter(), 20 + len(payload)))
+        if self.gone.is_set():
+            raise BadgeDisconnected("Badge disconnected")
+        try:
+            self.esp32_ep_out.write(header or self.frame_header(command, payload))
+            if len(payload) > 0:
+                self.esp32_ep_out.write(payload)
+        except Exception as e:
+            if device_gone(e):
+                raise BadgeDisconnected("Badge disconnected") from e
+            raise
 
     def receive_data(self, timeout = 100):
         while timeout > 0:
+            if self.gone.is_set():
+                raise BadgeDisconnected("Badge disconnected")
             try:
                 new_data = bytes(self.esp32_ep_in.read(self.esp32_ep_in.wMaxPacketSize, 5))
                 self.rx_data += new_data
                 if len(new_data) > 0:
                     timeout = 5
             except Exception as e:
+                if device_gone(e):
+                    raise BadgeDisconnected("Badge disconnected") from e
                 timeout-=1
 
     def receive_packets(self, timeout = 100):
@@ -134,22 +425,30 @@ class Badge:
             if payload_crc != payload_crc_check:
                 #print("payload", payload)
                 print("Payload CRC doesn't match {:08X} {:08X}".format(payload_crc, payload_crc_check))
-                #continue
+                self.metrics.crc_error()
+                continue
             self.packets.append({
                 "identifier": identifier,
                 "command": command_ascii,
                 "payload": payload
             })
+        if len(garbage) > 0:
+            self.metrics.garbage(len(garbage))
         if len(garbage) > 0 and self.printGarbage:
             print("Garbage:", garbage, garbage.decode("ascii", "ignore"))
         return True
     
     def receive_packet(self, timeout = 100):
-        self.receive_packets(timeout)
+        if len(self.packets) < 1: # Responses to pipelined requests could have arrived already
+            self.receive_packets(timeout)
         packet = None
         if len(self.packets) > 0:
             packet = self.packets[0]
             self.packets = self.packets[1:]
+        if len(self.pending) > 0:
+            (command, start, sent) = self.pending.pop(0)
+            received = 20 + len(packet["payload"]) if packet else 0
+            self.metrics.observe(command, time.perf_counter() - start, sent, received, packet is not None and packet["command"] == command)
         return packet
     
     def peek_packet(self, timeout = 100):
@@ -159,15 +458,81 @@ class Badge:
             packet = self.packets[0]
         return packet
     
+    def pipeline(self, requests, callback = None, skip = None):
+        """
+        Sends requests without waiting for the responses to earlier requests, returns the responses in order
+        @params:
+            requests    - Required  : list of (command, payload, timeout) tuples (List)
+            callback    - Optional  : function called with the index and the response of every request as soon as it arrives
+            skip        - Optional  : function called with the index of a request right before it is sent, returns True to leave it out. Its response is None and the callback isn't called for it
+        """
+        responses = []
+        sent = 0
+        skipped = set()
+        flush = True
+        with trace.span("pipeline", requests=len(requests)):
+            while len(responses) < len(requests):
+                while sent < len(requests):
+                    if skip is not None and skip(sent):
+                        skipped.add(sent)
+                        sent += 1
+                        continue
+                    # Limit the number of outstanding requests and bytes, the badge only buffers a few of them
+                    outstanding = [request for index, request in enumerate(requests[len(responses):sent + 1], len(responses)) if index not in skipped]
+                    if sent > len(responses) and (len(outstanding) > self.pipeline_depth or sum(len(request[1]) for request in outstanding) > self.pipeline_bytes):
+                        break
+                    (command, payload, timeout) = requests[sent]
+                    self.send_packet(command, payload, flush)
+                    flush = False
+                    sent += 1
+                if len(responses) in skipped:
+                    responses.append(None)
+                    continue
+                (command, payload, timeout) = requests[len(responses)]
+                response = self.receive_packet(timeout)
+                if not response or not (response["command"] == command or response["command"].startswith(b"ERR")):
+                    # A response got lost, the responses to the remaining requests can't be matched anymore
+                    missing = len(requests) - len(responses)
+                    responses += [None] * missing
+                    if callback:
+                        for index in range(len(responses) - missing, len(responses)):
+                            callback(index, None)
+                    self.sync()
+                    break
+                responses.append(response)
+                if callback:
+                    callback(len(responses) - 1, response)
+        return responses
+
+    def response_payload(self, command, response):
+        if not response:
+            print("No response to " + command.decode("ascii"))
+            return None
+        if not response["command"] == command:
+            print("No " + command.decode("ascii"), response["command"])
+            return None
+        return response["payload"]
+
+    def response_bool(self, command, response):
+        payload = self.response_payload(command, response)
+        if payload is None:
+            return False
+        if not len(payload) == 1:
+            print("Wrong payload length")
+            return False
+        return True if payload[0] else False
+
+    @traced("sync")
     def sync(self):
         self.receive_packets()
         self.packets = []
+        self.rx_data = bytes([]) # Drop incomplete packets, the rest of their data is never going to arrive
         self.send_packet(b"SYNC")
         response = self.receive_packet()
+        while response and response["command"] != b"SYNC": # Skip late responses to earlier requests
+            response = self.receive_packet()
         if not response:
             return False
-        if not response["command"] == b"SYNC":
-            return False
         if  len(response["payload"]) != 2 or (struct.unpack("<H", response["payload"])[0] < 0x0001):
             print("Please update your MCH2022 badge to firmware version 2.0.1 or newer. This firmware is currently available on the experimental update channel only.")
             print("To install go to Settings > Install experimental firmware on your badge.")
@@ -179,19 +544,23 @@ class Badge:
 
     def ping(self, payload):
         self.send_packet(b"PING", payload)
-        response = self.receive_packet()
+        return self.check_ping(payload, self.receive_packet())
+
+    def check_ping(self, payload, response):
         if not response:
             return False
         if not response["command"] == b"PING":
             print("No PING", response["command"])
             return False
         if not response["payload"] == payload:
-            print("Payload mismatch", payload, response["payload"])
-            for i in range(len(payload)):
-                print(i, int(payload[i]), int(response["payload"][i]))
+            received = response["payload"]
+            differences = [i for i in range(min(len(payload), len(received))) if payload[i] != received[i]]
+            first = differences[0] if len(differences) > 0 else min(len(payload), len(received))
+            print("Payload mismatch: sent {} bytes, received {} bytes, {} bytes differ, first difference at offset {}".format(len(payload), len(received), len(differences), first))
             return False
         return True
 
+    @resumable
     def info(self):
         self.send_packet(b"INFO")
         response = self.receive_packet()
@@ -202,6 +571,7 @@ class Badge:
             return False
         return response["payload"].decode("ascii", "ignore")
     
+    @resumable
     def fs_list(self, payload):
         self.send_packet(b"FSLS", payload + b"\0")
         response = self.receive_packet()
@@ -212,10 +582,11 @@ class Badge:
             if not response["command"] == b"ERR5": # Failed to open directory
                 print("No FSLS", response["command"])
             return None
-        payload = response["payload"]
+        return self.parse_fs_list(response["payload"])
 
+    def parse_fs_list(self, payload):
         output = []
-        
+
         while len(payload) > 0:
             data = payload[:1 + 4]
             payload = payload[1 + 4:]
@@ -239,51 +610,21 @@ class Badge:
             output.append(item)
         return output
 
+    @resumable
     def fs_file_exists(self, name):
         self.send_packet(b"FSEX", name)
-        response = self.receive_packet()
-        if not response:
-            print("No response to FSEX")
-            return False
-        if not response["command"] == b"FSEX":
-            print("No FSEX", response["command"])
-            return False
-        payload = response["payload"]
-        if not len(payload) == 1:
-            print("Wrong payload length")
-            return False
-        return True if payload[0] else False
+        return self.response_bool(b"FSEX", self.receive_packet())
 
+    @resumable
     def fs_create_directory(self, name):
         self.send_packet(b"FSMD", name)
-        response = self.receive_packet()
-        if not response:
-            print("No response to FSMD")
-            return False
-        if not response["command"] == b"FSMD":
-            print("No FSMD", response["command"])
-            return False
-        payload = response["payload"]
-        if not len(payload) == 1:
-            print("Wrong payload length")
-            return False
-        return True if payload[0] else False
+        return self.response_bool(b"FSMD", self.receive_packet())
 
     def fs_remove(self, name):
         self.send_packet(b"FSRM", name)
-        response = self.receive_packet(10000)
-        if not response:
-            print("No response to FSRM")
-            return False
-        if not response["command"] == b"FSRM":
-            print("No FSRM", response["command"])
-            return False
-        payload = response["payload"]
-        if not len(payload) == 1:
-            print("Wrong payload length")
-            return False
-        return True if payload[0] else False
+        return self.response_bool(b"FSRM", self.receive_packet(10000))
 
+    @resumable
     def fs_state(self):
         self.send_packet(b"FSST")
         response = self.receive_packet()
@@ -309,76 +650,539 @@ class Badge:
                 "free": appfs_free
             }
         }
-    def fs_write_file(self, name, data):
-        self.send_packet(b"FSFW", name)
-        response = self.receive_packet()
+    def open_file(self, command, payload, timeout = 100):
+        with trace.span("open " + command.decode("ascii")):
+            self.send_packet(command, payload)
+            response = self.receive_packet(timeout)
         if not response:
-            print("No response FSFW")
+            print("No response " + command.decode("ascii"))
             return False
-        if not response["command"] == b"FSFW":
-            print("No FSFW", response["command"])
+        if not response["command"] == command:
+            print("No " + command.decode("ascii"), response["command"])
             return False
         payload = response["payload"]
-        if not payload[0]:
-            print("Failed to open file")
-            return False
+        return len(payload) > 0 and payload[0] != 0
+
+    def send_chunk(self, chunk, position, header = None):
+        """
+        Sends one chunk to the opened file, retrying rejected chunks and sending the remainder of short writes
+        Returns True when the chunk has been written, False on failure and None when the amount of data written is unknown
+        @params:
+            chunk       - Required  : data to write, at most 8192 bytes (Bytes)
+            position    - Required  : position of the chunk in the file, for tracing (Int)
+            header      - Optional  : header of the CHNK packet with the whole chunk, if it was prepared already (Bytes)
+        """
+        offset = 0
+        attempts = 0
+        while offset < len(chunk):
+            part = chunk[offset:]
+            with trace.span("CHNK write", position=position+offset, size=len(part)):
+                sent = self.fs_write_chunk(part, header if offset == 0 else None)
+            if sent == len(part):
+                return True
+            attempts += 1
+            if attempts > self.max_retries:
+                print("Failed to send data", sent, len(part))
+                return False
+            self.metrics.retry(b"CHNK")
+            trace.instant("retry", position=position+offset, sent=sent)
+            self.sync()
+            if sent is None:
+                # The badge rejected the chunk, nothing was written
+                continue
+            if sent is not False and sent < len(part):
+                # Short write, only send the part that was not written
+                offset += sent
+                continue
+            return None
+        return True
+
+    def data_size(self, data):
+        """
+        Returns the size of data given as bytes or as a seekable binary file
+        """
+        if hasattr(data, "read"):
+            try:
+                return os.fstat(data.fileno()).st_size
+            except OSError:
+                return data.seek(0, io.SEEK_END)
+        return len(data)
+
+    def write_data(self, data, reopen):
+        """
+        Sends data to the opened file in chunks
+        A rejected chunk is sent again and after a short write only the remainder is sent. A chunk whose acknowledgement is missing or invalid can't be recovered on its own: the amount written is unknown, the firmware has no command to seek or append and FSFW and APPW truncate or erase on open. The file is reopened and the data is sent again from the start, for APPW this erases the app again
+        The next chunks are read and their headers computed on a worker thread while the current chunk is sent (see ChunkPrefetcher)
+        @params:
+            data        - Required  : data to write, bytes or a seekable binary file (Bytes or File)
+            reopen      - Required  : function that opens the file again from the start, returns True on success
+        """
+        return self.run_steps(self.write_data_steps(data, reopen))
+
+    def write_data_steps(self, data, reopen):
+        """
+        Generator version of write_data, yields True after every chunk sent and returns the result
+        The file is closed when the generator is closed early, what has been written so far stays on the badge
+        """
+        source = data if hasattr(data, "read") else io.BytesIO(data)
         position = 0
+        total = self.data_size(data)
+        restarts = 0
+        start = time.monotonic()
+        source.seek(0)
+        prefetcher = ChunkPrefetcher(source, 8192, self.prefetch_depth)
+        try:
+            while position < total:
+                try:
+                    (chunk, header) = prefetcher.get()
+                except IOError as e:
+                    print("Failed to read data:", e)
+                    self.fs_close_file()
+                    return False
+                if len(chunk) < 1:
+                    print("Data ended early, was the file changed?")
+                    self.fs_close_file()
+                    return False
+                self.report_progress("write", position, total, start)
+                result = self.send_chunk(chunk, position, header)
+                if result:
+                    position += len(chunk)
+                    yield True
+                    continue
+                if result is False:
+                    self.fs_close_file()
+                    return False
+                # No valid acknowledgement, the amount of data written is unknown
+                # There is no command for seeking or appending, reopening truncates the file, so the whole file is sent again
+                restarts += 1
+                if restarts > self.max_retries:
+                    print("Failed to send data")
+                    self.fs_close_file()
+                    return False
+                if not reopen():
+                    print("Failed to reopen file")
+                    return False
+                prefetcher.close()
+                source.seek(0)
+                prefetcher = ChunkPrefetcher(source, 8192, self.prefetch_depth)
+                position = 0
+        except GeneratorExit:
+            self.fs_close_file()
+            raise
+        finally:
+            prefetcher.close()
+        self.fs_close_file()
+        self.report_progress("write", total, total, start, True)
+        return True
 
-        total = len(data)
+    def write_stream(self, chunks, total = None):
+        """
+        Sends data from an iterable of chunks of any size to the opened file, without keeping all of the data in memory
+        Failed chunks are retried, but unlike write_data the transfer can't be restarted from the start
+        @params:
+            chunks      - Required  : iterable of data to write (Iterable of Bytes)
+            total       - Optional  : total number of bytes, for progress reporting (Int)
+        """
+        return self.run_steps(self.write_stream_steps(chunks, total))
+
+    def run_steps(self, steps):
+        """
+        Runs a generator of steps (see write_stream_steps) to the end, returns its result
+        """
         while True:
-            chunk = data[position:position+8192]
-            if len(chunk) < 1:
-                break
-            self.printProgressBar(position, total, 'Writing...', '{} of {} bytes'.format(position, total), 0)
-            position += 8192
-            sent = self.fs_write_chunk(chunk)
-            if sent != len(chunk):
-                print("Failed to send data", sent, len(chunk))
-                self.fs_close_file()
-                return False
+            try:
+                next(steps)
+            except StopIteration as e:
+                return e.value
+
+    def write_stream_steps(self, chunks, total = None):
+        """
+        Generator version of write_stream, for interleaving a transfer with other requests (see webusb_scheduler.py)
+        Yields True after every chunk sent and False when chunks returned an empty chunk because no data is available yet, returns the result
+        """
+        position = 0
+        buffer = bytearray()
+        start = time.monotonic()
+        chunks = iter(chunks)
+        try:
+            while True:
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    if len(chunk) < 1:
+                        yield False
+                        continue
+                    buffer += chunk
+                while len(buffer) >= 8192 or (chunk is None and len(buffer) > 0):
+                    part = bytes(buffer[:8192])
+                    del buffer[:8192]
+                    self.report_progress("write", position, total, start)
+                    result = self.send_chunk(part, position)
+                    if not result:
+                        if result is None:
+                            print("Failed to send data, a stream can't be restarted")
+                        self.fs_close_file()
+                        return False
+                    position += len(part)
+                    yield True
+                if chunk is None:
+                    break
+        except (Exception, GeneratorExit):
+            # Reading the data failed or the transfer was cancelled, the file on the badge is left as far as it got
+            self.fs_close_file()
+            raise
         self.fs_close_file()
-        self.printProgressBar(100, 100, 'Writing...', '', 0)
+        self.report_progress("write", position, position, start, True)
         return True
 
-    def fs_write_chunk(self, data):
-        self.send_packet(b"CHNK", data)
+    def read_stream(self, reopen):
+        """
+        Generator reading the opened file in chunks, reopening and skipping the data already received after a failed chunk
+        Raises IOError when the file can't be read, the file is closed when the generator is closed early
+        @params:
+            reopen      - Required  : function that opens the file again from the start, returns True on success
+        """
+        position = 0
+        skip = 0
+        attempts = 0
+        previous = 0 # Length of the previous chunk, it was a full chunk if more data follows
+        start = time.monotonic()
+        try:
+            while True:
+                with trace.span("CHNK read", position=position + skip):
+                    datanew = self.read_chunk()
+                if datanew and previous > 0:
+                    self.read_chunk_size = max(self.read_chunk_size or 0, previous)
+                previous = len(datanew) if datanew else 0
+                if datanew is False:
+                    attempts += 1
+                    if attempts > self.max_retries:
+                        self.fs_close_file()
+                        raise IOError("Read error!")
+                    self.metrics.retry(b"CHNK")
+                    trace.instant("retry", position=position)
+                    self.sync()
+                    if not reopen():
+                        raise IOError("Failed to reopen file")
+                    skip = position
+                    continue
+                if skip > 0:
+                    if len(datanew) < 1:
+                        self.fs_close_file()
+                        raise IOError("File changed while reading")
+                    skipped = min(skip, len(datanew))
+                    skip -= skipped
+                    datanew = datanew[skipped:]
+                    if len(datanew) < 1:
+                        continue
+                attempts = 0
+                if len(datanew) < 1:
+                    break
+                position += len(datanew)
+                self.report_progress("read", position, None, start)
+                yield datanew
+        except GeneratorExit:
+            self.fs_close_file()
+            raise
+        self.report_progress("read", position, None, start, True)
+        self.fs_close_file()
+
+    def read_data(self, reopen):
+        """
+        Reads the opened file in chunks, reopening and skipping the data already received after a failed chunk
+        @params:
+            reopen      - Required  : function that opens the file again from the start, returns True on success
+        """
+        data = bytearray()
+        try:
+            for chunk in self.read_stream(reopen):
+                data += chunk
+        except BadgeDisconnected:
+            raise
+        except IOError as e:
+            print(e)
+            return False
+        return data
+
+    @resumable
+    @traced("fs_write_file")
+    def fs_write_file(self, name, data):
+        return self.run_steps(self.fs_write_file_steps(name, data))
+
+    def fs_write_file_steps(self, name, data):
+        """
+        Generator version of fs_write_file, see write_data_steps
+        """
+        if not self.open_file(b"FSFW", name):
+            print("Failed to open file")
+            return False
+        return (yield from self.write_data_steps(data, lambda: self.open_file(b"FSFW", name)))
+
+    def fs_write_chunk(self, data, header = None):
+        self.send_packet(b"CHNK", data, header=header)
         response = self.receive_packet()
         if not response:
             print("No response CHNK write")
             return False
-        if not response["command"] == b"CHNK":
+        if response["command"].startswith(b"ERR"):
+            print("Chunk rejected", response["command"])
+            return None
+        if not response["command"] == b"CHNK" or len(response["payload"]) != 4:
             print("No CHNK", response["command"])
             return False
         return struct.unpack("<I", response["payload"])[0]
 
+    @resumable
+    @traced("fs_read_file")
     def fs_read_file(self, name):
-        self.send_packet(b"FSFR", name)
-        response = self.receive_packet()
-        if not response:
-            print("No response FSFR")
-            return False
-        if not response["command"] == b"FSFR":
-            print("No FSFR", response["command"])
+        if not self.open_file(b"FSFR", name):
             return False
-        payload = response["payload"]
-        if not payload[0]:
-            return False
-        
-        data = bytearray()
+        return self.read_data(lambda: self.open_file(b"FSFR", name))
+
+    @resumable
+    @traced("fs_write_files")
+    def fs_write_files(self, files, directories = [], callback = None):
+        """
+        Writes many files, sending the open, write and close requests of all files back-to-back (see pipeline)
+        Files that failed are written again in the next round, returns a list with the result for every file
+        @params:
+            files       - Required  : list of (name, data) tuples (List)
+            directories - Optional  : directories to create before writing the files (List of Bytes)
+            callback    - Optional  : function called with the index and the result of every file as soon as it is known
+        """
+        results = [False] * len(files)
+        remaining = list(range(len(files)))
+        total = sum(len(data) for (name, data) in files)
+        written = [0]
+        start = time.monotonic()
 
+        attempts = 0
+        first = True
         while True:
-            datanew = self.read_chunk()
-            if datanew == None:
-                print("Read error!")
-                return False
-            data += datanew
-            self.printProgressBar(0, 100, 'Reading...', '{} bytes'.format(len(data)), 0)
-            if len(datanew) < 1:
+            requests = []
+            owners = [] # Index of the file each request belongs to, None for directories
+            if first:
+                for directory in sorted(directories, key=lambda directory: directory.count(b"/")):
+                    requests.append((b"FSMD", directory, 100))
+                    owners.append(None)
+            for index in remaining:
+                (name, data) = files[index]
+                results[index] = True
+                requests.append((b"FSFW", name, 100))
+                owners.append(index)
+                for position in range(0, len(data), 8192):
+                    requests.append((b"CHNK", data[position:position+8192], 100))
+                    owners.append(index)
+                requests.append((b"FSFC", b"", 100))
+                owners.append(index)
+
+            def received(position, response):
+                owner = owners[position]
+                if owner is None:
+                    return # Directories that exist already are fine
+                (command, payload, timeout) = requests[position]
+                if command == b"CHNK":
+                    success = response is not None and response["command"] == b"CHNK" and response["payload"] == struct.pack("<I", len(payload))
+                else:
+                    success = response is not None and response["command"] == command and response["payload"] == b"\x01"
+                if not success:
+                    results[owner] = False
+                if command == b"FSFC" and results[owner]:
+                    written[0] += len(files[owner][1])
+                    self.report_progress("write", written[0], total, start)
+                    if callback:
+                        callback(owner, True)
+
+            self.pipeline(requests, received)
+            failed = [index for index in remaining if not results[index]]
+            if len(failed) < 1:
+                remaining = failed
                 break
-        self.printProgressBar(100, 100, 'Reading...', '{} bytes'.format(len(data)), 0)
-        self.fs_close_file()
-        return data
+            # Keep going as long as files get written, give up after rounds without progress
+            attempts = attempts + 1 if len(failed) == len(remaining) else 0
+            remaining = failed
+            first = False
+            if attempts > self.max_retries:
+                print("Failed to write {} files".format(len(remaining)))
+                break
+            for index in remaining:
+                self.metrics.retry(b"FSFW")
+            trace.instant("retry", files=len(remaining))
+            self.sync()
+
+        if callback:
+            for index in remaining:
+                callback(index, False)
+        self.report_progress("write", written[0], total, start, True)
+        return results
 
+    @resumable
+    def fs_list_tree(self, path):
+        """
+        Lists path recursively, listing all directories of a level at once, returns a list of (path, item) tuples or None if path can't be listed
+        @params:
+            path        - Required  : directory to list, without trailing slash (Bytes)
+        """
+        output = []
+        level = [path]
+        while len(level) > 0:
+            next_level = []
+            for directory, items in zip(level, self.fs_list_level(level)):
+                if items is None:
+                    if directory == path:
+                        return None
+                    print("Failed to list", directory.decode("ascii", "ignore"))
+                    continue
+                for item in items:
+                    item_path = directory + b"/" + item["name"]
+                    output.append((item_path, item))
+                    if item["type"] == 2:
+                        next_level.append(item_path)
+            level = next_level
+        return output
+
+    def fs_list_level(self, directories):
+        """
+        Lists many directories at once (see pipeline), returns a list with the items of every directory, None for directories that can't be listed
+        """
+        output = []
+        responses = self.pipeline([(b"FSLS", directory + b"\0", 100) for directory in directories])
+        for directory, response in zip(directories, responses):
+            if response is None:
+                # Lost in the pipeline, list it on its own
+                output.append(self.fs_list(directory))
+            elif response["command"] == b"FSLS":
+                output.append(self.parse_fs_list(response["payload"]))
+            else:
+                output.append(None)
+        return output
+
+    @resumable
+    @traced("fs_read_files")
+    def fs_read_files(self, files, callback):
+        """
+        Reads many files, sending the open, read and close requests of consecutive files back-to-back (see pipeline)
+        The number of reads per file is derived from its size, files that failed are read again in the next round
+        @params:
+            files       - Required  : list of (name, size) tuples, size as listed by fs_list or -1 if unknown (List)
+            callback    - Required  : function called with the index and the data of every file (False if it failed) as soon as it has been read
+        Returns a list with the result (True or False) for every file
+        """
+        results = [None] * len(files)
+        buffers = {}
+        total = sum(max(size, 0) for (name, size) in files)
+        received = [0]
+        start = time.monotonic()
+
+        def finish(index, data):
+            results[index] = data is not False
+            buffers.pop(index, None)
+            if data is not False:
+                received[0] += len(data)
+                self.report_progress("read", received[0], total, start)
+            callback(index, data)
+
+        ended = set() # Files the badge returned the last chunk of, their remaining reads aren't sent
+
+        def requests(remaining):
+            for index in remaining:
+                (name, size) = files[index]
+                yield (index, (b"FSFR", name, 100))
+                # One read more than needed, it should return no data
+                for position in range(-(-max(size, 0) // (self.read_chunk_size or self.READ_CHUNK_SIZE)) + 1):
+                    yield (index, (b"CHNK", b"", 100))
+                yield (index, (b"FSFC", b"", 100))
+
+        remaining = [index for index in range(len(files)) if results[index] is None]
+        attempts = 0
+        while len(remaining) > 0:
+            generator = requests(remaining)
+            pending = next(generator, None)
+            while pending is not None:
+                # Requests are generated a slice at a time, which keeps memory use bounded and allows adapting the number of reads
+                owners = []
+                batch = []
+                while pending is not None and len(batch) < 256:
+                    (index, request) = pending
+                    if results[index] is None:
+                        owners.append(index)
+                        batch.append(request)
+                    pending = next(generator, None)
+                if len(batch) < 1:
+                    break
+
+                def receive(position, response):
+                    index = owners[position]
+                    if results[index] is not None:
+                        return
+                    (command, payload, timeout) = batch[position]
+                    if response is None or response["command"] != command:
+                        results[index] = False
+                        return
+                    if command == b"FSFR":
+                        if response["payload"] != b"\x01":
+                            results[index] = False
+                            return
+                        buffers[index] = bytearray()
+                    elif command == b"CHNK":
+                        buffers[index] += response["payload"]
+                        if len(response["payload"]) < 1:
+                            ended.add(index)
+                        elif len(buffers[index]) < files[index][1]:
+                            # Only a chunk followed by more data of the file has the full size, the last one is shorter
+                            self.read_chunk_size = max(self.read_chunk_size or 0, len(response["payload"]))
+                    elif command == b"FSFC":
+                        if len(buffers[index]) != files[index][1]:
+                            results[index] = False
+                            return
+                        finish(index, buffers[index])
+
+                def skip(position):
+                    index = owners[position]
+                    return batch[position][0] == b"CHNK" and (index in ended or results[index] is not None)
+
+                self.pipeline(batch, receive, skip)
+
+            failed = [index for index in remaining if not results[index]]
+            if len(failed) < 1:
+                break
+            # Keep going as long as files get read, give up after rounds without progress
+            attempts = attempts + 1 if len(failed) == len(remaining) else 0
+            remaining = failed
+            for index in remaining:
+                results[index] = None
+                buffers.pop(index, None)
+                ended.discard(index)
+                self.metrics.retry(b"FSFR")
+            trace.instant("retry", files=len(remaining))
+            self.sync() # Drop what is left of the failed requests
+            if attempts > self.max_retries:
+                break
+
+        for index in remaining:
+            if results[index] is None:
+                # Most likely the file changed since it was listed, read it on its own
+                finish(index, self.fs_read_file(files[index][0]))
+        self.report_progress("read", received[0], total, start, True)
+        return results
+
+    def fs_write_stream(self, name, chunks, total = None):
+        return self.run_steps(self.fs_write_stream_steps(name, chunks, total))
+
+    def fs_write_stream_steps(self, name, chunks, total = None):
+        if not self.open_file(b"FSFW", name):
+            print("Failed to open file")
+            return False
+        return (yield from self.write_stream_steps(chunks, total))
+
+    def fs_read_stream(self, name):
+        """
+        Opens a file for reading, returns a generator of chunks (see read_stream) or False if the file can't be opened
+        """
+        if not self.open_file(b"FSFR", name):
+            return False
+        return self.read_stream(lambda: self.open_file(b"FSFR", name))
+
+    @traced("fs_close_file")
     def fs_close_file(self):
         self.send_packet(b"FSFC")
         response = self.receive_packet()
@@ -403,9 +1207,9 @@ class Badge:
         if not response["command"] == b"CHNK":
             print("No CHNK", response["command"])
             return False
-        payload = response["payload"]
-        return payload
+        return response["payload"]
 
+    @resumable
     def app_list(self):
         self.send_packet(b"APPL")
         response = self.receive_packet()
@@ -439,100 +1243,56 @@ class Badge:
             })
         return output
 
+    @resumable
+    @traced("app_read")
     def app_read(self, name):
-        self.send_packet(b"APPR", name)
-        response = self.receive_packet()
-        if not response:
-            print("No response APPR")
-            return False
-        if not response["command"] == b"APPR":
-            print("No APPR", response["command"])
-            return False
-        payload = response["payload"]
-        if not payload[0]:
+        if not self.open_file(b"APPR", name):
             return False
+        return self.read_data(lambda: self.open_file(b"APPR", name))
 
-        data = bytearray()
-
-        while True:
-            datanew = self.read_chunk()
-            if datanew == None:
-                print("Read error!")
-                return False
-            data += datanew
-            self.printProgressBar(0, 100, 'Reading...', '{} bytes'.format(len(data)), 0)
-            if len(datanew) < 1:
-                break
-        self.printProgressBar(100, 100, 'Reading...', '{} bytes'.format(len(data)), 0)
-        self.fs_close_file()
-        return data
-
+    @resumable
+    @traced("app_write")
     def app_write(self, name, title, version, data):
+        return self.run_steps(self.app_write_steps(name, title, version, data))
+
+    def app_write_steps(self, name, title, version, data):
+        """
+        Generator version of app_write, see write_data_steps
+        """
         print("Preparing...")
-        payload = struct.pack("<B", len(name)) + name + struct.pack("<B", len(title)) + title + struct.pack("<LH", len(data), version)
-        self.send_packet(b"APPW", payload)
-        response = self.receive_packet(10000)
-        if not response:
-            print("No response APPW")
+        payload = struct.pack("<B", len(name)) + name + struct.pack("<B", len(title)) + title + struct.pack("<LH", self.data_size(data), version)
+        if not self.open_file(b"APPW", payload, 10000):
+            print("Failed to open file")
             return False
-        if not response["command"] == b"APPW":
-            print("No APPW", response["command"])
+        return (yield from self.write_data_steps(data, lambda: self.open_file(b"APPW", payload, 10000)))
+
+    def app_read_stream(self, name):
+        if not self.open_file(b"APPR", name):
             return False
-        payload = response["payload"]
-        if not payload[0]:
+        return self.read_stream(lambda: self.open_file(b"APPR", name))
+
+    def app_write_stream(self, name, title, version, size, chunks):
+        return self.run_steps(self.app_write_stream_steps(name, title, version, size, chunks))
+
+    def app_write_stream_steps(self, name, title, version, size, chunks):
+        payload = struct.pack("<B", len(name)) + name + struct.pack("<B", len(title)) + title + struct.pack("<LH", size, version)
+        if not self.open_file(b"APPW", payload, 10000):
             print("Failed to open file")
             return False
-        position = 0
-
-        total = len(data)
-        while True:
-            chunk = data[position:position+8192]
-            if len(chunk) < 1:
-                break
-            self.printProgressBar(position, total, 'Writing...', '{} of {} bytes'.format(position, total), 0)
-            position += 8192
-            sent = self.fs_write_chunk(chunk)
-            if sent != len(chunk):
-                print("Failed to send data", sent, len(chunk))
-                self.fs_close_file()
-                return False
-        self.fs_close_file()
-        self.printProgressBar(100, 100, 'Writing...', '', 0)
-        return True
+        return (yield from self.write_stream_steps(chunks, size))
 
     def app_remove(self, name):
         self.send_packet(b"APPD", name)
-        response = self.receive_packet(10000)
-        if not response:
-            print("No response to APPD")
-            return False
-        if not response["command"] == b"APPD":
-            print("No APPD", response["command"])
-            return False
-        payload = response["payload"]
-        if not len(payload) == 1:
-            print("Wrong payload length")
-            return False
-        return True if payload[0] else False
+        return self.response_bool(b"APPD", self.receive_packet(10000))
 
     def app_run(self, name, command = None):
         if command:
             self.send_packet(b"APPX", name + b"\0" + command)
         else:
             self.send_packet(b"APPX", name)
-        response = self.receive_packet()
-        if not response:
-            print("No response to APPX")
-            return False
-        if not response["command"] == b"APPX":
-            print("No APPX", response["command"])
-            return False
-        payload = response["payload"]
-        if not len(payload) == 1:
-            print("Wrong payload length")
-            return False
-        return True if payload[0] else False
+        return self.response_bool(b"APPX", self.receive_packet())
 
+    @resumable
     def nvs_list(self, namespace = None):
         if namespace:
             self.send_packet(b"NVSL", namespace.encode("ascii", "ignore"))
@@ -571,22 +1331,40 @@ class Badge:
             })
         return output
 
-    def nvs_read(self, namespace, key, type_number):
+    def nvs_key(self, namespace, key):
         payload = bytearray()
         payload += struct.pack("<B", len(namespace))
         payload += namespace.encode("ascii", "ignore")
         payload += struct.pack("<B", len(key))
         payload += key.encode("ascii", "ignore")
-        payload += struct.pack("<B", type_number)
-        self.send_packet(b"NVSR", payload)
-        response = self.receive_packet()
-        if not response:
-            print("No response to NVSR")
-            return None
-        if not response["command"] == b"NVSR":
-            print("No NVSR", response["command"])
-            return None
-        result = response["payload"]
+        return payload
+
+    def nvs_encode(self, type_number, value):
+        if type_number == 0x01:
+            return struct.pack("<B", value)
+        if type_number == 0x11:
+            return struct.pack("<b", value)
+        if type_number == 0x02:
+            return struct.pack("<H", value)
+        if type_number == 0x12:
+            return struct.pack("<h", value)
+        if type_number == 0x04:
+            return struct.pack("<I", value)
+        if type_number == 0x14:
+            return struct.pack("<i", value)
+        if type_number == 0x08:
+            return struct.pack("<Q", value)
+        if type_number == 0x18:
+            return struct.pack("<q", value)
+        if type_number == 0x21:
+            if type(value) == bytes or type(value) == bytearray:
+                return value
+            return value.encode("utf-8", "ignore")
+        if type_number == 0x42:
+            return bytes(value)
+        raise ValueError("Invalid type")
+
+    def nvs_decode(self, type_number, result):
         if type_number == 0x01:
             return struct.unpack("<B", result)[0]
         if type_number == 0x11:
@@ -607,65 +1385,23 @@ class Badge:
             return result.decode("utf-8", "ignore")
         return result
 
+    @resumable
+    def nvs_read(self, namespace, key, type_number):
+        self.send_packet(b"NVSR", self.nvs_key(namespace, key) + struct.pack("<B", type_number))
+        result = self.response_payload(b"NVSR", self.receive_packet())
+        if result is None:
+            return None
+        return self.nvs_decode(type_number, result)
+
+    @resumable
     def nvs_write(self, namespace, key, type_number, value):
-        payload = bytearray()
-        payload += struct.pack("<B", len(namespace))
-        payload += namespace.encode("ascii", "ignore")
-        payload += struct.pack("<B", len(key))
-        payload += key.encode("ascii", "ignore")
-        payload += struct.pack("<B", type_number)
-        if type_number == 0x01:
-            payload += struct.pack("<B", value)
-        elif type_number == 0x11:
-            payload += struct.pack("<b", value)
-        elif type_number == 0x02:
-            payload += struct.pack("<H", value)
-        elif type_number == 0x12:
-            payload += struct.pack("<h", value)
-        elif type_number == 0x04:
-            payload += struct.pack("<I", value)
-        elif type_number == 0x14:
-            payload += struct.pack("<i", value)
-        elif type_number == 0x08:
-            payload += struct.pack("<Q", value)
-        elif type_number == 0x18:
-            payload += struct.pack("<q", value)
-        elif type_number == 0x21:
-            if type(value) == bytes or type(value) == bytearray:
-                payload += value
-            else:
-                payload += value.encode("utf-8", "ignore")
-        elif type_number == 0x42:
-            payload += bytes(value)
-        else:
-            raise ValueError("Invalid type")
+        payload = self.nvs_key(namespace, key) + struct.pack("<B", type_number) + self.nvs_encode(type_number, value)
         self.send_packet(b"NVSW", payload)
-        response = self.receive_packet()
-        if not response:
-            print("No response to NVSW")
-            return None
-        if not response["command"] == b"NVSW":
-            print("No NVSW", response["command"])
-            return None
-        result = response["payload"]
-        return result
+        return self.response_payload(b"NVSW", self.receive_packet())
 
     def nvs_remove(self, namespace, key):
-        payload = bytearray()
-        payload += struct.pack("<B", len(namespace))
-        payload += namespace.encode("ascii", "ignore")
-        payload += struct.pack("<B", len(key))
-        payload += key.encode("ascii", "ignore")
-        self.send_packet(b"NVSD", payload)
-        response = self.receive_packet()
-        if not response:
-            print("No response to NVSD")
-            return None
-        if not response["command"] == b"NVSD":
-            print("No NVSD", response["command"])
-            return None
-        result = response["payload"]
-        return result
+        self.send_packet(b"NVSD", self.nvs_key(namespace, key))
+        return self.response_payload(b"NVSD", self.receive_packet())
 
     def nvs_type_to_name(self, type_number):
         if type_number == 0x01:
@@ -734,6 +1470,7 @@ class Badge:
             return True
         return False
 
+    @traced("reset")
     def reset(self, reset_esp = True):
         self.device.ctrl_transfer(self.request_type_out, self.REQUEST_STATE, 0x0000, self.webusb_esp32.bInterfaceNumber) # Connect
         self.device.ctrl_transfer(self.request_type_out, self.REQUEST_MODE, self.BOOT_MODE_NORMAL, self.webusb_esp32.bInterfaceNumber)
@@ -741,6 +1478,7 @@ class Badge:
             self.device.ctrl_transfer(self.request_type_out, self.REQUEST_RESET, 0x0000, self.webusb_esp32.bInterfaceNumber)
         self.device.ctrl_transfer(self.request_type_out, self.REQUEST_BAUDRATE, 1152, self.webusb_esp32.bInterfaceNumber)
     
+    @traced("start_webusb")
     def start_webusb(self):
         self.device.ctrl_transfer(self.request_type_out, self.REQUEST_STATE, 0x0001, self.webusb_esp32.bInterfaceNumber) # Connect
         current_mode = int(self.device.ctrl_transfer(self.request_type_in, self.REQUEST_MODE_GET, 0, self.webusb_esp32.bInterfaceNumber, 1)[0]) # Read WebUSB mode
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Local cache of AppFS binaries
+#
+# Apps are looked up by the name, version and size in the app list of the
+# badge, which only change when the app is replaced. The binaries are stored
+# under the SHA-256 of their content, so the same binary installed under
+# several names or cached from several badges is stored once, and the content
+# is verified when it is read from the cache.
+#
+# The entries of the cache are the binaries (see webusb_cache.py), the index
+# also maps the apps to the digests of their binaries.
+
+import hashlib
+import json
+import time
+
+from webusb_cache import FileCache, default_directory
+
+class AppCache(FileCache):
+    def __init__(self, directory = None, max_size = 256 * 1024 * 1024):
+        self.apps = {} # key: digest
+        super().__init__(directory or default_directory("apps"), max_size, lambda digest: digest)
+
+    def load_index(self, index):
+        self.apps = index.get("apps", {})
+        self.entries = index.get("blobs", {})
+
+    def index(self):
+        return {"apps": self.apps, "blobs": self.entries}
+
+    def key(self, app):
+        return json.dumps([app["name"].decode("ascii", "ignore"), app["version"], app["size"]])
+
+    def get(self, app):
+        """
+        Returns the cached binary of app, None if it isn't cached
+        @params:
+            app         - Required  : entry of app_list (Dict)
+        """
+        digest = self.apps.get(self.key(app))
+        if digest is None or digest not in self.entries:
+            return None
+        data = self.read(digest)
+        if data is None or hashlib.sha256(data).hexdigest() != digest:
+            self.remove(digest)
+            return None
+        return data
+
+    def put(self, app, data):
+        """
+        Stores the binary read from app
+        """
+        if len(data) > self.max_size:
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self.entries:
+            self.entries[digest]["used"] = time.time()
+        else:
+            self.write(digest, data)
+        self.apps[self.key(app)] = digest
+        self.changed = True
+        self.evict()
+
+    def remove(self, digest):
+        super().remove(digest)
+        for key in [key for key, value in self.apps.items() if value == digest]:
+            del self.apps[key]
+            self.changed = True
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Planning of AppFS installs
+#
+# plan_install compares the apps to be installed with the app list of the
+# badge and skips every app that is installed with the same title, version
+# and size. Removals are done first, then the apps are installed in the
+# order that frees the most space first (installing an app replaces the app
+# with the same name). The free space is checked for every step of the plan
+# before anything is sent, so a plan that can't fit is refused up front
+# instead of failing halfway through an upload.
+
+import os
+
+PAGE_SIZE = 64 * 1024 # Apps occupy whole AppFS pages
+
+def allocated_size(size):
+    return (size + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+def app_from_file(filename, name, title, version):
+    """
+    Describes an app to be installed from a local binary
+    """
+    return {
+        "name": name,
+        "title": title,
+        "version": max(0, version),
+        "size": os.path.getsize(filename),
+        "file": filename,
+    }
+
+def up_to_date(installed, app):
+    # The size in the app list is either the size of the binary or of the space allocated for it
+    return installed["title"] == app["title"] and installed["version"] == app["version"] and installed["size"] in [app["size"], allocated_size(app["size"])]
+
+def plan_install(applist, free, apps, remove = [], force = False):
+    """
+    Plans the installation of apps, returns a dict with the apps to remove, install and skip and whether the plan fits
+    @params:
+        applist     - Required  : result of app_list (List)
+        free        - Required  : free space in the AppFS, fs_state()["app"]["free"] (Int)
+        apps        - Required  : apps to install, see app_from_file (List of Dicts)
+        remove      - Optional  : names of apps to remove (List of Bytes)
+        force       - Optional  : install apps that are up to date too (Bool)
+    """
+    installed = {app["name"]: app for app in applist}
+    plan = {"remove": [], "install": [], "skip": [], "free": free, "fits": True, "shortage": 0}
+    for name in remove:
+        if name in installed and name not in [app["name"] for app in apps] and name not in plan["remove"]:
+            plan["remove"].append(name)
+    for app in apps:
+        current = installed.get(app["name"])
+        if current is not None and not force and up_to_date(current, app):
+            plan["skip"].append(app)
+        else:
+            plan["install"].append(app)
+
+    def change(app):
+        current = installed.get(app["name"])
+        return allocated_size(app["size"]) - (allocated_size(current["size"]) if current else 0)
+
+    plan["install"].sort(key=change)
+    available = free + sum(allocated_size(installed[name]["size"]) for name in plan["remove"])
+    for app in plan["install"]:
+        available -= change(app)
+        if available < 0:
+            plan["fits"] = False
+            plan["shortage"] = max(plan["shortage"], -available)
+    return plan
+
+def execute_plan(badge, plan, callback = None):
+    """
+    Removes and installs the apps of a plan, returns True if everything succeeded
+    @params:
+        badge       - Required  : connected Badge
+        plan        - Required  : result of plan_install
+        callback    - Optional  : function called with the action ("remove" or "install"), the name and the result of every step
+    """
+    success = True
+    # The removals don't depend on each other, their requests are sent back-to-back
+    responses = badge.pipeline([(b"APPD", name, 10000) for name in plan["remove"]])
+    for name, response in zip(plan["remove"], responses):
+        result = badge.response_bool(b"APPD", response)
+        success = success and result
+        if callback:
+            callback("remove", name, result)
+    if not success:
+        # The plan counted on the space of the removed apps
+        print("Not installing, removing apps failed")
+        return False
+    for app in plan["install"]:
+        try:
+            # The binary is read while it is being sent
+            with open(app["file"], "rb") as f:
+                result = badge.data_size(f) == app["size"] and badge.app_write(app["name"], app["title"], app["version"], f)
+        except OSError as e:
+            print(e)
+            result = False
+        success = success and result
+        if callback:
+            callback("install", app["name"], result)
+    return success
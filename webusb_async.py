@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+# asyncio interface to the badge
+#
+# AsyncBadge offers awaitable versions of the Badge methods. pyusb only has
+# blocking transfers, so every AsyncBadge has a Scheduler (see
+# webusb_scheduler.py) whose worker thread talks to the badge while the
+# coroutines wait for the results. One event loop can drive many badges at
+# once, each at the speed of its own USB link:
+#
+#     async def main():
+#         badges = await connect_all()
+#         await asyncio.gather(*[badge.fs_write_file(b"/internal/hello.txt", b"Hello") for badge in badges])
+#         async for (path, item) in badges[0].walk(b"/internal"):
+#             print(path.decode("ascii"))
+#
+# File transfers and streaming reads run as scheduler jobs that exchange one
+# chunk per step. Cancelling the task that awaits a transfer, or leaving the
+# loop over a stream early, stops the transfer before the next chunk and
+# closes the file on the badge; what has been written so far stays on the
+# badge. The other requests are short, they are only cancelled if they
+# haven't been sent yet.
+#
+# Errors are reported like the Badge methods report them, except that a badge
+# that is unplugged raises BadgeDisconnected (see webusb.py), also from
+# fs_read_file and app_read.
+
+import asyncio
+import queue
+import threading
+
+import webusb
+from webusb_scheduler import Scheduler, INTERACTIVE, BULK, read_job
+
+class LoopQueue:
+    """
+    Bounded queue filled by the worker thread of a scheduler (see read_job) and emptied by a coroutine
+    """
+    def __init__(self, loop, size):
+        self.loop = loop
+        self.items = asyncio.Queue()
+        self.space = threading.Semaphore(size)
+
+    # Items are queued together with whether they took a slot
+
+    def put(self, item):
+        self.space.acquire()
+        self.loop.call_soon_threadsafe(self.items.put_nowait, (item, True))
+
+    def put_nowait(self, item):
+        if not self.space.acquire(blocking=False):
+            raise queue.Full
+        self.loop.call_soon_threadsafe(self.items.put_nowait, (item, True))
+
+    def fail(self, exception):
+        # Doesn't take a slot, the reader may have stopped reading
+        self.loop.call_soon_threadsafe(self.items.put_nowait, (exception, False))
+
+    async def get(self):
+        (item, counted) = await self.items.get()
+        if counted:
+            self.space.release()
+        return item
+
+class AsyncBadge:
+    def __init__(self, badge, scheduler = None, depth = 8):
+        """
+        Awaitable interface to a Badge
+        @params:
+            badge       - Required  : Badge with a session started by begin
+            scheduler   - Optional  : Scheduler of the badge, if the badge is shared with code using it directly (Scheduler)
+            depth       - Optional  : number of chunks read ahead of the reader of a stream (Int)
+        """
+        self.badge = badge
+        self.scheduler = scheduler or Scheduler(badge)
+        self.depth = depth
+
+    @property
+    def serial(self):
+        return self.badge.serial
+
+    async def call(self, function, priority = INTERACTIVE):
+        """
+        Runs function with the badge on the worker thread, returns its result
+        """
+        return await asyncio.wrap_future(self.scheduler.submit(function, priority))
+
+    async def job(self, start, priority = BULK):
+        """
+        Runs a job on the worker thread (see Scheduler.submit_job), returns its result
+        Cancelling the awaiting task stops the job before its next step
+        """
+        return await asyncio.wrap_future(self.scheduler.submit_job(start, priority))
+
+    async def stream(self, open_stream, description, priority = BULK):
+        """
+        Async iterator over the chunks of a file, raises IOError if the file can't be opened or read
+        @params:
+            open_stream - Required  : called with the badge, returns a generator of chunks or False (like Badge.fs_read_stream)
+            description - Required  : name of the file for the error message (Str)
+        """
+        sink = LoopQueue(asyncio.get_running_loop(), self.depth)
+        cancelled = threading.Event()
+        reader = read_job(open_stream, sink, cancelled)
+
+        def start(badge):
+            try:
+                return (yield from reader(badge))
+            except Exception as e:
+                sink.fail(e)
+                raise
+
+        future = self.scheduler.submit_job(start, priority)
+        try:
+            item = await sink.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                raise IOError("Failed to open {}".format(description))
+            while True:
+                item = await sink.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+            future.cancel()
+
+    async def read(self, chunks):
+        data = bytearray()
+        try:
+            async for chunk in chunks:
+                data += chunk
+        except webusb.BadgeDisconnected:
+            raise
+        except IOError as e:
+            print(e)
+            return False
+        return data
+
+    async def info(self):
+        return await self.call(lambda badge: badge.info())
+
+    # FAT filesystems
+
+    async def fs_list(self, path):
+        return await self.call(lambda badge: badge.fs_list(path))
+
+    async def walk(self, path):
+        """
+        Async iterator over (path, item) tuples for everything below path, like Badge.fs_list_tree
+        The directories of a level are listed at once, raises IOError if path can't be listed
+        """
+        level = [path]
+        while len(level) > 0:
+            listings = await self.call(lambda badge, level = level: badge.fs_list_level(level))
+            next_level = []
+            for directory, items in zip(level, listings):
+                if items is None:
+                    if directory == path:
+                        raise IOError("Failed to list {}".format(path.decode("ascii", "ignore")))
+                    print("Failed to list", directory.decode("ascii", "ignore"))
+                    continue
+                for item in items:
+                    item_path = directory + b"/" + item["name"]
+                    yield (item_path, item)
+                    if item["type"] == 2:
+                        next_level.append(item_path)
+            level = next_level
+
+    async def fs_file_exists(self, name):
+        return await self.call(lambda badge: badge.fs_file_exists(name))
+
+    async def fs_create_directory(self, name):
+        return await self.call(lambda badge: badge.fs_create_directory(name))
+
+    async def fs_remove(self, name):
+        return await self.call(lambda badge: badge.fs_remove(name))
+
+    async def fs_state(self):
+        return await self.call(lambda badge: badge.fs_state())
+
+    def fs_read_stream(self, name):
+        return self.stream(lambda badge: badge.fs_read_stream(name), name.decode("ascii", "ignore"))
+
+    async def fs_read_file(self, name):
+        return await self.read(self.fs_read_stream(name))
+
+    async def fs_write_file(self, name, data):
+        """
+        Writes data (bytes or a seekable binary file) to the file name, returns True on success
+        """
+        return await self.job(lambda badge: badge.fs_write_file_steps(name, data))
+
+    async def fs_write_stream(self, name, chunks, total = None):
+        return await self.job(lambda badge: badge.fs_write_stream_steps(name, chunks, total))
+
+    # AppFS
+
+    async def app_list(self):
+        return await self.call(lambda badge: badge.app_list())
+
+    def app_read_stream(self, name):
+        return self.stream(lambda badge: badge.app_read_stream(name), "app " + name.decode("ascii", "ignore"))
+
+    async def app_read(self, name):
+        return await self.read(self.app_read_stream(name))
+
+    async def app_write(self, name, title, version, data):
+        return await self.job(lambda badge: badge.app_write_steps(name, title, version, data))
+
+    async def app_remove(self, name):
+        return await self.call(lambda badge: badge.app_remove(name))
+
+    async def app_run(self, name, command = None):
+        return await self.call(lambda badge: badge.app_run(name, command))
+
+    # NVS
+
+    async def nvs_list(self, namespace = None):
+        return await self.call(lambda badge: badge.nvs_list(namespace))
+
+    async def nvs_read(self, namespace, key, type_number):
+        return await self.call(lambda badge: badge.nvs_read(namespace, key, type_number))
+
+    async def nvs_write(self, namespace, key, type_number, value):
+        return await self.call(lambda badge: badge.nvs_write(namespace, key, type_number, value))
+
+    async def nvs_remove(self, namespace, key):
+        return await self.call(lambda badge: badge.nvs_remove(namespace, key))
+
+async def connect(device = None, serial = None, wait = None):
+    """
+    Connects to a badge and starts a session, returns an AsyncBadge or None if the session can't be started
+    Raises ValueError if there is no badge, see Badge
+    """
+    loop = asyncio.get_running_loop()
+    badge = await loop.run_in_executor(None, lambda: webusb.Badge(device, serial=serial, wait=wait))
+    connection = AsyncBadge(badge)
+    if not await connection.call(lambda badge: badge.begin()):
+        return None
+    return connection
+
+async def connect_all():
+    """
+    Connects to all connected badges at once, returns a list of AsyncBadges for the badges a session was started with
+    """
+    loop = asyncio.get_running_loop()
+    devices = await loop.run_in_executor(None, webusb.find_devices)
+    connections = await asyncio.gather(*[connect(device) for device in devices])
+    return [connection for connection in connections if connection is not None]
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Local file caches with a size limit
+#
+# FileCache is the common part of the pull cache (webusb_pullcache.py) and the
+# app cache (webusb_appcache.py): a directory holding one content file per
+# entry and an index.json with the size and time of last use of every entry.
+# Files are written to a temporary file first and moved into place, so an
+# interrupted run never leaves a partial file behind. Once the total size
+# exceeds the limit the least recently used entries are evicted.
+
+import json
+import os
+import time
+
+def default_directory(name):
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "mch2022-tools", name)
+
+def write_atomic(filename, data):
+    temporary = filename + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, filename)
+
+class FileCache:
+    def __init__(self, directory, max_size, naming):
+        """
+        Opens the cache in directory, subclasses define how the index is stored
+        @params:
+            directory   - Required  : directory holding the cache (Str)
+            max_size    - Required  : total size in bytes above which entries are evicted (Int)
+            naming      - Required  : returns the name of the content file of a key (Function)
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.naming = naming
+        self.entries = {} # key: {"size", "used", ...}
+        self.changed = False
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.index_file(), "r") as f:
+                self.load_index(json.load(f))
+        except (OSError, ValueError, KeyError):
+            self.load_index({}) # Missing or damaged index, the content files are overwritten as needed
+        self.evict() # The limit may be lower than when the cache was filled
+
+    def load_index(self, index):
+        self.entries = index.get("entries", {})
+
+    def index(self):
+        return {"entries": self.entries}
+
+    def index_file(self):
+        return os.path.join(self.directory, "index.json")
+
+    def content_file(self, key):
+        return os.path.join(self.directory, self.naming(key))
+
+    def read(self, key):
+        """
+        Returns the content of the entry key and marks it as used, None if it can't be read
+        """
+        try:
+            with open(self.content_file(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        self.entries[key]["used"] = time.time()
+        self.changed = True
+        return data
+
+    def write(self, key, data, **fields):
+        """
+        Stores data as the content of the entry key, together with fields in the index
+        """
+        write_atomic(self.content_file(key), data)
+        self.entries[key] = dict(fields, size=len(data), used=time.time())
+        self.changed = True
+
+    def remove(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.changed = True
+        try:
+            os.remove(self.content_file(key))
+        except OSError:
+            pass
+
+    def total_size(self):
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def evict(self):
+        total = self.total_size()
+        for key in sorted(self.entries, key=lambda key: self.entries[key]["used"]):
+            if total <= self.max_size:
+                break
+            total -= self.entries[key]["size"]
+            self.remove(key)
+
+    def save(self):
+        if not self.changed:
+            return
+        write_atomic(self.index_file(), json.dumps(self.index()).encode("utf-8"))
+        self.changed = False
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# Capture and replay of the USB traffic between the host and the badge
+#
+# CaptureDevice wraps a device and records every endpoint write, endpoint read
+# and control transfer with a monotonic timestamp. Set BADGE_CAPTURE to a
+# filename to record the session of any of the tools.
+#
+# ReplayDevice feeds a capture back into Badge in place of a real device. Data
+# read from the badge is released once the host has written as many bytes as
+# it had written before that data arrived in the original session, after the
+# same delay divided by the replay speed (0 replays without any delays). Set
+# BADGE_REPLAY to a capture file (and optionally BADGE_REPLAY_SPEED) to run
+# any of the tools against a recorded session.
+#
+# File format: the magic b"BCAP" and a version byte, followed by records of a
+# type byte, the time since the previous record in microseconds (uint32), the
+# length of the data (uint32) and the data itself.
+
+import atexit
+import bisect
+import struct
+import sys
+import time
+import usb.core
+
+FILE_MAGIC = b"BCAP\x01"
+
+RECORD_WRITE   = 0x00
+RECORD_READ    = 0x01
+RECORD_CONTROL = 0x02
+
+RECORD_HEADER = struct.Struct("<BII")
+CONTROL_HEADER = struct.Struct("<BBHH")
+
+BOOT_MODE_WEBUSB = 0x03
+
+class CaptureEndpoint:
+    def __init__(self, device, endpoint):
+        self.device = device
+        self.endpoint = endpoint
+        self.bEndpointAddress = endpoint.bEndpointAddress
+        self.wMaxPacketSize = endpoint.wMaxPacketSize
+
+    def write(self, data, timeout = None):
+        result = self.endpoint.write(data, timeout)
+        self.device.record(RECORD_WRITE, bytes(data))
+        return result
+
+    def read(self, size, timeout = None):
+        data = self.endpoint.read(size, timeout)
+        self.device.record(RECORD_READ, bytes(data))
+        return data
+
+class CaptureInterface:
+    def __init__(self, interface, endpoints):
+        self.bInterfaceNumber = interface.bInterfaceNumber
+        self.endpoints = endpoints
+
+    def __iter__(self):
+        return iter(self.endpoints)
+
+class CaptureDevice:
+    def __init__(self, device, filename):
+        self.device = device
+        self.file = open(filename, "wb")
+        self.file.write(FILE_MAGIC)
+        self.last = time.monotonic()
+        interface = device.get_active_configuration()[(4, 0)]
+        self.interface = CaptureInterface(interface, [CaptureEndpoint(self, endpoint) for endpoint in interface])
+        atexit.register(self.close)
+
+    def record(self, record_type, data):
+        if self.file is None:
+            return
+        now = time.monotonic()
+        delta = min(int((now - self.last) * 1000000), 0xFFFFFFFF)
+        self.last = now
+        self.file.write(RECORD_HEADER.pack(record_type, delta, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def get_active_configuration(self):
+        return {(4, 0): self.interface}
+
+    def ctrl_transfer(self, request_type, request, value = 0, index = 0, data_or_length = None, timeout = None):
+        result = self.device.ctrl_transfer(request_type, request, value, index, data_or_length, timeout)
+        data = bytes(result) if request_type & 0x80 else b""
+        self.record(RECORD_CONTROL, CONTROL_HEADER.pack(request_type, request, value, index) + data)
+        return result
+
+def load(filename):
+    """
+    Reads a capture file, returns a list of (type, timestamp, data) tuples with timestamps in seconds since the start
+    """
+    records = []
+    with open(filename, "rb") as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError("Not a capture file")
+        timestamp = 0
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            (record_type, delta, length) = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            timestamp += delta / 1000000
+            records.append((record_type, timestamp, data))
+    return records
+
+class ReplayEndpoint:
+    def __init__(self, device, address, packet_size):
+        self.device = device
+        self.bEndpointAddress = address
+        self.wMaxPacketSize = packet_size
+
+    def write(self, data, timeout = None):
+        return self.device.replay_write(data)
+
+    def read(self, size, timeout = None):
+        return self.device.replay_read(size, timeout)
+
+class ReplayDevice:
+    bInterfaceNumber = 4
+
+    def __init__(self, filename, speed = 1.0, packet_size = 64):
+        self.speed = speed
+        self.reads = []
+        self.controls = []
+        written = 0
+        last_write = 0
+        for (record_type, timestamp, data) in load(filename):
+            if record_type == RECORD_WRITE:
+                written += len(data)
+                last_write = timestamp
+            elif record_type == RECORD_READ and len(data) > 0:
+                self.reads.append((written, timestamp - last_write, data))
+            elif record_type == RECORD_CONTROL:
+                self.controls.append(data)
+        self.written = 0
+        self.writes = [] # (total bytes written, time) for every write
+        self.ready = None
+        self.interface = CaptureInterface(self, [
+            ReplayEndpoint(self, 0x03, packet_size),
+            ReplayEndpoint(self, 0x83, packet_size),
+        ])
+
+    def get_active_configuration(self):
+        return {(4, 0): self.interface}
+
+    def ctrl_transfer(self, request_type, request, value = 0, index = 0, data_or_length = None, timeout = None):
+        if not request_type & 0x80:
+            return 0
+        for position, data in enumerate(self.controls):
+            if data[1] == request and len(data) > CONTROL_HEADER.size:
+                del self.controls[position]
+                return data[CONTROL_HEADER.size:]
+        return bytes([BOOT_MODE_WEBUSB])
+
+    def replay_write(self, data):
+        self.written += len(data)
+        self.writes.append((self.written, time.monotonic()))
+        return len(data)
+
+    def _ready_time(self):
+        (needed, delay, data) = self.reads[0]
+        if self.written < needed:
+            return None
+        if self.speed <= 0:
+            return 0
+        if self.ready is None:
+            # Time at which the host wrote the data that caused this response
+            index = bisect.bisect_left(self.writes, (needed, 0))
+            written_at = self.writes[index][1] if needed > 0 else 0
+            self.ready = written_at + delay / self.speed
+        return self.ready
+
+    def replay_read(self, size, timeout = None):
+        if len(self.reads) < 1:
+            raise usb.core.USBTimeoutError("End of capture")
+        ready = self._ready_time()
+        now = time.monotonic()
+        if ready is None or ready > now:
+            if self.speed > 0:
+                wait = (timeout if timeout else 1000) / 1000
+                if ready is not None:
+                    wait = min(wait, ready - now)
+                time.sleep(max(0, wait))
+            ready = self._ready_time()
+            if ready is None or ready > time.monotonic():
+                raise usb.core.USBTimeoutError("Operation timed out")
+        (needed, delay, data) = self.reads[0]
+        output = data[:size]
+        if len(data) > size:
+            self.reads[0] = (needed, delay, data[size:])
+        else:
+            self.reads.pop(0)
+            self.ready = None
+        return output
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: webusb_capture.py {capture}")
+        sys.exit(1)
+    records = load(sys.argv[1])
+    names = {RECORD_WRITE: "Writes", RECORD_READ: "Reads", RECORD_CONTROL: "Control transfers"}
+    for record_type, name in names.items():
+        selected = [data for (kind, timestamp, data) in records if kind == record_type]
+        print("{: <18} {: <8} {} bytes".format(name + ":", len(selected), sum(len(data) for data in selected)))
+    if len(records) > 0:
+        print("{: <18} {:.3f} s".format("Duration:", records[-1][1]))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# Notifications of badges being plugged in and unplugged
+#
+# HotplugMonitor keeps a list of the connected badges up to date on a
+# background thread. Where libusb supports hot-plug events (Linux and macOS)
+# a hot-plug callback for 0x16d0:0x0f9a is registered in the libusb context
+# of pyusb and the list is updated as soon as a badge arrives or leaves,
+# without enumerating the devices in between. Where it doesn't (Windows) the
+# devices are enumerated every interval seconds.
+#
+# The serial number of a badge is read once, when it arrives. Listeners are
+# called on the monitor thread with the event ("arrived" or "left"), the key
+# of the device (see webusb.device_key), the serial number and the pyusb
+# device.
+
+import ctypes
+import threading
+import time
+import weakref
+
+import webusb
+
+LIBUSB_CAP_HAS_HOTPLUG = 0x0001
+LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED = 0x01
+LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT = 0x02
+LIBUSB_HOTPLUG_MATCH_ANY = -1
+
+HOTPLUG_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p)
+
+class timeval(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+
+class HotplugMonitor:
+    def __init__(self, interval = 0.2, rescan = 5.0):
+        """
+        Tracks the connected badges
+        @params:
+            interval    - Optional  : seconds between enumerations when libusb has no hot-plug support (Float)
+            rescan      - Optional  : seconds between enumerations with hot-plug support, in case an event was missed (Float)
+        """
+        self.interval = interval
+        self.rescan = rescan
+        self.condition = threading.Condition()
+        self.devices = {}    # key: (serial, device)
+        self.generation = 0  # Incremented on every change
+        self.listeners = []
+        self.changed = threading.Event()
+        self.hotplug = self.register_hotplug()
+        self.refresh()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def register_hotplug(self):
+        try:
+            from usb.backend import libusb1
+            backend = webusb.usb_backend() or libusb1.get_backend()
+            if backend is None or not backend.lib.libusb_has_capability(LIBUSB_CAP_HAS_HOTPLUG):
+                return False
+            lib = backend.lib
+            lib.libusb_hotplug_register_callback.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, HOTPLUG_CALLBACK, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+            lib.libusb_handle_events_timeout_completed.argtypes = [ctypes.c_void_p, ctypes.POINTER(timeval), ctypes.c_void_p]
+            self.callback = HOTPLUG_CALLBACK(self.hotplug_event) # Referenced for as long as libusb may call it
+            handle = ctypes.c_int()
+            if lib.libusb_hotplug_register_callback(backend.ctx, LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED | LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT, 0,
+                                                    0x16d0, 0x0f9a, LIBUSB_HOTPLUG_MATCH_ANY, self.callback, None, ctypes.byref(handle)) != 0:
+                return False
+        except Exception:
+            # No libusb, or one without hot-plug support
+            return False
+        self.backend = backend
+        threading.Thread(target=self.handle_events, daemon=True).start()
+        return True
+
+    def hotplug_event(self, context, device, event, user_data):
+        # Called by libusb while it handles events, libusb can't be used here, the worker enumerates the devices
+        self.changed.set()
+        return 0
+
+    def handle_events(self):
+        # Hot-plug callbacks are only called while libusb handles the events of its context
+        timeout = timeval(1, 0)
+        while True:
+            self.backend.lib.libusb_handle_events_timeout_completed(self.backend.ctx, ctypes.byref(timeout), None)
+
+    def worker(self):
+        while True:
+            with self.condition:
+                # The serial number can't always be read right after a badge arrives, it is tried again soon
+                unread = any(serial is None for (serial, device) in self.devices.values())
+            self.changed.wait(self.interval if unread or not self.hotplug else self.rescan)
+            self.changed.clear()
+            self.refresh()
+
+    def refresh(self):
+        try:
+            present = {webusb.device_key(device): device for device in webusb.find_devices()}
+        except Exception:
+            present = {} # No usable libusb backend
+        with self.condition:
+            known = dict(self.devices)
+        events = []
+        for key, (serial, device) in known.items():
+            if key not in present:
+                events.append(("left", key, serial, device))
+        for key, device in present.items():
+            if key not in known:
+                events.append(("arrived", key, webusb.device_serial(device), device))
+            elif known[key][0] is None:
+                serial = webusb.device_serial(device)
+                if serial is not None:
+                    events.append(("arrived", key, serial, device))
+        if len(events) < 1:
+            return
+        with self.condition:
+            for (event, key, serial, device) in events:
+                if event == "left":
+                    self.devices.pop(key, None)
+                else:
+                    self.devices[key] = (serial, device)
+            self.generation += 1
+            self.condition.notify_all()
+        for event in events:
+            self.notify(*event)
+
+    def add_listener(self, listener):
+        """
+        Calls listener with (event, key, serial, device) for every badge that arrives or leaves, bound methods are referenced weakly
+        """
+        with self.condition:
+            self.listeners.append(weakref.WeakMethod(listener) if hasattr(listener, "__self__") else (lambda: listener))
+
+    def notify(self, *event):
+        with self.condition:
+            listeners = [reference() for reference in self.listeners]
+            self.listeners = [reference for reference, listener in zip(self.listeners, listeners) if listener is not None]
+        for listener in listeners:
+            if listener is not None:
+                listener(*event)
+
+    def badges(self):
+        """
+        Returns a list of (serial number, device) tuples for the connected badges
+        """
+        with self.condition:
+            return list(self.devices.values())
+
+    def wait_for(self, match, timeout = None, exclude = []):
+        """
+        Waits for a badge, returns its (serial number, device) or None if none was connected before the timeout
+        @params:
+            match       - Required  : function called with the serial number, returns True for a suitable badge
+            timeout     - Optional  : seconds to wait, None to wait forever (Float)
+            exclude     - Optional  : keys of devices to ignore (List)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for key, (serial, device) in self.devices.items():
+                    if key not in exclude and match(serial):
+                        return (serial, device)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def wait_change(self, generation, timeout = None):
+        """
+        Waits until the list of badges differs from generation, returns the current generation
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+shared = None
+shared_lock = threading.Lock()
+
+def monitor():
+    """
+    Returns the monitor shared by everything in the process, started on first use
+    """
+    global shared
+    with shared_lock:
+        if shared is None:
+            shared = HotplugMonitor()
+        return shared
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Cache of directory listings of the FAT filesystems of the badge
+#
+# Used by the shell for completion and by the HTTP gateway. Every badge
+# access is done while holding badge.lock, so the cache can be refreshed from
+# a background thread while the badge is used by another thread.
+
+import posixpath
+import threading
+import time
+
+ROOT_LISTING = [
+    {"type": 2, "name": b"internal", "stat": None},
+    {"type": 2, "name": b"sd", "stat": None},
+]
+
+class ListingCache:
+    """
+    Cache of fs_list results. With background set, stale listings are returned and refreshed by a background thread, otherwise they are fetched again
+    """
+    def __init__(self, badge, max_age = 5.0, prefetch = 32, background = True, scheduler = None):
+        self.badge = badge
+        self.scheduler = scheduler # Listings are requested through the scheduler if given (see webusb_scheduler.py)
+        self.max_age = max_age
+        self.prefetch = prefetch # Maximum number of subdirectories fetched in the background per listing
+        self.background = background
+        self.entries = {} # path: (time, listing)
+        self.queue = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        if background:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+
+    def fetch(self, path):
+        if path == "/":
+            return ROOT_LISTING
+        if self.scheduler is not None:
+            listing = self.scheduler.call(lambda badge: badge.fs_list(path.encode("ascii", "ignore")))
+        else:
+            with self.badge.lock:
+                listing = self.badge.fs_list(path.encode("ascii", "ignore"))
+        with self.lock:
+            if listing is None:
+                self.entries.pop(path, None)
+            else:
+                self.entries[path] = (time.monotonic(), listing)
+        return listing
+
+    def get(self, path, wait = True):
+        """
+        Returns the listing of path, from the cache if possible. Returns None if the path is not a directory, or if it isn't cached and wait is False
+        """
+        if path == "/":
+            return ROOT_LISTING
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None:
+            if time.monotonic() - entry[0] <= self.max_age:
+                return entry[1]
+            if self.background:
+                self.refresh(path)
+                return entry[1]
+        elif not wait and self.background:
+            self.refresh(path)
+            return None
+        return self.fetch(path)
+
+    def refresh(self, path):
+        with self.lock:
+            if path not in self.queue:
+                self.queue.append(path)
+        self.wakeup.set()
+
+    def prefetch_children(self, path, listing):
+        if not self.background:
+            return
+        count = 0
+        for item in listing:
+            if count >= self.prefetch:
+                break
+            if item["type"] != 2:
+                continue
+            child = posixpath.join(path, item["name"].decode("ascii", "ignore"))
+            with self.lock:
+                cached = child in self.entries
+            if not cached:
+                self.refresh(child)
+                count += 1
+
+    def invalidate(self, path):
+        """
+        Drops the cached listings of path, everything below it and its parent directory
+        """
+        parent = posixpath.dirname(path)
+        with self.lock:
+            for cached in list(self.entries):
+                if cached == path or cached == parent or cached.startswith(path + "/"):
+                    del self.entries[cached]
+
+    def worker(self):
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                if len(self.queue) < 1:
+                    self.wakeup.clear()
+                    continue
+                path = self.queue.pop(0)
+            try:
+                self.fetch(path)
+            except IOError:
+                pass # The badge was unplugged, the listing is requested again when it is needed
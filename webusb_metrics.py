@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# Protocol metrics for the MCH2022 badge WebUSB tools
+#
+# Every Badge records the latency of each command, the number of bytes sent
+# and received, retries, garbage bytes and CRC failures in a Metrics object.
+# Set BADGE_METRICS to a JSON file to accumulate the metrics of every run in
+# that file, and BADGE_METRICS_PROM to a file in the textfile collector
+# directory of the Prometheus node exporter to export the accumulated totals.
+# Without BADGE_METRICS the totals are kept in BADGE_METRICS_PROM + ".json".
+# Exports are serialised with a lock file, so processes exiting at the same
+# time don't lose each other's counts.
+
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows, concurrent exports aren't serialised
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.crc_errors = 0
+        self.garbage_bytes = 0
+        self.retries = 0
+
+    def _command(self, command):
+        name = command.decode("ascii", "ignore") if isinstance(command, bytes) else command
+        if name not in self.commands:
+            self.commands[name] = {
+                "count": 0,
+                "errors": 0,
+                "retries": 0,
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "latency_sum": 0.0,
+                "latency_min": None,
+                "latency_max": None,
+                "buckets": [0] * (len(BUCKETS) + 1),
+            }
+        return self.commands[name]
+
+    def observe(self, command, latency, bytes_sent, bytes_received, success = True):
+        with self.lock:
+            entry = self._command(command)
+            entry["count"] += 1
+            if not success:
+                entry["errors"] += 1
+            entry["bytes_sent"] += bytes_sent
+            entry["bytes_received"] += bytes_received
+            entry["latency_sum"] += latency
+            entry["latency_min"] = latency if entry["latency_min"] is None else min(entry["latency_min"], latency)
+            entry["latency_max"] = latency if entry["latency_max"] is None else max(entry["latency_max"], latency)
+            index = 0
+            while index < len(BUCKETS) and latency > BUCKETS[index]:
+                index += 1
+            entry["buckets"][index] += 1
+
+    def retry(self, command):
+        with self.lock:
+            self._command(command)["retries"] += 1
+            self.retries += 1
+
+    def crc_error(self):
+        with self.lock:
+            self.crc_errors += 1
+
+    def garbage(self, length):
+        with self.lock:
+            self.garbage_bytes += length
+
+    def percentile(self, command, fraction):
+        """
+        Estimates a latency percentile of a command from its histogram, returns the upper bound of the bucket
+        """
+        entry = self.commands.get(command.decode("ascii", "ignore") if isinstance(command, bytes) else command)
+        if entry is None or entry["count"] == 0:
+            return None
+        target = fraction * entry["count"]
+        total = 0
+        for index, count in enumerate(entry["buckets"]):
+            total += count
+            if total >= target:
+                return min(BUCKETS[index], entry["latency_max"]) if index < len(BUCKETS) else entry["latency_max"]
+        return entry["latency_max"]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "buckets": list(BUCKETS),
+                "commands": {name: dict(entry, buckets=list(entry["buckets"])) for name, entry in self.commands.items()},
+                "crc_errors": self.crc_errors,
+                "garbage_bytes": self.garbage_bytes,
+                "retries": self.retries,
+            }
+
+    def merge(self, snapshot):
+        """
+        Adds the metrics from a snapshot, used for accumulating the metrics of multiple runs
+        """
+        if snapshot.get("buckets") != BUCKETS:
+            return False
+        with self.lock:
+            for name, other in snapshot["commands"].items():
+                entry = self._command(name)
+                for key in ["count", "errors", "retries", "bytes_sent", "bytes_received", "latency_sum"]:
+                    entry[key] += other[key]
+                for key, function in [("latency_min", min), ("latency_max", max)]:
+                    if other[key] is not None:
+                        entry[key] = other[key] if entry[key] is None else function(entry[key], other[key])
+                entry["buckets"] = [a + b for a, b in zip(entry["buckets"], other["buckets"])]
+            self.crc_errors += snapshot["crc_errors"]
+            self.garbage_bytes += snapshot["garbage_bytes"]
+            self.retries += snapshot["retries"]
+        return True
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        lines.append("# HELP badge_command_duration_seconds Time between sending a command to the badge and receiving the response")
+        lines.append("# TYPE badge_command_duration_seconds histogram")
+        for name, entry in sorted(snapshot["commands"].items()):
+            total = 0
+            for index, bound in enumerate(BUCKETS):
+                total += entry["buckets"][index]
+                lines.append('badge_command_duration_seconds_bucket{{command="{}",le="{}"}} {}'.format(name, bound, total))
+            lines.append('badge_command_duration_seconds_bucket{{command="{}",le="+Inf"}} {}'.format(name, entry["count"]))
+            lines.append('badge_command_duration_seconds_sum{{command="{}"}} {}'.format(name, entry["latency_sum"]))
+            lines.append('badge_command_duration_seconds_count{{command="{}"}} {}'.format(name, entry["count"]))
+        for (key, metric, description) in [
+            ("errors", "badge_command_errors_total", "Commands that did not receive a valid response"),
+            ("retries", "badge_command_retries_total", "Commands that were retried"),
+            ("bytes_sent", "badge_command_sent_bytes_total", "Bytes sent to the badge, including headers"),
+            ("bytes_received", "badge_command_received_bytes_total", "Bytes received from the badge, including headers"),
+        ]:
+            lines.append("# HELP {} {}".format(metric, description))
+            lines.append("# TYPE {} counter".format(metric))
+            for name, entry in sorted(snapshot["commands"].items()):
+                lines.append('{}{{command="{}"}} {}'.format(metric, name, entry[key]))
+        for (key, metric, description) in [
+            ("crc_errors", "badge_crc_errors_total", "Packets dropped because of a payload CRC mismatch"),
+            ("garbage_bytes", "badge_garbage_bytes_total", "Bytes received outside of a packet"),
+            ("retries", "badge_retries_total", "Retried commands"),
+        ]:
+            lines.append("# HELP {} {}".format(metric, description))
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, snapshot[key]))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, filename):
+        import json
+        write_atomic(filename, json.dumps(self.snapshot(), indent=4))
+
+    def write_prometheus(self, filename):
+        write_atomic(filename, self.to_prometheus())
+
+def write_atomic(filename, content):
+    # The node exporter could read a partially written file otherwise
+    temporary = filename + ".tmp"
+    with open(temporary, "w") as f:
+        f.write(content)
+    os.replace(temporary, filename)
+
+def export(metrics, json_filename = None, prometheus_filename = None):
+    """
+    Writes the metrics to the files configured using BADGE_METRICS and BADGE_METRICS_PROM, accumulating earlier runs
+    Without BADGE_METRICS the totals are kept in a JSON file next to the Prometheus file
+    """
+    import json
+    json_filename = json_filename or os.environ.get("BADGE_METRICS")
+    prometheus_filename = prometheus_filename or os.environ.get("BADGE_METRICS_PROM")
+    if not json_filename and not prometheus_filename:
+        return
+    json_filename = json_filename or prometheus_filename + ".json"
+    # Badges in other processes could be exporting at the same time, their totals would be lost otherwise
+    with open(json_filename + ".lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        total = Metrics()
+        try:
+            with open(json_filename, "r") as f:
+                total.merge(json.load(f))
+        except (OSError, ValueError, KeyError):
+            pass
+        total.merge(metrics.snapshot())
+        total.write_json(json_filename)
+        if prometheus_filename:
+            total.write_prometheus(prometheus_filename)
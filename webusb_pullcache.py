@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Local cache of files pulled from the FAT filesystems of the badge
+#
+# Entries are keyed by the serial number of the badge and the remote path, as
+# the same path holds different files on different badges, and are only valid
+# for the size and modification time the file had in the FSLS listing when it
+# was downloaded. A pull first lists the directory and only downloads files
+# whose size or modification time changed, so pulling the same logs again only
+# transfers new data.
+#
+# The cache holds one file per badge and remote path, its index the size,
+# modification time and time of last use of every entry (see webusb_cache.py).
+
+import hashlib
+import json
+
+from webusb_cache import FileCache, default_directory
+
+class PullCache(FileCache):
+    def __init__(self, directory = None, max_size = 256 * 1024 * 1024):
+        super().__init__(directory or default_directory("pull"), max_size, lambda key: hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def key(self, serial, path):
+        return json.dumps([serial or "", path])
+
+    def usable(self, stat):
+        # Without a modification time a changed file of the same size can't be detected
+        return stat is not None and stat["modified"] > 0
+
+    def get(self, serial, path, stat):
+        """
+        Returns the cached content of path if it matches the size and modification time in stat, None otherwise
+        @params:
+            serial      - Required  : serial number of the badge (Str)
+            path        - Required  : remote path (Str)
+            stat        - Required  : stat of the file from fs_list (Dict)
+        """
+        key = self.key(serial, path)
+        entry = self.entries.get(key)
+        if entry is None or not self.usable(stat):
+            return None
+        if entry["size"] != stat["size"] or entry["modified"] != stat["modified"]:
+            return None
+        data = self.read(key)
+        if data is None or len(data) != entry["size"]:
+            self.remove(key)
+            return None
+        return data
+
+    def put(self, serial, path, stat, data):
+        """
+        Stores the content of path on the badge with serial as downloaded while its listing showed stat
+        """
+        key = self.key(serial, path)
+        if not self.usable(stat) or len(data) != stat["size"] or len(data) > self.max_size:
+            self.remove(key)
+            return
+        self.write(key, data, modified=stat["modified"])
+        self.evict()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# Scheduler sharing one badge between several clients
+#
+# All requests are run by a single worker thread. Short requests (listing a
+# directory, checking a file, INFO, reading NVS entries) are functions that
+# run at once. Bulk transfers are jobs: generators that do one CHNK exchange
+# per step (see Badge.write_stream_steps and Badge.read_stream). Between two
+# steps of a job the worker runs all waiting requests with a higher priority
+# (a lower number) first, so a status query only waits for the chunk on the
+# wire instead of for the whole transfer.
+#
+# A job is cancelled by cancelling its Future: the worker closes its generator
+# before the next step, which closes the file it has open on the badge.
+#
+# The badge has a single open file, so a job can't be paused for another job
+# halfway through a file. Jobs run one at a time; when one finishes the next
+# is the waiting job with the highest priority, and among those the job of
+# the client that has been served the least, so one client queueing many
+# transfers doesn't starve the others.
+
+import heapq
+import queue
+import threading
+from concurrent.futures import Future, InvalidStateError
+
+INTERACTIVE = 0
+NORMAL = 10
+BULK = 20
+
+class Scheduler:
+    def __init__(self, badge, wait = 0.005):
+        self.badge = badge
+        self.wait = wait # Seconds to wait when the running job is waiting for data and there are no requests
+        self.condition = threading.Condition()
+        self.requests = [] # Heap of (priority, sequence, function, future)
+        self.jobs = []     # Jobs that haven't started yet
+        self.active = None # Job being run
+        self.served = {}   # client: number of steps run for the jobs of the client
+        self.sequence = 0
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, function, priority = INTERACTIVE):
+        """
+        Queues a request, returns a Future with its result
+        @params:
+            function    - Required  : called with the badge on the worker thread
+            priority    - Optional  : lower numbers are run first (Int)
+        """
+        future = Future()
+        with self.condition:
+            heapq.heappush(self.requests, (priority, self.sequence, function, future))
+            self.sequence += 1
+            self.condition.notify()
+        return future
+
+    def call(self, function, priority = INTERACTIVE):
+        """
+        Runs a request and waits for its result
+        """
+        return self.submit(function, priority).result()
+
+    def submit_job(self, start, priority = BULK, client = None):
+        """
+        Queues a transfer, returns a Future with its result
+        @params:
+            start       - Required  : called with the badge on the worker thread, returns a generator that yields True after every step and False while it waits for data. Its return value is the result
+            priority    - Optional  : lower numbers are run first (Int)
+            client      - Optional  : identifies the client for sharing the badge fairly between clients
+        """
+        future = Future()
+        with self.condition:
+            self.jobs.append({"start": start, "steps": None, "priority": priority, "client": client, "future": future, "sequence": self.sequence})
+            self.sequence += 1
+            self.condition.notify()
+        return future
+
+    def next_request(self):
+        if len(self.requests) < 1:
+            return None
+        if self.active is not None:
+            limit = self.active["priority"]
+            if self.requests[0][0] >= limit:
+                return None # Waits for the transfer to finish
+        elif len(self.jobs) > 0 and self.requests[0][0] > min(job["priority"] for job in self.jobs):
+            return None
+        return heapq.heappop(self.requests)
+
+    def next_job(self):
+        if self.active is None and len(self.jobs) > 0:
+            self.active = min(self.jobs, key=lambda job: (job["priority"], self.served.get(job["client"], 0), job["sequence"]))
+            self.jobs.remove(self.active)
+        return self.active
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while len(self.requests) < 1 and len(self.jobs) < 1 and self.active is None:
+                    self.condition.wait()
+                request = self.next_request()
+                job = self.next_job() if request is None else None
+            if request is not None:
+                self.run_request(request)
+            elif job is not None:
+                self.step(job)
+
+    def run_request(self, request):
+        (priority, sequence, function, future) = request
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            with self.badge.lock:
+                result = function(self.badge)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        future.set_result(result)
+
+    def step(self, job):
+        if job["future"].cancelled():
+            self.cancel(job)
+            return
+        progress = False
+        try:
+            with self.badge.lock:
+                if job["steps"] is None:
+                    job["steps"] = job["start"](self.badge)
+                progress = next(job["steps"])
+        except StopIteration as e:
+            self.finish(job)
+            settle(job["future"], e.value)
+            return
+        except Exception as e:
+            self.finish(job)
+            settle(job["future"], exception=e)
+            return
+        if progress:
+            self.served[job["client"]] = self.served.get(job["client"], 0) + 1
+        else:
+            with self.condition:
+                if len(self.requests) < 1 or self.requests[0][0] >= job["priority"]:
+                    self.condition.wait(self.wait)
+
+    def finish(self, job):
+        with self.condition:
+            self.active = None
+
+    def cancel(self, job):
+        # Closing the generator of a job that has started closes the file it has open on the badge
+        try:
+            with self.badge.lock:
+                if job["steps"] is not None:
+                    job["steps"].close()
+        except Exception as e:
+            print("Failed to stop a cancelled transfer:", e)
+        self.finish(job)
+
+def settle(future, result = None, exception = None):
+    # The future may have been cancelled by its owner while the job was running, the result is dropped then
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+def read_job(open_stream, sink, cancelled):
+    """
+    Job reading a file into a queue: True once the file is opened, then the chunks and None at the end. False is put if the file can't be opened and an IOError if reading fails
+    @params:
+        open_stream - Required  : called with the badge, returns a generator of chunks or False (like Badge.fs_read_stream)
+        sink        - Required  : bounded queue the chunks are put in (queue.Queue)
+        cancelled   - Required  : set when the receiver stopped reading (threading.Event)
+    """
+    def put(item):
+        while True:
+            if cancelled.is_set():
+                return False
+            try:
+                sink.put_nowait(item)
+                return True
+            except queue.Full:
+                yield False
+
+    def start(badge):
+        stream = open_stream(badge)
+        if stream is False:
+            sink.put(False)
+            return False
+        sink.put(True)
+        try:
+            for chunk in stream:
+                if not (yield from put(chunk)):
+                    stream.close()
+                    return False
+                yield True
+        except IOError as e:
+            yield from put(e)
+            return False
+        except GeneratorExit:
+            # The job was cancelled, closing the stream closes the file on the badge
+            stream.close()
+            raise
+        yield from put(None)
+        return True
+    return start
+
+def queued_chunks(source):
+    """
+    Generator of the chunks put in a queue by another thread, until None. Yields empty chunks while the queue is empty (see Badge.write_stream_steps), raises exceptions put in the queue
+    """
+    while True:
+        try:
+            item = source.get_nowait()
+        except queue.Empty:
+            yield b""
+            continue
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+
+# Simulated MCH2022 badge speaking the FEEDF00D WebUSB protocol
+#
+# SimulatedDevice behaves like the pyusb device object that Badge normally
+# gets from usb.core.find(), which allows the complete host side stack to run
+# without a physical badge:
+#
+#     badge = Badge(SimulatedDevice(latency = 0.002, bandwidth = 90000))
+#     badge.begin()
+#
+# The FAT filesystems are kept in memory (MemoryFilesystem) or mapped onto a
+# local directory (DirectoryFilesystem). AppFS and NVS are kept in memory.
+#
+# FaultyDevice wraps a simulated or real device and injects faults into the
+# data read from the badge.
+#
+# unplug() makes every following transfer fail the way pyusb fails for a
+# device that was removed, plug() connects the badge again, freshly booted
+# and under a new USB address.
+
+import os
+import random
+import shutil
+import struct
+import binascii
+import errno
+import time
+import usb.core
+
+MAGIC = 0xFEEDF00D
+
+# Defined in webusb_task.c of the RP2040 firmware
+REQUEST_STATE          = 0x22
+REQUEST_RESET          = 0x23
+REQUEST_BAUDRATE       = 0x24
+REQUEST_MODE           = 0x25
+REQUEST_MODE_GET       = 0x26
+REQUEST_FW_VERSION_GET = 0x27
+
+BOOT_MODE_NORMAL = 0x00
+BOOT_MODE_WEBUSB = 0x03
+
+# Error responses sent by the simulator, only ERR5 is interpreted by the host
+ERR_UNKNOWN_COMMAND = b"ERR1"
+ERR_CRC             = b"ERR2"
+ERR_NO_FILE_OPEN    = b"ERR3"
+ERR_INVALID         = b"ERR4"
+ERR_OPEN_DIRECTORY  = b"ERR5"
+
+FS_TYPE_FILE      = 1
+FS_TYPE_DIRECTORY = 2
+
+def split_path(path):
+    if not (path.startswith("/internal") or path.startswith("/sd")):
+        return None
+    return [part for part in path.split("/") if part]
+
+class MemoryFilesystem:
+    def __init__(self, internal_size = 4 * 1024 * 1024, sd_size = 0):
+        self.sizes = {"internal": internal_size, "sd": sd_size}
+        self.directories = {"/internal": time.time()}
+        if sd_size > 0:
+            self.directories["/sd"] = time.time()
+        self.files = {}
+
+    def _normalize(self, path):
+        parts = split_path(path)
+        if parts is None:
+            return None
+        return "/" + "/".join(parts)
+
+    def _parent_exists(self, path):
+        return path.rsplit("/", 1)[0] in self.directories
+
+    def list(self, path):
+        path = self._normalize(path)
+        if path not in self.directories:
+            return None
+        prefix = path + "/"
+        output = []
+        for name, modified in self.directories.items():
+            if name.startswith(prefix) and "/" not in name[len(prefix):]:
+                output.append((FS_TYPE_DIRECTORY, name[len(prefix):], 0, int(modified)))
+        for name, (data, modified) in self.files.items():
+            if name.startswith(prefix) and "/" not in name[len(prefix):]:
+                output.append((FS_TYPE_FILE, name[len(prefix):], len(data), int(modified)))
+        return output
+
+    def exists(self, path):
+        path = self._normalize(path)
+        return path in self.files or path in self.directories
+
+    def create_directory(self, path):
+        path = self._normalize(path)
+        if path is None or path in self.files or path in self.directories or not self._parent_exists(path):
+            return False
+        self.directories[path] = time.time()
+        return True
+
+    def remove(self, path):
+        path = self._normalize(path)
+        if path is None:
+            return False
+        if path in self.files:
+            del self.files[path]
+            return True
+        if path not in self.directories or path.count("/") < 2:
+            return False
+        prefix = path + "/"
+        for name in [name for name in self.files if name.startswith(prefix)]:
+            del self.files[name]
+        for name in [name for name in self.directories if name.startswith(prefix) or name == path]:
+            del self.directories[name]
+        return True
+
+    def read(self, path):
+        path = self._normalize(path)
+        if path not in self.files:
+            return None
+        return bytes(self.files[path][0])
+
+    def write(self, path, data):
+        path = self._normalize(path)
+        if path is None or path in self.directories or not self._parent_exists(path):
+            return False
+        self.files[path] = (bytes(data), time.time())
+        return True
+
+    def can_write(self, path):
+        path = self._normalize(path)
+        return path is not None and path not in self.directories and self._parent_exists(path)
+
+    def state(self):
+        used = {"internal": 0, "sd": 0}
+        for name, (data, modified) in self.files.items():
+            used[name.split("/")[1]] += len(data)
+        return {key: (self.sizes[key], max(0, self.sizes[key] - used[key])) for key in self.sizes}
+
+class DirectoryFilesystem:
+    def __init__(self, root, internal_size = 4 * 1024 * 1024, sd_size = 32 * 1024 * 1024):
+        self.root = root
+        self.sizes = {"internal": internal_size, "sd": sd_size}
+        for name in self.sizes:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    def _local(self, path):
+        parts = split_path(path)
+        if parts is None or ".." in parts:
+            return None
+        return os.path.join(self.root, *parts)
+
+    def list(self, path):
+        local = self._local(path)
+        if local is None or not os.path.isdir(local):
+            return None
+        output = []
+        for name in sorted(os.listdir(local)):
+            stat = os.stat(os.path.join(local, name))
+            if os.path.isdir(os.path.join(local, name)):
+                output.append((FS_TYPE_DIRECTORY, name, 0, int(stat.st_mtime)))
+            else:
+                output.append((FS_TYPE_FILE, name, stat.st_size, int(stat.st_mtime)))
+        return output
+
+    def exists(self, path):
+        local = self._local(path)
+        return local is not None and os.path.exists(local)
+
+    def create_directory(self, path):
+        local = self._local(path)
+        if local is None or os.path.exists(local) or not os.path.isdir(os.path.dirname(local)):
+            return False
+        os.mkdir(local)
+        return True
+
+    def remove(self, path):
+        local = self._local(path)
+        if local is None or len(split_path(path)) < 2:
+            return False
+        if os.path.isdir(local):
+            shutil.rmtree(local)
+            return True
+        if os.path.isfile(local):
+            os.remove(local)
+            return True
+        return False
+
+    def read(self, path):
+        local = self._local(path)
+        if local is None or not os.path.isfile(local):
+            return None
+        with open(local, "rb") as f:
+            return f.read()
+
+    def write(self, path, data):
+        if not self.can_write(path):
+            return False
+        with open(self._local(path), "wb") as f:
+            f.write(data)
+        return True
+
+    def can_write(self, path):
+        local = self._local(path)
+        return local is not None and not os.path.isdir(local) and os.path.isdir(os.path.dirname(local))
+
+    def state(self):
+        output = {}
+        for name, size in self.sizes.items():
+            used = 0
+            for root, dirs, files in os.walk(os.path.join(self.root, name)):
+                used += sum(os.path.getsize(os.path.join(root, filename)) for filename in files)
+            output[name] = (size, max(0, size - used))
+        return output
+
+class SimulatedEndpoint:
+    def __init__(self, device, address, packet_size):
+        self.device = device
+        self.bEndpointAddress = address
+        self.wMaxPacketSize = packet_size
+
+    def write(self, data, timeout = None):
+        return self.device.usb_write(bytes(data))
+
+    def read(self, size, timeout = None):
+        return self.device.usb_read(size, timeout)
+
+class SimulatedInterface:
+    bInterfaceNumber = 4
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+
+    def __iter__(self):
+        return iter(self.endpoints)
+
+class SimulatedDevice:
+    addresses = 0 # USB addresses handed out to simulated badges
+
+    def __init__(self, filesystem = None, latency = 0.0, bandwidth = None, packet_size = 64, chunk_size = 4096,
+                 appfs_size = 8 * 1024 * 1024, info = "MCH2022 v2.0.5-simulated", mode = BOOT_MODE_WEBUSB, serial = "SIMULATED0001"):
+        """
+        Simulated badge
+        @params:
+            filesystem  - Optional  : MemoryFilesystem or DirectoryFilesystem instance
+            latency     - Optional  : seconds between receiving a request and starting the response (Float)
+            bandwidth   - Optional  : link speed in bytes per second in both directions, None for unlimited (Int)
+            packet_size - Optional  : maximum number of bytes returned by a single USB read (Int)
+            chunk_size  - Optional  : number of bytes returned for a CHNK read request (Int)
+            appfs_size  - Optional  : size of the AppFS partition in bytes (Int)
+            info        - Optional  : device name and firmware version returned by INFO (Str)
+            mode        - Optional  : boot mode the ESP32 starts in (Int)
+            serial      - Optional  : USB serial number (Str)
+        """
+        self.filesystem = filesystem if filesystem is not None else MemoryFilesystem()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.packet_size = packet_size
+        self.chunk_size = chunk_size
+        self.appfs_size = appfs_size
+        self.info = info
+        self.mode = mode
+        self.serial_number = serial
+        self.connected = True
+        self.bus = 1
+        self.address = self._next_address()
+        self.apps = {}
+        self.nvs = {}
+        self.started_app = None
+        self.interface = SimulatedInterface([
+            SimulatedEndpoint(self, 0x03, packet_size),
+            SimulatedEndpoint(self, 0x83, packet_size),
+        ])
+        self._reset_state()
+
+    def _reset_state(self):
+        self.rx_data = bytearray()
+        self.tx_queue = []
+        self.tx_end = 0
+        self.open_file = None
+
+    def get_active_configuration(self):
+        return {(4, 0): self.interface}
+
+    @classmethod
+    def _next_address(cls):
+        cls.addresses += 1
+        return cls.addresses
+
+    def unplug(self):
+        self.connected = False
+
+    def plug(self):
+        self.connected = True
+        self.address = self._next_address()
+        self.mode = BOOT_MODE_NORMAL
+        self._reset_state()
+
+    def _check_connected(self):
+        if not self.connected:
+            raise usb.core.USBError("No such device (it may have been disconnected)", -4, errno.ENODEV)
+
+    def ctrl_transfer(self, request_type, request, value = 0, index = 0, data_or_length = None, timeout = None):
+        self._check_connected()
+        if request == REQUEST_MODE_GET:
+            return bytes([self.mode])
+        if request == REQUEST_MODE:
+            self.mode = value
+        elif request == REQUEST_RESET:
+            self._reset_state()
+        return 0
+
+    # USB transport
+
+    def _transfer_time(self, length):
+        if not self.bandwidth:
+            return 0
+        return length / self.bandwidth
+
+    def usb_write(self, data):
+        self._check_connected()
+        delay = self._transfer_time(len(data))
+        if delay > 0:
+            time.sleep(delay)
+        if self.mode == BOOT_MODE_WEBUSB:
+            self.rx_data += data
+            self._process()
+        return len(data)
+
+    def _next_read(self, size):
+        # Time at which the next USB packet has been transferred completely
+        if len(self.tx_queue) < 1:
+            return None
+        start, end, data = self.tx_queue[0]
+        return start + self._transfer_time(min(size, self.packet_size, len(data)))
+
+    def usb_read(self, size, timeout = None):
+        self._check_connected()
+        ready = self._next_read(size)
+        now = time.monotonic()
+        if ready is None or ready > now:
+            wait = (timeout if timeout else 1000) / 1000
+            if ready is not None:
+                wait = min(wait, ready - now)
+            time.sleep(max(0, wait))
+            ready = self._next_read(size)
+            if ready is None or ready > time.monotonic():
+                raise usb.core.USBTimeoutError("Operation timed out")
+        start, end, data = self.tx_queue[0]
+        length = min(size, self.packet_size, len(data))
+        output = data[:length]
+        if length < len(data):
+            self.tx_queue[0] = (start + self._transfer_time(length), end, data[length:])
+        else:
+            self.tx_queue.pop(0)
+        return output
+
+    def _send(self, identifier, command, payload = b""):
+        data = struct.pack("<IIIII", MAGIC, identifier, int.from_bytes(command, "little"), len(payload), binascii.crc32(payload)) + payload
+        start = max(time.monotonic() + self.latency, self.tx_end)
+        self.tx_end = start + self._transfer_time(len(data))
+        self.tx_queue.append((start, self.tx_end, data))
+
+    def _process(self):
+        while len(self.rx_data) >= 20:
+            (magic, identifier, command, length, crc) = struct.unpack("<IIIII", self.rx_data[:20])
+            if magic != MAGIC:
+                del self.rx_data[0]
+                continue
+            if len(self.rx_data) < 20 + length:
+                return
+            payload = bytes(self.rx_data[20:20 + length])
+            del self.rx_data[:20 + length]
+            command = struct.pack("<I", command)
+            if binascii.crc32(payload) != crc:
+                self._send(identifier, ERR_CRC)
+                continue
+            handler = getattr(self, "_handle_" + command.decode("ascii", "ignore").lower(), None)
+            if handler is None:
+                self._send(identifier, ERR_UNKNOWN_COMMAND)
+                continue
+            response = handler(payload)
+            if isinstance(response, tuple):
+                self._send(identifier, response[0], response[1])
+            else:
+                self._send(identifier, command, response)
+
+    # Protocol commands
+
+    def _handle_sync(self, payload):
+        return struct.pack("<H", 0x0001)
+
+    def _handle_ping(self, payload):
+        return payload
+
+    def _handle_info(self, payload):
+        return self.info.encode("ascii", "ignore")
+
+    def _handle_fsls(self, payload):
+        entries = self.filesystem.list(payload.rstrip(b"\0").decode("ascii", "ignore"))
+        if entries is None:
+            return (ERR_OPEN_DIRECTORY, b"")
+        output = bytearray()
+        for (item_type, name, size, modified) in entries:
+            name = name.encode("ascii", "ignore")
+            output += struct.pack("<BI", item_type, len(name)) + name + struct.pack("<iIQ", 0, size, modified)
+        return bytes(output)
+
+    def _handle_fsex(self, payload):
+        return bytes([self.filesystem.exists(payload.decode("ascii", "ignore"))])
+
+    def _handle_fsmd(self, payload):
+        return bytes([self.filesystem.create_directory(payload.decode("ascii", "ignore"))])
+
+    def _handle_fsrm(self, payload):
+        return bytes([self.filesystem.remove(payload.decode("ascii", "ignore"))])
+
+    def _handle_fsst(self, payload):
+        state = self.filesystem.state()
+        (internal_size, internal_free) = state["internal"]
+        (sd_size, sd_free) = state["sd"]
+        appfs_used = sum(len(app["data"]) for app in self.apps.values())
+        return struct.pack("<QQQQQQ", internal_size, internal_free, sd_size, sd_free, self.appfs_size, self.appfs_size - appfs_used)
+
+    def _handle_fsfw(self, payload):
+        path = payload.decode("ascii", "ignore")
+        if not self.filesystem.can_write(path):
+            self.open_file = None
+            return bytes([0])
+        self.open_file = {"mode": "fs_write", "path": path, "data": bytearray()}
+        return bytes([1])
+
+    def _handle_fsfr(self, payload):
+        data = self.filesystem.read(payload.decode("ascii", "ignore"))
+        if data is None:
+            self.open_file = None
+            return bytes([0])
+        self.open_file = {"mode": "read", "data": data, "position": 0}
+        return bytes([1])
+
+    def _handle_chnk(self, payload):
+        if self.open_file is None:
+            return (ERR_NO_FILE_OPEN, b"")
+        if self.open_file["mode"] == "read":
+            position = self.open_file["position"]
+            chunk = self.open_file["data"][position:position + self.chunk_size]
+            self.open_file["position"] += len(chunk)
+            return chunk
+        self.open_file["data"] += payload
+        return struct.pack("<I", len(payload))
+
+    def _handle_fsfc(self, payload):
+        if self.open_file is None:
+            return bytes([0])
+        open_file = self.open_file
+        self.open_file = None
+        if open_file["mode"] == "fs_write":
+            return bytes([self.filesystem.write(open_file["path"], open_file["data"])])
+        if open_file["mode"] == "app_write":
+            self.apps[open_file["name"]] = {
+                "title": open_file["title"],
+                "version": open_file["version"],
+                "data": bytes(open_file["data"][:open_file["size"]]),
+            }
+        return bytes([1])
+
+    def _handle_appl(self, payload):
+        output = bytearray()
+        for name, app in self.apps.items():
+            output += struct.pack("<H", len(name)) + name + struct.pack("<H", len(app["title"])) + app["title"]
+            output += struct.pack("<HI", app["version"], len(app["data"]))
+        return bytes(output)
+
+    def _handle_appr(self, payload):
+        if payload not in self.apps:
+            self.open_file = None
+            return bytes([0])
+        self.open_file = {"mode": "read", "data": self.apps[payload]["data"], "position": 0}
+        return bytes([1])
+
+    def _handle_appw(self, payload):
+        try:
+            name_length = payload[0]
+            name = payload[1:1 + name_length]
+            payload = payload[1 + name_length:]
+            title_length = payload[0]
+            title = payload[1:1 + title_length]
+            (size, version) = struct.unpack("<LH", payload[1 + title_length:1 + title_length + 6])
+        except (IndexError, struct.error):
+            return (ERR_INVALID, b"")
+        available = self.appfs_size - sum(len(app["data"]) for key, app in self.apps.items() if key != name)
+        if size > available or name_length < 1:
+            self.open_file = None
+            return bytes([0])
+        self.open_file = {"mode": "app_write", "name": name, "title": title, "version": version, "size": size, "data": bytearray()}
+        return bytes([1])
+
+    def _handle_appd(self, payload):
+        if payload not in self.apps:
+            return bytes([0])
+        del self.apps[payload]
+        return bytes([1])
+
+    def _handle_appx(self, payload):
+        name = payload.split(b"\0")[0]
+        if name not in self.apps:
+            return bytes([0])
+        self.started_app = payload
+        return bytes([1])
+
+    def _parse_nvs_key(self, payload):
+        namespace_length = payload[0]
+        namespace = payload[1:1 + namespace_length].decode("ascii", "ignore")
+        payload = payload[1 + namespace_length:]
+        key_length = payload[0]
+        key = payload[1:1 + key_length].decode("ascii", "ignore")
+        return namespace, key, payload[1 + key_length:]
+
+    def _handle_nvsl(self, payload):
+        namespace_filter = payload.decode("ascii", "ignore")
+        output = bytearray()
+        for (namespace, key), (value_type, value) in self.nvs.items():
+            if namespace_filter and namespace != namespace_filter:
+                continue
+            output += struct.pack("<H", len(namespace)) + namespace.encode("ascii")
+            output += struct.pack("<H", len(key)) + key.encode("ascii")
+            output += struct.pack("<BL", value_type, len(value))
+        return bytes(output)
+
+    def _handle_nvsr(self, payload):
+        try:
+            namespace, key, payload = self._parse_nvs_key(payload)
+        except IndexError:
+            return (ERR_INVALID, b"")
+        entry = self.nvs.get((namespace, key))
+        if entry is None or entry[0] != payload[0]:
+            return b""
+        return entry[1]
+
+    def _handle_nvsw(self, payload):
+        try:
+            namespace, key, payload = self._parse_nvs_key(payload)
+            self.nvs[(namespace, key)] = (payload[0], bytes(payload[1:]))
+        except IndexError:
+            return (ERR_INVALID, b"")
+        return bytes([1])
+
+    def _handle_nvsd(self, payload):
+        try:
+            namespace, key, payload = self._parse_nvs_key(payload)
+        except IndexError:
+            return (ERR_INVALID, b"")
+        if (namespace, key) not in self.nvs:
+            return bytes([0])
+        del self.nvs[(namespace, key)]
+        return bytes([1])
+
+class FaultyEndpoint:
+    def __init__(self, device, endpoint):
+        self.device = device
+        self.endpoint = endpoint
+        self.bEndpointAddress = endpoint.bEndpointAddress
+        self.wMaxPacketSize = endpoint.wMaxPacketSize
+
+    def write(self, data, timeout = None):
+        return self.endpoint.write(data, timeout)
+
+    def read(self, size, timeout = None):
+        return self.device.faulty_read(self.endpoint, size, timeout)
+
+class FaultyDevice:
+    def __init__(self, device, drop_rate = 0.0, garbage_rate = 0.0, corrupt_rate = 0.0, delay_rate = 0.0, delay = 0.05, seed = None):
+        """
+        Fault injecting wrapper around a simulated or real device
+        @params:
+            device       - Required  : device to wrap
+            drop_rate    - Optional  : probability of discarding the data of a USB read (Float)
+            garbage_rate - Optional  : probability of appending random bytes to a USB read (Float)
+            corrupt_rate - Optional  : probability of flipping a bit in a USB read (Float)
+            delay_rate   - Optional  : probability of delaying a USB read (Float)
+            delay        - Optional  : duration of a delay in seconds (Float)
+            seed         - Optional  : seed for the random number generator (Int)
+        """
+        self.device = device
+        self.drop_rate = drop_rate
+        self.garbage_rate = garbage_rate
+        self.corrupt_rate = corrupt_rate
+        self.delay_rate = delay_rate
+        self.delay = delay
+        self.random = random.Random(seed)
+        self.enabled = True
+        self.faults = []
+        interface = device.get_active_configuration()[(4, 0)]
+        endpoints = []
+        for endpoint in interface:
+            if endpoint.bEndpointAddress & 0x80:
+                endpoint = FaultyEndpoint(self, endpoint)
+            endpoints.append(endpoint)
+        self.interface = SimulatedInterface(endpoints)
+        self.interface.bInterfaceNumber = interface.bInterfaceNumber
+
+    def get_active_configuration(self):
+        return {(4, 0): self.interface}
+
+    @property
+    def serial_number(self):
+        return self.device.serial_number
+
+    @property
+    def bus(self):
+        return self.device.bus
+
+    @property
+    def address(self):
+        return self.device.address
+
+    def ctrl_transfer(self, *args, **kwargs):
+        return self.device.ctrl_transfer(*args, **kwargs)
+
+    def _roll(self, rate, kind):
+        if not self.enabled or rate <= 0 or self.random.random() >= rate:
+            return False
+        self.faults.append((time.monotonic(), kind))
+        return True
+
+    def faulty_read(self, endpoint, size, timeout):
+        data = bytearray(endpoint.read(size, timeout))
+        if self._roll(self.delay_rate, "delay"):
+            time.sleep(self.delay)
+        if self._roll(self.drop_rate, "drop"):
+            raise usb.core.USBTimeoutError("Operation timed out")
+        if len(data) > 0 and self._roll(self.corrupt_rate, "corrupt"):
+            data[self.random.randrange(len(data))] ^= 1 << self.random.randrange(8)
+        if self._roll(self.garbage_rate, "garbage"):
+            data += bytes(self.random.randrange(256) for i in range(self.random.randint(1, 16)))
+        return bytes(data)
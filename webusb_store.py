@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Content-addressed chunk store
+#
+# Data is split into chunks of CHUNK_SIZE bytes, every chunk is stored once
+# under the SHA-256 of its content, compressed with zlib:
+#
+#     {directory}/chunks/{first two hex digits}/{sha256}
+#
+# Content stored again only adds the chunks that aren't in the store yet, so
+# data shared between snapshots or between badges is stored once. Appending
+# to a file only adds the chunks after the end of the old content.
+#
+# Snapshots are JSON documents describing what was stored, kept per label:
+#
+#     {directory}/snapshots/{label}/{name}.json
+
+import hashlib
+import json
+import os
+import time
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+class ChunkStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.new_chunks = 0 # Number of chunks added since the store was opened
+        self.new_bytes = 0  # Compressed size of the chunks added since the store was opened
+        os.makedirs(os.path.join(directory, "chunks"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "snapshots"), exist_ok=True)
+
+    def chunk_file(self, digest):
+        return os.path.join(self.directory, "chunks", digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.chunk_file(digest))
+
+    def put_chunk(self, data):
+        """
+        Stores a single chunk if it isn't stored yet, returns its digest
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        filename = self.chunk_file(digest)
+        if os.path.exists(filename):
+            return digest
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        compressed = zlib.compress(data)
+        temporary = filename + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(compressed)
+        os.replace(temporary, filename)
+        self.new_chunks += 1
+        self.new_bytes += len(compressed)
+        return digest
+
+    def get_chunk(self, digest):
+        with open(self.chunk_file(digest), "rb") as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise IOError("Chunk {} is damaged".format(digest))
+        return data
+
+    def put(self, data):
+        """
+        Stores data, returns the list of digests of its chunks
+        """
+        return [self.put_chunk(data[position:position + CHUNK_SIZE]) for position in range(0, len(data), CHUNK_SIZE)]
+
+    def put_stream(self, chunks):
+        """
+        Stores the data from an iterable of byte strings of any size, returns (list of digests, size)
+        """
+        digests = []
+        size = 0
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            size += len(chunk)
+            while len(buffer) >= CHUNK_SIZE:
+                digests.append(self.put_chunk(bytes(buffer[:CHUNK_SIZE])))
+                del buffer[:CHUNK_SIZE]
+        if len(buffer) > 0:
+            digests.append(self.put_chunk(bytes(buffer)))
+        return digests, size
+
+    def get(self, digests):
+        return b"".join(self.stream(digests))
+
+    def stream(self, digests):
+        """
+        Generator returning the content of the chunks one by one, raises IOError for missing or damaged chunks
+        """
+        for digest in digests:
+            try:
+                yield self.get_chunk(digest)
+            except (OSError, zlib.error):
+                raise IOError("Chunk {} is missing or damaged".format(digest))
+
+    def missing(self, digests):
+        return [digest for digest in digests if not self.has(digest)]
+
+    # Snapshots
+
+    def snapshot_file(self, label, name):
+        return os.path.join(self.directory, "snapshots", label, name + ".json")
+
+    def snapshots(self, label):
+        """
+        Returns the names of the snapshots with label, oldest first
+        """
+        try:
+            names = os.listdir(os.path.join(self.directory, "snapshots", label))
+        except OSError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith(".json"))
+
+    def labels(self):
+        return sorted(os.listdir(os.path.join(self.directory, "snapshots")))
+
+    def load_snapshot(self, label, name = None):
+        """
+        Returns the snapshot called name, or the latest snapshot with label if name is None. Returns None if there is no such snapshot
+        """
+        if name is None:
+            names = self.snapshots(label)
+            if len(names) < 1:
+                return None
+            name = names[-1]
+        try:
+            with open(self.snapshot_file(label, name), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_snapshot(self, label, snapshot):
+        """
+        Stores a snapshot under the current time, returns its name
+        """
+        name = time.strftime("%Y%m%d-%H%M%S")
+        count = 1
+        while os.path.exists(self.snapshot_file(label, name)):
+            name = time.strftime("%Y%m%d-%H%M%S") + "-{}".format(count)
+            count += 1
+        filename = self.snapshot_file(label, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temporary = filename + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(temporary, filename)
+        return name
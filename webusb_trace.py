@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Phase tracing for the MCH2022 badge WebUSB tools
+#
+# When enabled, Badge records spans for USB enumeration, resets, syncs and
+# for opening, transferring (per chunk) and closing files. The spans are
+# written in the Chrome trace event format when the process exits, the file
+# can be opened in https://ui.perfetto.dev or chrome://tracing.
+#
+# Enable tracing with the BADGE_TRACE environment variable or the --trace
+# argument of the tools. BADGE_PROFILE or --profile additionally stores a
+# cProfile dump of the run, which can be inspected using pstats or snakeviz.
+
+import atexit
+import contextlib
+import functools
+import os
+import threading
+import time
+
+tracer = None
+null_span = contextlib.nullcontext()
+
+class Tracer:
+    def __init__(self, filename):
+        self.filename = filename
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def timestamp(self):
+        return time.perf_counter() * 1000000
+
+    def add(self, event):
+        event["pid"] = self.pid
+        event["tid"] = threading.get_ident()
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start = self.timestamp()
+        try:
+            yield
+        finally:
+            self.add({"name": name, "ph": "X", "ts": start, "dur": self.timestamp() - start, "args": args})
+
+    def instant(self, name, **args):
+        self.add({"name": name, "ph": "i", "s": "t", "ts": self.timestamp(), "args": args})
+
+    def write(self):
+        import json
+        with self.lock:
+            events = list(self.events)
+        with open(self.filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def enable(filename = None, profile = None):
+    """
+    Starts tracing to filename and/or profiling to profile, the results are written when the process exits
+    """
+    global tracer
+    if filename and tracer is None:
+        tracer = Tracer(filename)
+        atexit.register(tracer.write)
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def dump():
+            profiler.disable()
+            profiler.dump_stats(profile)
+        atexit.register(dump)
+
+def span(name, **args):
+    if tracer is None:
+        return null_span
+    return tracer.span(name, **args)
+
+def instant(name, **args):
+    if tracer is not None:
+        tracer.instant(name, **args)
+
+def traced(name):
+    """
+    Decorator recording a span for every call of the decorated function
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return function(*args, **kwargs)
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def add_arguments(parser):
+    parser.add_argument("--trace", help="Store a Chrome trace of the run in this file")
+    parser.add_argument("--profile", help="Store a cProfile dump of the run in this file")
+
+enable(os.environ.get("BADGE_TRACE"), os.environ.get("BADGE_PROFILE"))